@@ -0,0 +1,45 @@
+"""add content hash to metric_aggregations_j and metric_properties_j
+
+Revision ID: a3f1c9d2e4b7
+Revises: 7f48fc8c8ebf
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c9d2e4b7'
+down_revision = '7f48fc8c8ebf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metric_aggregations_j', sa.Column('hash', mysql.BINARY(length=16), nullable=True))
+    op.add_column('metric_properties_j', sa.Column('hash', mysql.BINARY(length=16), nullable=True))
+
+    # backfill, computed the same way as hs_utils.aggregations_hash and hs_utils.properties_hash
+    op.execute("""UPDATE metric_aggregations_j
+                  SET hash = UNHEX(MD5(JSON_ARRAY(bias_value, properties, aggregations)))""")
+    op.execute("""UPDATE metric_properties_j
+                  SET hash = UNHEX(MD5(JSON_ARRAY(bias_property, properties)))""")
+
+    # nothing used to stop duplicates, so only the oldest row of each content keeps its hash
+    for table in ('metric_aggregations_j', 'metric_properties_j'):
+        op.execute(f"""UPDATE {table} t
+                       JOIN (SELECT hash, MIN(id) AS keep_id FROM {table} GROUP BY hash HAVING COUNT(*) > 1) dupes
+                         ON t.hash = dupes.hash AND t.id != dupes.keep_id
+                       SET t.hash = NULL""")
+
+    op.create_index(op.f('ix_metric_aggregations_j_hash'), 'metric_aggregations_j', ['hash'], unique=True)
+    op.create_index(op.f('ix_metric_properties_j_hash'), 'metric_properties_j', ['hash'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_metric_properties_j_hash'), table_name='metric_properties_j')
+    op.drop_index(op.f('ix_metric_aggregations_j_hash'), table_name='metric_aggregations_j')
+    op.drop_column('metric_properties_j', 'hash')
+    op.drop_column('metric_aggregations_j', 'hash')
@@ -0,0 +1,57 @@
+"""add metric_aggregations_wide
+
+Revision ID: d81b6e0f5a92
+Revises: a3f1c9d2e4b7
+Create Date: 2026-10-18 13:40:05.118236
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81b6e0f5a92'
+down_revision = 'a3f1c9d2e4b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('metric_aggregations_wide',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('properties_id', sa.Integer(), nullable=True),
+                    sa.Column('bias_value', sa.Integer(), nullable=True),
+                    sa.Column('val_1', sa.Integer(), nullable=True),
+                    sa.Column('val_2', sa.Integer(), nullable=True),
+                    sa.Column('val_3', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_metric_aggregations_wide_vals', 'metric_aggregations_wide',
+                    ['properties_id', 'val_1', 'val_2', 'val_3', 'bias_value'], unique=False)
+    op.create_index('ix_metric_aggregations_wide_bias', 'metric_aggregations_wide',
+                    ['properties_id', 'bias_value'], unique=False)
+
+    # backfill the existing aggregations of up to three dimensions. properties are sorted and project is faked as
+    # property 0, so a project can only ever be the first dimension. legacy duplicate properties rows lost their hash,
+    # so the owner is the one row with the content hash of the gender (P21) bias and the aggregation's properties.
+    op.execute("""INSERT IGNORE INTO metric_aggregations_wide(id, properties_id, bias_value, val_1, val_2, val_3)
+                  SELECT j.id,
+                         pj.id,
+                         j.bias_value,
+                         COALESCE(p.id, JSON_UNQUOTE(JSON_EXTRACT(j.aggregations, '$[0]'))),
+                         JSON_UNQUOTE(JSON_EXTRACT(j.aggregations, '$[1]')),
+                         JSON_UNQUOTE(JSON_EXTRACT(j.aggregations, '$[2]'))
+                  FROM metric_aggregations_j j
+                           JOIN metric_properties_j pj
+                                ON pj.hash = UNHEX(MD5(JSON_ARRAY(21, j.properties)))
+                           LEFT JOIN project p
+                                     ON JSON_EXTRACT(j.properties, '$[0]') = 0
+                                         AND p.code = JSON_UNQUOTE(JSON_EXTRACT(j.aggregations, '$[0]'))
+                  WHERE j.aggregations_len <= 3""")
+
+
+def downgrade():
+    op.drop_index('ix_metric_aggregations_wide_bias', table_name='metric_aggregations_wide')
+    op.drop_index('ix_metric_aggregations_wide_vals', table_name='metric_aggregations_wide')
+    op.drop_table('metric_aggregations_wide')
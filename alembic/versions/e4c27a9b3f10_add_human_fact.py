@@ -0,0 +1,37 @@
+"""add human_fact
+
+Revision ID: e4c27a9b3f10
+Revises: d81b6e0f5a92
+Create Date: 2026-10-18 16:02:47.530918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4c27a9b3f10'
+down_revision = 'd81b6e0f5a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('human_fact',
+                    sa.Column('fill_id', sa.Integer(), nullable=False),
+                    sa.Column('project_id', sa.SMALLINT(), nullable=False),
+                    sa.Column('country', sa.Integer(), nullable=False),
+                    sa.Column('qid', sa.Integer(), nullable=False),
+                    sa.Column('gender', sa.Integer(), nullable=True),
+                    sa.Column('year_of_birth', sa.SMALLINT(), nullable=True),
+                    sa.Column('year_of_death', sa.SMALLINT(), nullable=True),
+                    sa.Column('sitelink_count', sa.SMALLINT(), nullable=True),
+                    sa.PrimaryKeyConstraint('fill_id', 'project_id', 'country', 'qid')
+                    )
+    op.create_index('ix_human_fact_qid', 'human_fact', ['fill_id', 'qid'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_human_fact_qid', table_name='human_fact')
+    op.drop_table('human_fact')
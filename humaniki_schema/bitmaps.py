@@ -0,0 +1,195 @@
+import argparse
+import time
+
+import numpy as np
+
+from humaniki_schema.columnar import FillColumns, NULL_VALUE
+from humaniki_schema.db import session_factory
+from humaniki_schema.queries import get_latest_fill_id, get_exact_fill_id
+from humaniki_schema.utils import Properties, PopulationDefinition, make_dump_date_from_str
+from humaniki_schema.log import get_logger
+
+log = get_logger()
+
+# number of set bits of every byte value
+_POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.int64)
+
+
+class FillBitmaps():
+    """
+    Per-value indexes of the humans of one fill, over FillColumns' dense human ordinal, so that any
+    (bias x dimension filters) count can be answered by intersecting them instead of running a MetricCreator.
+    Like a roaring bitmap, but per value rather than per chunk: a value held by few humans keeps the sorted array of
+    their ordinals, and a value held by many a packed bitmap (np.packbits), whichever is smaller.
+    """
+    def __init__(self, fill_id, n_humans, containers):
+        self.fill_id = fill_id
+        self.n_humans = n_humans
+        # {(Properties, value): sorted int32 ordinals, or packed uint8 bitmap}, population masks under
+        # (PopulationDefinition, None)
+        self.containers = containers
+
+    @classmethod
+    def from_fill_columns(cls, fill_columns):
+        build_start = time.time()
+        n_humans = len(fill_columns)
+        containers = {}
+        for population_definition in PopulationDefinition:
+            containers[(population_definition, None)] = _make_container(
+                np.flatnonzero(fill_columns.population_mask(population_definition)), n_humans)
+
+        ordinals = np.arange(n_humans)
+        single_valued = {Properties.GENDER: fill_columns.gender, **fill_columns.single_valued}
+        for prop, values in single_valued.items():
+            known = values != NULL_VALUE
+            containers.update(cls._make_value_containers(prop, ordinals[known], values[known], n_humans))
+        for prop, (offsets, values) in fill_columns.multi_valued.items():
+            owners = np.repeat(ordinals, np.diff(offsets))
+            if prop == Properties.PROJECT:
+                values = fill_columns.sitelink_codes[values]
+            containers.update(cls._make_value_containers(prop, owners, values, n_humans))
+
+        log.info(f'Building {len(containers)} bitmaps of fill {fill_columns.fill_id} took '
+                 f'{round(time.time() - build_start)} seconds')
+        return cls(fill_id=fill_columns.fill_id, n_humans=n_humans, containers=containers)
+
+    @classmethod
+    def from_db(cls, session, fill_id):
+        """from the human tables HumanikiDataInserter loaded"""
+        return cls.from_fill_columns(FillColumns.from_db(session, fill_id))
+
+    @staticmethod
+    def _make_value_containers(prop, owners, values, n_humans):
+        """one container per distinct value, of the (ascending) ordinals of the humans that have it"""
+        if len(values) == 0:
+            return {}
+        # stable, so the ordinals of each value stay ascending
+        value_order = np.argsort(values, kind='stable')
+        owners, values = owners[value_order], values[value_order]
+        boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+        return {(prop, _to_python(value_owners_values[0])): _make_container(value_owners, n_humans)
+                for value_owners, value_owners_values in zip(np.split(owners, boundaries),
+                                                             np.split(values, boundaries))}
+
+    def save(self, path):
+        arrays = {'fill_id': np.array(self.fill_id), 'n_humans': np.array(self.n_humans)}
+        for (key, value), container in self.containers.items():
+            kind = 'population' if isinstance(key, PopulationDefinition) else 'property'
+            arrays[f'{kind}:{key.value}:{value}'] = container
+        np.savez_compressed(path, **arrays)
+        log.info(f'Saved {len(self.containers)} bitmaps of fill {self.fill_id} to {path}')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            containers = {}
+            for name in arrays.files:
+                if ':' not in name:
+                    continue
+                kind, key, value = name.split(':', 2)
+                if kind == 'population':
+                    containers[(PopulationDefinition(int(key)), None)] = arrays[name]
+                else:
+                    prop = Properties(int(key))
+                    containers[(prop, value if prop == Properties.PROJECT else int(value))] = arrays[name]
+            return cls(fill_id=int(arrays['fill_id']), n_humans=int(arrays['n_humans']), containers=containers)
+
+    def _get(self, prop, values):
+        """the humans with any of values of prop"""
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        empty = np.array([], dtype=np.int32)
+        found = [self.containers.get((prop, value), empty) for value in values]
+        union = found[0] if found else empty
+        for container in found[1:]:
+            union = _union(union, container, self.n_humans)
+        return union
+
+    def select(self, filters, population_definition=PopulationDefinition.ALL_WIKIDATA):
+        """
+        :param filters: {Properties: a value, or a list of values any of which a human has to have}, sitelinks by
+        their code, like 'enwiki'
+        :return: the container of the humans of the population that pass every filter
+        """
+        selected = self.containers[(population_definition, None)]
+        # the smallest first, so that the intersections stay small
+        for container in sorted([self._get(prop, values) for prop, values in filters.items()], key=lambda container: container.nbytes):
+            selected = _intersect(selected, container)
+        return selected
+
+    def count(self, filters, population_definition=PopulationDefinition.ALL_WIKIDATA):
+        return _cardinality(self.select(filters, population_definition))
+
+    def count_by_bias(self, filters, population_definition=PopulationDefinition.ALL_WIKIDATA,
+                      bias_property=Properties.GENDER):
+        """{bias value: the number of humans with it that pass the filters}, without the bias values none pass"""
+        selected = self.select(filters, population_definition)
+        counts = {}
+        for (prop, value), container in self.containers.items():
+            if prop == bias_property:
+                total = _cardinality(_intersect(selected, container))
+                if total:
+                    counts[value] = total
+        return counts
+
+
+def _to_python(value):
+    return str(value) if isinstance(value, str) else int(value)
+
+
+def _is_bitmap(container):
+    return container.dtype == np.uint8
+
+
+def _pack(ordinals, n_humans):
+    bits = np.zeros(n_humans, dtype=bool)
+    bits[ordinals] = True
+    return np.packbits(bits)
+
+
+def _make_container(ordinals, n_humans):
+    """an int32 array of the ordinals is 4 bytes a human, a bitmap n_humans / 8 bytes"""
+    if len(ordinals) * 4 < (n_humans + 7) // 8:
+        return ordinals.astype(np.int32)
+    return _pack(ordinals, n_humans)
+
+
+def _to_bitmap(container, n_humans):
+    return container if _is_bitmap(container) else _pack(container, n_humans)
+
+
+def _bitmap_contains(bitmap, ordinals):
+    return ((bitmap[ordinals >> 3] >> (7 - (ordinals & 7))) & 1).astype(bool)
+
+
+def _intersect(a, b):
+    if _is_bitmap(a) and _is_bitmap(b):
+        return a & b
+    if _is_bitmap(a):
+        a, b = b, a
+    # a is an array
+    if _is_bitmap(b):
+        return a[_bitmap_contains(b, a)]
+    return np.intersect1d(a, b, assume_unique=True)
+
+
+def _union(a, b, n_humans):
+    if not _is_bitmap(a) and not _is_bitmap(b):
+        return np.union1d(a, b).astype(np.int32)
+    return _to_bitmap(a, n_humans) | _to_bitmap(b, n_humans)
+
+
+def _cardinality(container):
+    return int(_POPCOUNT[container].sum()) if _is_bitmap(container) else len(container)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build and save the bitmaps of a fill')
+    parser.add_argument('path')
+    parser.add_argument('dump_date', nargs='?', default=None)
+    args = parser.parse_args()
+    db_session = session_factory()
+    if args.dump_date is None:
+        fill_id, _ = get_latest_fill_id(db_session)
+    else:
+        fill_id, _ = get_exact_fill_id(db_session, make_dump_date_from_str(args.dump_date))
+    FillBitmaps.from_db(db_session, fill_id).save(args.path)
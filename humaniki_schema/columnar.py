@@ -0,0 +1,245 @@
+import time
+
+from sqlalchemy import and_
+from sqlalchemy.sql.operators import isnot
+
+from humaniki_schema.schema import human, human_sitelink, human_country, human_occupation
+from humaniki_schema.utils import Properties, PopulationDefinition
+from humaniki_schema.log import get_logger
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('For the columnar metric engine we need numpy')
+
+log = get_logger()
+
+# years of birth and death can legitimately be negative, so nulls get a sentinel far outside any real value
+NULL_VALUE = np.iinfo(np.int32).min
+
+
+class FillColumns():
+    """
+    One fill's human tables held in memory as numpy arrays, so that every metric combination can be grouped without
+    going back to MySQL.
+    Humans are addressed by a dense ordinal, their position in the sorted `qid` array. The multi-valued properties
+    (project, citizenship, occupation) are stored CSR-style: the values of human i are
+    values[offsets[i]:offsets[i+1]]. Sitelinks are dictionary encoded, their codes live in `sitelink_codes`.
+    Only humans with a gender are loaded, because every metric and coverage query filters on it.
+    """
+    SINGLE_VALUED = (Properties.DATE_OF_BIRTH, Properties.DATE_OF_DEATH)
+    MULTI_VALUED = (Properties.PROJECT, Properties.CITIZENSHIP, Properties.OCCUPATION)
+
+    def __init__(self, fill_id, qid, gender, year_of_birth, year_of_death, sitelink_count, multi_valued,
+                 sitelink_codes):
+        self.fill_id = fill_id
+        self.qid = qid
+        self.gender = gender
+        self.sitelink_count = sitelink_count
+        self.single_valued = {Properties.DATE_OF_BIRTH: year_of_birth,
+                              Properties.DATE_OF_DEATH: year_of_death}
+        # {Properties: (offsets, values)}
+        self.multi_valued = multi_valued
+        self.sitelink_codes = sitelink_codes
+
+    def __len__(self):
+        return len(self.qid)
+
+    @classmethod
+    def from_db(cls, session, fill_id, batch_size=500000):
+        load_start = time.time()
+        human_q = session.query(human.qid, human.gender, human.year_of_birth, human.year_of_death,
+                                human.sitelink_count) \
+            .filter(human.fill_id == fill_id) \
+            .filter(isnot(human.gender, None)) \
+            .order_by(human.qid)
+        qid, gender, year_of_birth, year_of_death, sitelink_count = _fetch_columns(
+            session, human_q, null_values=[None, None, NULL_VALUE, NULL_VALUE, 0], batch_size=batch_size)
+
+        multi_valued = {}
+        join_tables = {Properties.PROJECT: (human_sitelink, human_sitelink.sitelink),
+                       Properties.CITIZENSHIP: (human_country, human_country.country),
+                       Properties.OCCUPATION: (human_occupation, human_occupation.occupation)}
+        sitelink_codes = np.array([], dtype=object)
+        for prop, (join_table, value_col) in join_tables.items():
+            value_q = session.query(join_table.human_id, value_col) \
+                .filter(join_table.fill_id == fill_id) \
+                .order_by(join_table.human_id)
+            human_ids, values = _fetch_columns(session, value_q, null_values=[None, None], batch_size=batch_size,
+                                               dtypes=[np.int64, object if prop == Properties.PROJECT else np.int64])
+            if prop == Properties.PROJECT:
+                sitelink_codes, values = np.unique(values.astype(str), return_inverse=True)
+            multi_valued[prop] = _make_csr(qid, human_ids, values)
+
+        fill_columns = cls(fill_id=fill_id, qid=qid, gender=gender, year_of_birth=year_of_birth,
+                           year_of_death=year_of_death, sitelink_count=sitelink_count, multi_valued=multi_valued,
+                           sitelink_codes=sitelink_codes)
+        log.info(f'Loading fill {fill_id} columns ({len(fill_columns)} humans) took '
+                 f'{round(time.time() - load_start)} seconds')
+        return fill_columns
+
+    def population_mask(self, population_definition):
+        mask_map = {PopulationDefinition.ALL_WIKIDATA: lambda: np.ones(len(self), dtype=bool),
+                    PopulationDefinition.GTE_ONE_SITELINK: lambda: self.sitelink_count > 0}
+        return mask_map[population_definition]()
+
+    def has_property_mask(self, prop):
+        if prop in self.SINGLE_VALUED:
+            return self.single_valued[prop] != NULL_VALUE
+        else:
+            offsets, _ = self.multi_valued[prop]
+            return np.diff(offsets) > 0
+
+    def coverage(self, dimension_properties, population_definition):
+        """the number of humans that have all of the dimension properties, and the sum of their sitelinks"""
+        mask = self.population_mask(population_definition)
+        for prop in dimension_properties:
+            mask &= self.has_property_mask(prop)
+        return int(mask.sum()), int(self.sitelink_count[mask].sum())
+
+    def groupby(self, dimension_properties, population_definition, threshold=None, mask=None):
+        """
+        the in-memory equivalent of MetricCreator.make_agg_humans_query.
+        :param mask: only group the humans it is true for
+        :return: (keys, totals) where keys is a 2d array whose first column is the gender and the following columns
+        are the dimension values in the order of dimension_properties (sitelinks still as codes into sitelink_codes),
+        and totals is the count of humans for each row of keys.
+        """
+        population_mask = self.population_mask(population_definition)
+        rows = np.flatnonzero(population_mask & mask if mask is not None else population_mask)
+        dim_cols = []
+        for prop in dimension_properties:
+            if prop in self.SINGLE_VALUED:
+                values = self.single_valued[prop][rows]
+                keep = values != NULL_VALUE
+                rows = rows[keep]
+                dim_cols = [col[keep] for col in dim_cols]
+                dim_cols.append(values[keep])
+            else:
+                offsets, values = self.multi_valued[prop]
+                repeats, value_positions = _explode(offsets, rows)
+                rows = rows[repeats]
+                dim_cols = [col[repeats] for col in dim_cols]
+                dim_cols.append(values[value_positions])
+
+        key_cols = [self.gender[rows]] + dim_cols
+        keys = np.column_stack([col.astype(np.int64) for col in key_cols])
+        if len(keys) == 0:
+            return keys, np.array([], dtype=np.int64)
+        keys, totals = np.unique(keys, axis=0, return_counts=True)
+        if threshold:
+            above_threshold = totals >= threshold
+            keys, totals = keys[above_threshold], totals[above_threshold]
+        return keys, totals
+
+    def cells_mask(self, dimension_properties, keys):
+        """
+        the humans that can be in any of the cells keys, decoded like groupby's keys are: those with one of the keys'
+        genders and one of their values of each dimension. grouping just them gets those cells their full totals.
+        """
+        mask = np.isin(self.gender, [key[0] for key in keys])
+        for i, prop in enumerate(dimension_properties, start=1):
+            wanted = {key[i] for key in keys}
+            if prop == Properties.PROJECT:
+                wanted = np.flatnonzero(np.isin(self.sitelink_codes, list(wanted)))
+            else:
+                wanted = np.array(list(wanted))
+            if prop in self.SINGLE_VALUED:
+                mask &= np.isin(self.single_valued[prop], wanted)
+            else:
+                offsets, values = self.multi_valued[prop]
+                owners = np.repeat(np.arange(len(self)), np.diff(offsets))
+                has_wanted = np.zeros(len(self), dtype=bool)
+                has_wanted[owners[np.isin(values, wanted)]] = True
+                mask &= has_wanted
+        return mask
+
+    def changed_masks(self, previous):
+        """
+        diff against the columns of a previous fill, by qid and attribute tuple.
+        :return: (mask of self, mask of previous) of the humans that were added, removed, or have any attribute that
+        differs.
+        """
+        changed = np.ones(len(self), dtype=bool)
+        previous_changed = np.ones(len(previous), dtype=bool)
+        _, positions, previous_positions = np.intersect1d(self.qid, previous.qid, assume_unique=True,
+                                                          return_indices=True)
+        same = (self.gender[positions] == previous.gender[previous_positions]) & \
+               (self.sitelink_count[positions] == previous.sitelink_count[previous_positions])
+        for prop in self.SINGLE_VALUED:
+            same &= self.single_valued[prop][positions] == previous.single_valued[prop][previous_positions]
+        for prop in self.MULTI_VALUED:
+            same &= self._same_multi_values(prop, positions, previous, previous_positions)
+        changed[positions[same]] = False
+        previous_changed[previous_positions[same]] = False
+        log.info(f'Fill {self.fill_id} has {int(changed.sum())} humans added or changed since fill {previous.fill_id}, '
+                 f'and {int(previous_changed.sum())} changed or removed')
+        return changed, previous_changed
+
+    def _same_multi_values(self, prop, positions, previous, previous_positions):
+        offsets, values = self.multi_valued[prop]
+        previous_offsets, previous_values = previous.multi_valued[prop]
+        same = np.diff(offsets)[positions] == np.diff(previous_offsets)[previous_positions]
+        # the values of each human are sorted, so humans with as many values in both fills compare position by position
+        rows = np.flatnonzero(same)
+        repeats, value_positions = _explode(offsets, positions[rows])
+        _, previous_value_positions = _explode(previous_offsets, previous_positions[rows])
+        if prop == Properties.PROJECT:
+            # each fill has its own sitelink codes
+            mismatch = self.sitelink_codes[values[value_positions]] != \
+                       previous.sitelink_codes[previous_values[previous_value_positions]]
+        else:
+            mismatch = values[value_positions] != previous_values[previous_value_positions]
+        same[rows[np.unique(repeats[mismatch])]] = False
+        return same
+
+    def decode(self, prop, value):
+        """turn an array value back into what the SQL engine would have grouped on"""
+        if prop == Properties.PROJECT:
+            return str(self.sitelink_codes[value])
+        else:
+            return int(value)
+
+
+def _fetch_columns(session, query, null_values, batch_size, dtypes=None):
+    """stream a query into one numpy array per selected column, replacing None with the per-column null_value"""
+    dtypes = dtypes if dtypes else [np.int64] * len(null_values)
+    result = session.execute(query.statement.execution_options(stream_results=True))
+    batches = [[] for _ in null_values]
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for i, col in enumerate(zip(*rows)):
+            null_value = null_values[i]
+            if null_value is not None:
+                col = [null_value if v is None else v for v in col]
+            batches[i].append(np.array(col, dtype=dtypes[i]))
+    return [np.concatenate(batch) if batch else np.array([], dtype=dtypes[i]) for i, batch in enumerate(batches)]
+
+
+def _make_csr(qid, human_ids, values):
+    """human_ids are sorted, so their values can be kept in order and indexed by per-human offsets"""
+    ordinals = np.searchsorted(qid, human_ids)
+    ordinals_clipped = np.minimum(ordinals, len(qid) - 1) if len(qid) else ordinals
+    known_human = (qid[ordinals_clipped] == human_ids) if len(qid) else np.zeros(len(human_ids), dtype=bool)
+    ordinals, values = ordinals[known_human], values[known_human]
+    # sort each human's values, so that they can be compared between fills
+    value_order = np.lexsort((values, ordinals))
+    ordinals, values = ordinals[value_order], values[value_order]
+    counts = np.bincount(ordinals, minlength=len(qid))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return offsets, values
+
+
+def _explode(offsets, rows):
+    """
+    the in-memory equivalent of a join: each row is repeated once per value its human has.
+    :return: (repeats, value_positions) indices into rows, and into the CSR values array.
+    """
+    starts = offsets[rows]
+    lens = offsets[rows + 1] - starts
+    repeats = np.repeat(np.arange(len(rows)), lens)
+    within = np.arange(len(repeats)) - np.repeat(np.cumsum(lens) - lens, lens)
+    value_positions = starts[repeats] + within
+    return repeats, value_positions
@@ -2,11 +2,13 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import os
 
-engine = create_engine("mysql://{user}:{password}@{host}/{database}?charset=utf8".format(
+db_url = "mysql://{user}:{password}@{host}/{database}?charset=utf8".format(
     host=os.environ['HUMANIKI_MYSQL_HOST'],
     user=os.environ['HUMANIKI_MYSQL_USER'],
     password=os.environ['HUMANIKI_MYSQL_PASS'],
-    database=os.environ['HUMANIKI_MYSQL_DB']),
+    database=os.environ['HUMANIKI_MYSQL_DB'])
+
+engine = create_engine(db_url,
     pool_size=10,
     max_overflow=20,
     pool_recycle=3600,
@@ -15,3 +17,19 @@ engine = create_engine("mysql://{user}:{password}@{host}/{database}?charset=utf8
 
 # Base.metadata.bind = db_engine
 session_factory = sessionmaker(bind=engine)
+
+# connections that may LOAD DATA LOCAL INFILE, for streaming files from this host. the server has to allow it too
+# (local_infile=ON)
+local_infile_engine = create_engine(db_url,
+    connect_args={'local_infile': 1},
+    pool_size=4,
+    max_overflow=4,
+    pool_recycle=3600,
+    pool_pre_ping=True
+)
+local_infile_session_factory = sessionmaker(bind=local_infile_engine)
+
+
+def pinned_session_factory():
+    """a session that keeps one connection for its whole life, so session scoped temporary tables survive commits"""
+    return session_factory(bind=engine.connect())
@@ -10,7 +10,7 @@ log = get_logger()
 # the tables that store full copies of the base data each week. the metrics never refer back to them.
 # I used to think i wanted to keep these full copies to look at interesting moments when something happened, but space is more important
 # I also made the mistake of not partitioning these tables on the fill_id, so
-DELETABLE_TABLES = ['human_sitelink', 'human', 'human_country', 'human_occupation']
+DELETABLE_TABLES = ['human_sitelink', 'human', 'human_country', 'human_occupation', 'human_fact']
 
 
 def delete_single_fill(db_session, fill_id):
@@ -0,0 +1,143 @@
+import os
+import time
+
+import pandas as pd
+
+from humaniki_schema.schema import human, human_sitelink, human_country, human_occupation
+from humaniki_schema.utils import Properties, PopulationDefinition
+from humaniki_schema.log import get_logger
+
+try:
+    import duckdb
+except ImportError:
+    raise ImportError('For the duckdb metric engine we need duckdb')
+
+log = get_logger()
+
+
+class FillDuck():
+    """
+    One fill's human tables copied into a local DuckDB file, so that the metric group bys run on DuckDB's parallel
+    executor instead of the MySQL that serves the backend. Only the finished metric rows go back to MySQL, see
+    generate_metrics.DuckMetricCreator.
+    The file is written once, by export, and then opened read only, so that several worker processes can share it.
+    Like FillColumns, only humans with a gender are copied.
+    """
+    # {table: (the MySQL table, its copied columns, the DuckDB column types)}
+    TABLES = {'human': (human, ['qid', 'gender', 'year_of_birth', 'year_of_death', 'sitelink_count'],
+                        ['INTEGER', 'INTEGER', 'SMALLINT', 'SMALLINT', 'SMALLINT']),
+              'human_sitelink': (human_sitelink, ['human_id', 'sitelink'], ['INTEGER', 'VARCHAR']),
+              'human_country': (human_country, ['human_id', 'country'], ['INTEGER', 'INTEGER']),
+              'human_occupation': (human_occupation, ['human_id', 'occupation'], ['INTEGER', 'INTEGER'])}
+    # {Properties: (the table to join, or None for a column of human, the value column)}
+    DIMENSION_COLUMNS = {Properties.PROJECT: ('human_sitelink', 'sitelink'),
+                         Properties.CITIZENSHIP: ('human_country', 'country'),
+                         Properties.OCCUPATION: ('human_occupation', 'occupation'),
+                         Properties.DATE_OF_BIRTH: (None, 'year_of_birth'),
+                         Properties.DATE_OF_DEATH: (None, 'year_of_death')}
+    POPULATION_FILTERS = {PopulationDefinition.ALL_WIKIDATA: None,
+                          PopulationDefinition.GTE_ONE_SITELINK: 'h.sitelink_count > 0'}
+
+    def __init__(self, fill_id, connection):
+        self.fill_id = fill_id
+        self.connection = connection
+
+    @classmethod
+    def create_tables(cls, connection):
+        for table_name, (_, columns, column_types) in cls.TABLES.items():
+            column_defs = ', '.join(f'{col} {col_type}' for col, col_type in zip(columns, column_types))
+            connection.execute(f'CREATE TABLE {table_name} ({column_defs})')
+        connection.execute('CREATE TABLE fill_info (fill_id INTEGER)')
+
+    @classmethod
+    def export(cls, session, fill_id, path, batch_size=500000):
+        """(over)write the DuckDB file at path with the fill's human tables"""
+        export_start = time.time()
+        tmp_path = f'{path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = duckdb.connect(tmp_path)
+        try:
+            cls.create_tables(connection)
+            for table_name, (table, columns, _) in cls.TABLES.items():
+                table_q = session.query(*[getattr(table, col) for col in columns]).filter(table.fill_id == fill_id)
+                if table is human:
+                    table_q = table_q.filter(human.gender.isnot(None))
+                rowcount = _copy_query(session, table_q, connection, table_name, columns, batch_size)
+                log.info(f'Exported {rowcount} rows of {table_name} for fill {fill_id}')
+            connection.execute('INSERT INTO fill_info VALUES (?)', [fill_id])
+        finally:
+            connection.close()
+        # only a complete export gets the name other processes open
+        os.replace(tmp_path, path)
+        log.info(f'Exporting fill {fill_id} to {path} took {round(time.time() - export_start)} seconds')
+
+    @classmethod
+    def open(cls, fill_id, path):
+        connection = duckdb.connect(path, read_only=True)
+        exported_fill_id = connection.execute('SELECT fill_id FROM fill_info').fetchone()[0]
+        if exported_fill_id != fill_id:
+            connection.close()
+            raise ValueError(f'{path} has fill {exported_fill_id}, not fill {fill_id}')
+        return cls(fill_id=fill_id, connection=connection)
+
+    def _make_humans_with_properties_sql(self, dimension_properties, population_definition):
+        """:return: (the dimension value expressions, the FROM and WHERE of humans with all of the properties)"""
+        value_exprs, joins, filters = [], [], ['h.gender IS NOT NULL']
+        for i, prop in enumerate(dimension_properties):
+            join_table, value_col = self.DIMENSION_COLUMNS[prop]
+            if join_table is None:
+                value_exprs.append(f'h.{value_col}')
+                filters.append(f'h.{value_col} IS NOT NULL')
+            else:
+                joins.append(f'JOIN {join_table} d{i} ON d{i}.human_id = h.qid')
+                value_exprs.append(f'd{i}.{value_col}')
+        population_filter = self.POPULATION_FILTERS[population_definition]
+        if population_filter is not None:
+            filters.append(population_filter)
+        from_where = f"FROM human h {' '.join(joins)} WHERE {' AND '.join(filters)}"
+        return value_exprs, from_where
+
+    def groupby(self, dimension_properties, population_definition, threshold=None):
+        """
+        the DuckDB equivalent of MetricCreator.make_agg_humans_query.
+        :return: [(gender, dimension values..., total)] with the values as the SQL engine groups them
+        """
+        value_exprs, from_where = self._make_humans_with_properties_sql(dimension_properties, population_definition)
+        group_bys = ', '.join(['h.gender'] + value_exprs)
+        groupby_sql = f'SELECT {group_bys}, count(*) AS total {from_where} GROUP BY {group_bys}'
+        if threshold:
+            groupby_sql += f' HAVING count(*) >= {int(threshold)}'
+        return self.connection.execute(groupby_sql).fetchall()
+
+    def coverage(self, dimension_properties, population_definition):
+        """the number of humans that have all of the dimension properties, and the sum of their sitelinks"""
+        _, from_where = self._make_humans_with_properties_sql(dimension_properties, population_definition)
+        coverage_sql = f'SELECT count(*), coalesce(sum(sitelink_count), 0) FROM ' \
+                       f'(SELECT DISTINCT h.qid, h.sitelink_count {from_where}) items_with'
+        total_with_properties, total_sitelinks_with_properties = self.connection.execute(coverage_sql).fetchone()
+        return int(total_with_properties), int(total_sitelinks_with_properties)
+
+    def close(self):
+        self.connection.close()
+
+
+def _copy_query(session, query, connection, table_name, columns, batch_size):
+    """stream a MySQL query into a DuckDB table, a batch at a time"""
+    result = session.execute(query.statement.execution_options(stream_results=True))
+    rowcount = 0
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        _insert_batch(connection, table_name, columns, rows)
+        rowcount += len(rows)
+    return rowcount
+
+
+def _insert_batch(connection, table_name, columns, rows):
+    """insert rows into a DuckDB table through a registered DataFrame, rather than a statement per row"""
+    batch = pd.DataFrame([tuple(row) for row in rows], columns=columns)
+    connection.register('batch', batch)
+    connection.execute(f'INSERT INTO {table_name} SELECT * FROM batch')
+    connection.unregister('batch')
@@ -1,26 +1,37 @@
+import argparse
 import datetime
 import gc
+import math
+import operator
+import multiprocessing
 import os
 import sys
 import time
+from functools import reduce
 from itertools import combinations, product
 
+import numpy as np
 import sqlalchemy
 
-from sqlalchemy import func, and_, literal, text, case
+from sqlalchemy import func, and_, or_, literal, literal_column, text, case, exists
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.sql.expression import not_
 from sqlalchemy.sql.functions import count
 from sqlalchemy.sql.operators import isnot
 
+from humaniki_schema.columnar import FillColumns
 from humaniki_schema.queries import get_latest_fill_id, get_properties_obj, NoSuchWikiError, \
-    get_exact_fill_id, count_table_metrics, count_table_metric_aggregations_j, count_table_metric_aggregations_n
-from humaniki_schema.db import session_factory
+    get_exact_fill_id, update_fill_detail, get_previous_active_fill_id, \
+    get_project_wikiencoding_from_id, make_human_fact_source, get_fill_by_id, create_temporary_table, aggregations_hash_expr, register_aggregations, \
+    bulk_insert_ignore, make_qid_sample_filter, create_new_fill, deactivate_preview_fills
+from humaniki_schema.db import session_factory, pinned_session_factory, engine as db_engine
 from humaniki_schema.schema import human, human_sitelink, human_country, human_occupation, metric, job, metric_coverage, \
-    metric_aggregations_j, metric_aggregations_n, project
+    metric_aggregations_j, metric_aggregations_n, metric_aggregations_wide, METRIC_AGGREGATIONS_WIDE_DIMENSIONS, project
 from humaniki_schema.utils import Properties, PopulationDefinition, get_enum_from_str, read_config_file, \
-    make_dump_date_from_str, JobType, JobState
+    make_dump_date_from_str, JobType, JobState, FillType, COVERAGE_PROPERTIES, property_mask, coverage_from_property_masks, \
+    threshold_for_row_budget
 from humaniki_schema.log import get_logger
 
 log = get_logger()
@@ -36,19 +47,76 @@ class MetricFactory():
     - creating the aggregation_id and property_id tables first if necessary, or cacheing them in memory for fast access
     """
 
-    def __init__(self, config, db_session=None, fill_date=None):
+    def __init__(self, config, db_session=None, fill_date=None, fill_dates=None, fill_type=FillType.DUMP):
+        """
+        :param fill_dates: several fills to create and execute the jobs of together, e.g. for a backfill. each
+        combination's jobs then form a fill group, whose jobs are all run by one scan of the human tables.
+        :param fill_type: FillType.PREVIEW to execute the jobs of the dump's preview fill, see preview
+        """
+        self.config_file = config
         self.config = read_config_file(config, __file__)
         self.config_generation = self.config['generation']
         self.db_session = db_session if db_session else session_factory()
+        self.fill_type = fill_type
         if fill_date is None:
-            self.curr_fill, self.curr_fill_date = get_latest_fill_id(self.db_session)
+            self.curr_fill, self.curr_fill_date = get_latest_fill_id(self.db_session, fill_type)
         else:
-            fill_dt = make_dump_date_from_str(fill_date)
-            self.curr_fill, self.curr_fill_date = get_exact_fill_id(self.db_session, fill_dt)
+            fill_dt = make_dump_date_from_str(fill_date) if isinstance(fill_date, str) else fill_date
+            self.curr_fill, self.curr_fill_date = get_exact_fill_id(self.db_session, fill_dt, fill_type=fill_type)
+        self.fill_dates = fill_dates
+        self.fill_group = None  # the ids of fill_dates, and the group's leader fill as curr_fill
+        if fill_dates:
+            fills = sorted(get_exact_fill_id(self.db_session, make_dump_date_from_str(d) if isinstance(d, str) else d)
+                           for d in fill_dates)
+            self.fill_group = [fill_id for fill_id, _ in fills]
+            self.fill_group_dates = [fill_dt for _, fill_dt in fills]
+            self.curr_fill, self.curr_fill_date = fills[0]
         self.metric_combinations = None
+        self.dimension_cardinalities = None
         self.metric_creator = None
+        self.creator_session = None  # the session the metric creator runs on, closed once its job has run
         self.metric_job = None
+        self.lattice_jobs = []  # the jobs rolled up from self.metric_job, if it is a lattice root
+        self.population_jobs = []  # the jobs of self.metric_job's other populations, if it leads a population group
+        self.fill_group_jobs = []  # the jobs of self.metric_job's combination in the other fills of its fill group
+        self.execute_strategy = self.config_generation.get('execute_strategy', 'sequential')
+        if self.fill_type == FillType.PREVIEW:
+            # a preview fill has no humans of its own to load, its jobs sample the human tables of the previewed fill
+            self.execute_strategy = 'sequential'
+        self.materialize_grouped = self.config_generation.get('materialize_grouped', False)
+        self.use_human_fact = self.config_generation.get('use_human_fact', False)
+        self.prune_from_len = self.config_generation.get('combination', {}).get('prune_from_len')
+        self.fill_coverage = self.config_generation.get('fill_coverage', False)
+        self.fill_columns = {}  # fill_id: FillColumns, only used by the columnar and incremental strategies
+        self.fill_ducks = {}  # fill_id: FillDuck, only used by the duckdb strategy
+        self.duckdb_dir = self.config_generation.get('duckdb_dir', '/tmp')
+        self.changed_masks = {}  # (fill_id, previous_fill_id): FillColumns.changed_masks, only used by incremental
+        self.previous_fill = get_previous_active_fill_id(self.db_session, self.curr_fill_date)[0] \
+            if self.execute_strategy == 'incremental' else None
         self.pid = os.getpid()
+        self._check_generation_options()
+
+    def _check_generation_options(self):
+        """
+        reject the options that each run a job's scan their own way, and so can't be combined:
+        - a fill group (fill_dates) scans the human tables of every fill, so not a lattice root's, a population
+          group's, a materialized join, pruned parent cells or human_fact
+        - a lattice root and a population group both choose which jobs share a scan
+        """
+        combination_config = self.config_generation.get('combination', {})
+        lattice_rollup = combination_config.get('lattice_rollup', False)
+        merge_populations = combination_config.get('merge_populations', False)
+        if self.fill_group:
+            fill_group_conflicts = {'lattice_rollup': lattice_rollup,
+                                    'merge_populations': merge_populations,
+                                    'prune_from_len': self.prune_from_len is not None,
+                                    'materialize_grouped': self.materialize_grouped,
+                                    'use_human_fact': self.use_human_fact}
+            conflicting = [option for option, is_set in fill_group_conflicts.items() if is_set]
+            if conflicting:
+                raise ValueError(f"fill_dates can't be combined with {', '.join(conflicting)}")
+        if lattice_rollup and merge_populations:
+            raise ValueError("lattice_rollup can't be combined with merge_populations")
 
 
     def _get_threshold(self, dimension_combination_len):
@@ -58,6 +126,13 @@ class MetricFactory():
             # excepting both either threshold are not present in config at all or not for this length
             return None
 
+    def _get_row_budget(self, dimension_combination_len):
+        """the most metric rows a combination of this length may write, its threshold is then chosen to fit"""
+        try:
+            return self.config_generation['combination']['row_budget'][dimension_combination_len]
+        except KeyError:
+            return None
+
     def _generate_metric_combinations(self):
         try:
             combination_config = self.config_generation['combination']
@@ -90,29 +165,125 @@ class MetricFactory():
         dim_pop_combs = [{"dimensions": dim_tuple,
                           "population_definition": pop_defn,
                           'threshold': self._get_threshold(len(dim_tuple)),
+                          'row_budget': self._get_row_budget(len(dim_tuple)),
                           "bias": bias_prop} for (dim_tuple, pop_defn) in dim_pop_combs_res]
 
         num_dim_combs = len(dimension_combinations)
         num_pop_defns = len(all_pop_defns)
         log.info(f'PID:{self.pid} {len(dim_pop_combs)}==?{num_dim_combs} * {num_pop_defns}')
+        if self.config_generation.get('combination', {}).get('lattice_rollup', False):
+            self._plan_metric_lattice(dim_pop_combs)
+        elif self.config_generation.get('combination', {}).get('merge_populations', False):
+            # every population of a combination comes from one scan, run by the job of the first population
+            for metric_combination in dim_pop_combs:
+                metric_combination['population_group'] = [pop_defn.value for pop_defn in all_pop_defns]
         self.metric_combinations = dim_pop_combs
 
-    def _get_metric_comb_as_job(self, metric_combination):
+    def _plan_metric_lattice(self, metric_combinations):
+        """
+        assign every combination a lattice root: the first largest combination of the same population whose
+        dimensions contain its own. a root is computed from one scan of the human tables, and the combinations it
+        contains are rolled up from that scan (see MetricLattice) instead of each rescanning the human tables.
+        """
+        roots = []
+        for metric_combination in sorted(metric_combinations, key=lambda mc: len(mc['dimensions']), reverse=True):
+            root = next((r for r in roots if r['population_definition'] == metric_combination['population_definition']
+                         and set(metric_combination['dimensions']) <= set(r['dimensions'])), None)
+            if root is None:
+                roots.append(metric_combination)
+                root = metric_combination
+            metric_combination['lattice_root'] = root['dimensions']
+        log.info(f'PID:{self.pid} {len(metric_combinations)} combinations planned onto {len(roots)} lattice roots')
+
+    def _make_metric_comb_jobs_query(self, metric_combination):
+        """the jobs of the metric combination, of any fill"""
         job_query = self.db_session.query(job).filter(
             and_(job.job_type == JobType.METRIC_CREATE.value,
                  job.detail["population_definition"] == metric_combination["population_definition"].value,
                  job.detail["bias_property"] == metric_combination["bias"].value,
                  job.detail["dimension_properties_len"] == len(metric_combination["dimensions"]),
-                 job.fill_id == self.curr_fill,
                  ))
 
         for i, dimension_property in enumerate(metric_combination["dimensions"]):
             job_query = job_query.filter(
                 job.detail["dimension_properties"][i] == metric_combination["dimensions"][i].value)
+        return job_query
 
-        job_or_none = job_query.one_or_none()
+    def _get_metric_comb_as_job(self, metric_combination):
+        job_or_none = self._make_metric_comb_jobs_query(metric_combination) \
+            .filter(job.fill_id == self.curr_fill) \
+            .one_or_none()
         return job_or_none
 
+    def _get_previous_duration(self, metric_combination):
+        """the seconds the combination's steps took the last time it completed, in an earlier fill"""
+        previous_job = self._make_metric_comb_jobs_query(metric_combination) \
+            .filter(job.fill_id < self.curr_fill) \
+            .filter(job.job_state == JobState.COMPLETE.value) \
+            .order_by(job.fill_id.desc()) \
+            .first()
+        if previous_job is None or not previous_job.detail.get('counters'):
+            return None
+        return sum(counter['seconds'] for counter in previous_job.detail['counters'].values())
+
+    def _get_dimension_cardinalities(self):
+        """
+        {Properties: the number of distinct values the dimension has in this fill}, from the fill's stats if insertion
+        collected them
+        """
+        if self.dimension_cardinalities is None:
+            fill_stats = get_fill_by_id(self.db_session, self.curr_fill).detail.get('stats')
+            if fill_stats:
+                self.dimension_cardinalities = {Properties[prop_name.upper()]: cardinality
+                                                for prop_name, cardinality in fill_stats['distinct'].items()}
+                return self.dimension_cardinalities
+            value_cols = {Properties.PROJECT: (human_sitelink.sitelink, human_sitelink.fill_id),
+                          Properties.CITIZENSHIP: (human_country.country, human_country.fill_id),
+                          Properties.OCCUPATION: (human_occupation.occupation, human_occupation.fill_id),
+                          Properties.DATE_OF_BIRTH: (human.year_of_birth, human.fill_id),
+                          Properties.DATE_OF_DEATH: (human.year_of_death, human.fill_id)}
+            dimensions = {dim for mc in self.metric_combinations for dim in mc['dimensions']}
+            self.dimension_cardinalities = {}
+            for dim in dimensions:
+                value_col, fill_id_col = value_cols[dim]
+                self.dimension_cardinalities[dim] = self.db_session.query(func.count(func.distinct(value_col))) \
+                    .filter(fill_id_col == self.curr_fill).scalar()
+            log.info(f'PID:{self.pid} Dimension cardinalities: {self.dimension_cardinalities}')
+        return self.dimension_cardinalities
+
+    def _estimate_metric_combination_costs(self):
+        """
+        set every combination's 'estimated_cost', so that workers can claim the longest jobs first.
+        the cost is the combination's duration in the previous fill. combinations without one get the product of their
+        dimensions' cardinalities (their worst case number of aggregations), converted to seconds with the median
+        seconds per aggregation of the combinations that do have one.
+        a lattice root or population group leader is run together with its members, so its cost includes theirs.
+        """
+        cardinalities = self._get_dimension_cardinalities()
+        seconds_per_aggregation = []
+        for metric_combination in self.metric_combinations:
+            metric_combination['max_aggregations'] = int(np.prod([cardinalities[dim] for dim in
+                                                                  metric_combination['dimensions']]))
+            metric_combination['previous_duration'] = self._get_previous_duration(metric_combination)
+            if metric_combination['previous_duration'] is not None:
+                seconds_per_aggregation.append(metric_combination['previous_duration'] /
+                                               max(metric_combination['max_aggregations'], 1))
+        rate = float(np.median(seconds_per_aggregation)) if seconds_per_aggregation else 1
+
+        for metric_combination in self.metric_combinations:
+            previous_duration = metric_combination['previous_duration']
+            metric_combination['estimated_cost'] = previous_duration if previous_duration is not None else \
+                rate * metric_combination['max_aggregations']
+
+        for root in self.metric_combinations:
+            if root.get('lattice_root') == root['dimensions']:
+                root['estimated_cost'] = sum(mc['estimated_cost'] for mc in self.metric_combinations
+                                             if mc['population_definition'] == root['population_definition']
+                                             and mc.get('lattice_root') == root['dimensions'])
+            elif root.get('population_group') and root['population_definition'].value == root['population_group'][0]:
+                root['estimated_cost'] = sum(mc['estimated_cost'] for mc in self.metric_combinations
+                                             if mc['dimensions'] == root['dimensions'])
+
     def _persist_metric_combination_as_job(self, metric_combination):
         properties_obj = get_properties_obj(bias_property=metric_combination['bias'].value,
                            dimension_properties=[d.value for d in metric_combination["dimensions"]],
@@ -127,7 +298,14 @@ class MetricFactory():
                              "dimension_properties": [d.value for d in metric_combination["dimensions"]],
                              "dimension_properties_len": len(metric_combination["dimensions"]),
                              "threshold": metric_combination['threshold'],
+                             "row_budget": metric_combination.get('row_budget'),
                              "properties_id": properties_obj.id,
+                             "lattice_root": [d.value for d in metric_combination['lattice_root']]
+                             if 'lattice_root' in metric_combination else None,
+                             "population_group": metric_combination.get('population_group'),
+                             "estimated_cost": metric_combination.get('estimated_cost'),
+                             "fill_group": self.fill_group,
+                             "preview": metric_combination.get('preview'),
                              })
         self.db_session.add(mc_job)
         self.db_session.commit()
@@ -136,6 +314,7 @@ class MetricFactory():
         """
         idempotently, store self.metric_combinations in the jobs table
         """
+        self._estimate_metric_combination_costs()
         # for each metrics_combination, attempt to get it's job row, if no exist--create.
         for metric_combination in self.metric_combinations:
             job_or_none = self._get_metric_comb_as_job(metric_combination)
@@ -156,25 +335,290 @@ class MetricFactory():
                                   JobState.NEEDS_RETRY.value)
         uncompleted_jobs_q = self.db_session.query(job).filter(and_(
             job.job_type == JobType.METRIC_CREATE.value,
-            job.job_state.in_(uncompleted_job_states)
+            job.job_state.in_(uncompleted_job_states),
+            job.fill_id == self.curr_fill
         ))
+        log.info(f'PID:{self.pid} There are {uncompleted_jobs_q.count()} uncompleted jobs')
+
+        # jobs that are rolled up from a lattice root get run by whoever claims the root, and the jobs of a
+        # population group by whoever claims the group's first population.
+        # the columnar, incremental and duckdb strategies have the whole fill at hand anyway, so they run every job on
+        # its own
+        if self.execute_strategy == 'sequential':
+            lattice_root = func.JSON_EXTRACT(job.detail, '$.lattice_root')
+            uncompleted_jobs_q = uncompleted_jobs_q.filter(or_(
+                func.COALESCE(func.JSON_TYPE(lattice_root), 'NULL') == 'NULL',
+                lattice_root == func.JSON_EXTRACT(job.detail, '$.dimension_properties')))
+            population_group = func.JSON_EXTRACT(job.detail, '$.population_group')
+            uncompleted_jobs_q = uncompleted_jobs_q.filter(or_(
+                func.COALESCE(func.JSON_TYPE(population_group), 'NULL') == 'NULL',
+                func.JSON_EXTRACT(job.detail, '$.population_group[0]') ==
+                func.JSON_EXTRACT(job.detail, '$.population_definition')))
+            fill_group = func.JSON_EXTRACT(job.detail, '$.fill_group')
+            uncompleted_jobs_q = uncompleted_jobs_q.filter(or_(
+                func.COALESCE(func.JSON_TYPE(fill_group), 'NULL') == 'NULL',
+                func.JSON_EXTRACT(job.detail, '$.fill_group[0]') == job.fill_id))
+
+        # longest first, so that the run doesn't end with one long job and idle workers.
+        # with pruning, fewer dimensions first though, so that the parents of a combination are there to prune it
+        order_bys = [func.JSON_EXTRACT(job.detail, '$.estimated_cost').desc(), job.id]
+        if self.prune_from_len is not None:
+            order_bys.insert(0, job.detail['dimension_properties_len'])
+        self.metric_job = self._claim_metric_job(uncompleted_jobs_q, order_bys, uncompleted_job_states)
+        self.lattice_jobs = self._get_lattice_jobs() if self.metric_job is not None and \
+                                                       self.execute_strategy == 'sequential' else []
+        self.population_jobs = self._get_population_jobs() if self.metric_job is not None and \
+                                                             self.execute_strategy == 'sequential' else []
+        self.fill_group_jobs = self._get_fill_group_jobs() if self.metric_job is not None and \
+                                                             self.execute_strategy == 'sequential' else []
+
+    def _claim_metric_job(self, uncompleted_jobs_q, order_bys, uncompleted_job_states, candidates=10):
+        """
+        claim the first of the uncompleted jobs that no other worker claims first. the candidates are read without
+        locks, and each is claimed by a primary key update that only succeeds while it is still uncompleted, and
+        that is committed straight away. so no lock is held while sorting, or while the job's creator is set up.
+        """
+        while True:
+            candidate_ids = [job_id for job_id, in uncompleted_jobs_q.with_entities(job.id)
+                             .order_by(*order_bys)
+                             .limit(candidates)
+                             .all()]
+            self.db_session.commit()
+            if not candidate_ids:
+                return None
+            for candidate_id in candidate_ids:
+                claimed = self.db_session.query(job) \
+                    .filter(job.id == candidate_id) \
+                    .filter(job.job_state.in_(uncompleted_job_states)) \
+                    .update({job.job_state: JobState.IN_PROGRESS.value}, synchronize_session=False)
+                self.db_session.commit()
+                if claimed == 1:
+                    return self.db_session.query(job).get(candidate_id)
+                log.info(f'PID:{self.pid} Job {candidate_id} was claimed by another worker')
+
+    @staticmethod
+    def _is_lattice_root(a_job):
+        lattice_root = a_job.detail.get('lattice_root')
+        return lattice_root is None or lattice_root == a_job.detail['dimension_properties']
+
+    def _get_lattice_jobs(self):
+        """the unfinished jobs whose lattice root is self.metric_job"""
+        if self.metric_job.detail.get('lattice_root') is None:
+            return []
+        unfinished_job_states = (JobState.UNATTEMPTED.value,
+                                 JobState.NEEDS_RETRY.value,
+                                 JobState.IN_PROGRESS.value)
+        candidate_jobs = self.db_session.query(job).filter(and_(
+            job.job_type == JobType.METRIC_CREATE.value,
+            job.job_state.in_(unfinished_job_states),
+            job.fill_id == self.metric_job.fill_id,
+            job.id != self.metric_job.id,
+            job.detail["population_definition"] == self.metric_job.detail["population_definition"],
+        )).all()
+        return [j for j in candidate_jobs if not self._is_lattice_root(j)
+                and j.detail['lattice_root'] == self.metric_job.detail['lattice_root']]
+
+    def _get_population_jobs(self):
+        """the unfinished jobs of self.metric_job's combination in the other populations of its population group"""
+        population_group = self.metric_job.detail.get('population_group')
+        if not population_group or population_group[0] != self.metric_job.detail['population_definition']:
+            return []
+        unfinished_job_states = (JobState.UNATTEMPTED.value,
+                                 JobState.NEEDS_RETRY.value,
+                                 JobState.IN_PROGRESS.value)
+        candidate_jobs = self.db_session.query(job).filter(and_(
+            job.job_type == JobType.METRIC_CREATE.value,
+            job.job_state.in_(unfinished_job_states),
+            job.fill_id == self.metric_job.fill_id,
+            job.id != self.metric_job.id,
+            job.detail["properties_id"] == self.metric_job.detail["properties_id"],
+        )).all()
+        return [j for j in candidate_jobs if j.detail.get('population_group') == population_group
+                and j.detail['population_definition'] in population_group]
+
+    def _get_fill_group_jobs(self):
+        """the unfinished jobs of self.metric_job's combination in the other fills of its fill group"""
+        fill_group = self.metric_job.detail.get('fill_group')
+        if not fill_group or fill_group[0] != self.metric_job.fill_id:
+            return []
+        unfinished_job_states = (JobState.UNATTEMPTED.value,
+                                 JobState.NEEDS_RETRY.value,
+                                 JobState.IN_PROGRESS.value)
+        return self.db_session.query(job).filter(and_(
+            job.job_type == JobType.METRIC_CREATE.value,
+            job.job_state.in_(unfinished_job_states),
+            job.fill_id.in_(fill_group[1:]),
+            job.detail["properties_id"] == self.metric_job.detail["properties_id"],
+            job.detail["population_definition"] == self.metric_job.detail["population_definition"],
+        )).all()
+
+    def _get_companion_jobs(self):
+        """the jobs that are run together with self.metric_job"""
+        return self.lattice_jobs + self.population_jobs + self.fill_group_jobs
+
+    def _get_fill_columns(self, fill_id):
+        """load a fill's human tables into memory once, and share them between all of its jobs"""
+        if fill_id not in self.fill_columns:
+            self.fill_columns[fill_id] = FillColumns.from_db(self.db_session, fill_id)
+        return self.fill_columns[fill_id]
+
+    def _get_duckdb_path(self, fill_id):
+        return os.path.join(self.duckdb_dir, f'humaniki_fill_{fill_id}.duckdb')
+
+    def export_fill_duck(self, fill_id):
+        """copy the fill's human tables into its DuckDB file, once per fill before its jobs are executed"""
+        from humaniki_schema.duck import FillDuck  # duckdb is only needed for this strategy
+        FillDuck.export(self.db_session, fill_id, self._get_duckdb_path(fill_id))
+
+    def _get_fill_duck(self, fill_id):
+        """open a fill's DuckDB file once, exporting it if create didn't, and share it between all of its jobs"""
+        from humaniki_schema.duck import FillDuck
+        if fill_id not in self.fill_ducks:
+            if not os.path.exists(self._get_duckdb_path(fill_id)):
+                self.export_fill_duck(fill_id)
+            self.fill_ducks[fill_id] = FillDuck.open(fill_id, self._get_duckdb_path(fill_id))
+        return self.fill_ducks[fill_id]
+
+    def _get_previous_complete_job(self):
+        """the metric job's combination in the previous active fill, if it completed there"""
+        if self.previous_fill is None:
+            return None
+        return self.db_session.query(job).filter(and_(
+            job.job_type == JobType.METRIC_CREATE.value,
+            job.job_state == JobState.COMPLETE.value,
+            job.fill_id == self.previous_fill,
+            job.detail["population_definition"] == self.metric_job.detail["population_definition"],
+            job.detail["properties_id"] == self.metric_job.detail["properties_id"],
+        )).first()
 
-        uncompleted_jobs_count = uncompleted_jobs_q.count()
-        uncompleted_jobs_first = uncompleted_jobs_q.first()
-        log.info(f'PID:{self.pid} There are {uncompleted_jobs_count} uncompleted jobs')
-        self.metric_job = uncompleted_jobs_first
+    def _can_run_incrementally(self):
+        """
+        whether the metric job can start from its combination's metric in the previous fill: only if that has the
+        cells of the same threshold. a row budget chooses its threshold from the full grouping anyway.
+        """
+        previous_job = self._get_previous_complete_job()
+        return previous_job is not None and self.metric_job.detail.get('row_budget') is None and \
+               previous_job.detail.get('threshold') == self.metric_job.detail['threshold']
+
+    def _get_metric_creator_kwargs(self, a_job, db_session):
+        mc_kwargs = dict(
+            population_definition=PopulationDefinition(a_job.detail["population_definition"]),
+            bias_property=Properties(a_job.detail['bias_property']),
+            dimension_properties=[Properties(d) for d in a_job.detail['dimension_properties']],
+            threshold=a_job.detail['threshold'],
+            row_budget=a_job.detail.get('row_budget'),
+            fill_id=a_job.fill_id,
+            properties_id=a_job.detail['properties_id'],
+            db_session=db_session,
+            materialize=self.materialize_grouped,
+            humans_source=self._get_human_fact_source(a_job, db_session),
+            prune_parents=self._get_prune_parents(a_job),
+            skip_coverage=get_fill_by_id(self.db_session, a_job.fill_id).detail.get('coverage') is not None
+        )
+        preview = a_job.detail.get('preview')
+        if preview:
+            # a preview job groups a sample of the previewed fill's human tables themselves, see MetricCreator
+            mc_kwargs.update(humans_fill_id=preview['of_fill'], sample_rate=preview['sample_rate'],
+                             min_sample_count=preview['min_sample_count'], materialize=False, humans_source=None,
+                             prune_parents=None)
+        return mc_kwargs
+
+    def _get_prune_parents(self, a_job):
+        """
+        [(properties_id, dimension properties)] of the combinations one dimension smaller than a_job's that already
+        completed in this fill and population.
+        counts are anti-monotone: a cell can only reach the threshold if each of its parent cells did, so as long as a
+        parent's threshold isn't higher, its metric rows are a superset of the cells a_job can produce.
+        """
+        dimension_properties = a_job.detail['dimension_properties']
+        threshold = a_job.detail['threshold']
+        if self.prune_from_len is None or len(dimension_properties) < self.prune_from_len or not threshold \
+                or self.execute_strategy != 'sequential':
+            return []
+        prune_parents = []
+        for parent_dimensions in combinations(dimension_properties, len(dimension_properties) - 1):
+            # the parent's cells are read back from metric_aggregations_wide
+            if len(parent_dimensions) > METRIC_AGGREGATIONS_WIDE_DIMENSIONS:
+                continue
+            parent_combination = {'population_definition': PopulationDefinition(a_job.detail['population_definition']),
+                                  'bias': Properties(a_job.detail['bias_property']),
+                                  'dimensions': [Properties(d) for d in parent_dimensions]}
+            parent_job = self._make_metric_comb_jobs_query(parent_combination) \
+                .filter(job.fill_id == a_job.fill_id) \
+                .filter(job.job_state == JobState.COMPLETE.value) \
+                .one_or_none()
+            if parent_job is None or (parent_job.detail['threshold'] or 0) > threshold:
+                continue
+            prune_parents.append((parent_job.detail['properties_id'], parent_combination['dimensions']))
+        log.info(f'PID:{self.pid} Pruning job {a_job.id} with {len(prune_parents)} completed parent combinations')
+        return prune_parents
+
+    def _get_human_fact_source(self, a_job, db_session):
+        """
+        read the fill's human_fact instead of joining the human tables, when it has been built for the fill.
+        human_fact has a row per sitelink and citizenship, so it only pays off for the jobs that would join at least one
+        of them, and it doesn't have occupations.
+        """
+        if not self.use_human_fact or self.execute_strategy != 'sequential':
+            return None
+        dimension_properties = {Properties(d) for d in a_job.detail['dimension_properties']}
+        joins_fact_dimension = dimension_properties & {Properties.PROJECT, Properties.CITIZENSHIP}
+        if not joins_fact_dimension or Properties.OCCUPATION in dimension_properties:
+            return None
+        if get_fill_by_id(self.db_session, a_job.fill_id).detail.get('human_fact') is None:
+            log.info(f'PID:{self.pid} Fill {a_job.fill_id} has no human_fact, joining the human tables')
+            return None
+        return make_human_fact_source(db_session, a_job.fill_id)
 
     def _create_metric_creators(self):
         if self.metric_job is not None:
-            mc = MetricCreator(
-                population_definition=PopulationDefinition(self.metric_job.detail["population_definition"]),
-                bias_property=Properties(self.metric_job.detail['bias_property']),
-                dimension_properties=[Properties(d) for d in self.metric_job.detail['dimension_properties']],
-                threshold=self.metric_job.detail['threshold'],
-                fill_id=self.metric_job.fill_id,
-                properties_id=self.metric_job.detail['properties_id'],
-                db_session=session_factory()
-            )
+            if self._get_companion_jobs():
+                # the root's (or group's) temporary tables have to be visible to every member, so they share one
+                # connection
+                lattice_session = pinned_session_factory()
+                self.creator_session = lattice_session
+            elif self.execute_strategy == 'sequential':
+                # the job's grouped humans are a temporary table, see MetricCreator.run
+                self.creator_session = pinned_session_factory()
+            else:
+                self.creator_session = session_factory()
+            mc_kwargs = self._get_metric_creator_kwargs(self.metric_job, self.creator_session)
+
+            if self.execute_strategy == 'incremental' and self._can_run_incrementally():
+                fill_columns = self._get_fill_columns(self.metric_job.fill_id)
+                previous_fill_columns = self._get_fill_columns(self.previous_fill)
+                if (self.metric_job.fill_id, self.previous_fill) not in self.changed_masks:
+                    self.changed_masks[(self.metric_job.fill_id, self.previous_fill)] = \
+                        fill_columns.changed_masks(previous_fill_columns)
+                mc = IncrementalMetricCreator(fill_columns=fill_columns,
+                                              previous_fill_columns=previous_fill_columns,
+                                              changed_masks=self.changed_masks[(self.metric_job.fill_id,
+                                                                                self.previous_fill)],
+                                              **mc_kwargs)
+            elif self.execute_strategy in ('columnar', 'incremental'):
+                # without a previous metric to start from, at the same threshold, incremental computes the metric from
+                # scratch
+                mc = ColumnarMetricCreator(fill_columns=self._get_fill_columns(self.metric_job.fill_id), **mc_kwargs)
+            elif self.execute_strategy == 'duckdb':
+                mc = DuckMetricCreator(fill_duck=self._get_fill_duck(self.metric_job.fill_id), **mc_kwargs)
+            elif self.fill_group_jobs:
+                # one scan of the human tables of every fill, the fill group's jobs aren't combined with the other
+                # ways of sharing a scan
+                mc_kwargs.update(humans_source=None, materialize=False, prune_parents=None, skip_coverage=False)
+                mc = MetricCreator(fill_ids=[self.metric_job.fill_id] + [j.fill_id for j in self.fill_group_jobs],
+                                   **mc_kwargs)
+            elif self.lattice_jobs:
+                member_creators = [MetricCreator(**self._get_metric_creator_kwargs(lattice_job, lattice_session))
+                                   for lattice_job in self.lattice_jobs]
+                mc = MetricLattice(root_creator=MetricCreator(**mc_kwargs), member_creators=member_creators)
+            elif self.population_jobs:
+                member_creators = [MetricCreator(**self._get_metric_creator_kwargs(population_job, lattice_session))
+                                   for population_job in self.population_jobs]
+                mc = MetricPopulationGroup(creators=[MetricCreator(**mc_kwargs), *member_creators])
+            elif self.execute_strategy == 'sequential':
+                mc = MetricCreator(**mc_kwargs)
+            else:
+                raise ValueError(f'Unknown execute_strategy: {self.execute_strategy}')
             self.metric_creator = mc
             log.info(f"hydrate metric creator")
         else:
@@ -190,6 +634,7 @@ class MetricFactory():
         previous_errors = [] if previous_errors is None else previous_errors
         self.metric_job.job_state = JobState.IN_PROGRESS.value
         self.db_session.add(self.metric_job)
+        self._mirror_job_state_to_companion_jobs()
         self.db_session.commit()
 
         try:
@@ -209,27 +654,241 @@ class MetricFactory():
             else:
                 self.metric_job.job_state = JobState.NEEDS_RETRY.value
         finally:
+            self._close_creator_session()
             self.db_session.add(self.metric_job)
+            self._mirror_job_state_to_companion_jobs()
+            self._record_job_counters()
             self.db_session.commit()
             success = self.metric_job.job_state == JobState.COMPLETE.value
             correct_error_count = len(previous_errors) + 1 == len(self.metric_job.errors) if \
                 self.metric_job.errors is not None else True
             assert success or correct_error_count
 
+    def _close_creator_session(self):
+        """give the creator's connection back to the pool, a pinned session's connection included"""
+        if self.creator_session is None:
+            return
+        creator_bind = self.creator_session.get_bind()
+        self.creator_session.close()
+        if isinstance(creator_bind, Connection):
+            creator_bind.close()
+        self.creator_session = None
+
+    def _record_job_counters(self):
+        """
+        store what each step of the attempt inserted, and how long it took, in the job's detail. and the threshold the
+        metric was made with, which a row budget may have raised, so that the backend knows which cells were suppressed
+        and the next fill's incremental run whether it can start from this one. and which process ran the job, one of
+        pool's workers or a process of its own.
+        """
+        runs_companions = isinstance(self.metric_creator, (MetricLattice, MetricPopulationGroup))
+        if runs_companions:
+            job_creators = zip([self.metric_job, *self._get_companion_jobs()], self.metric_creator.creators)
+        else:
+            job_creators = [(self.metric_job, self.metric_creator)]
+        for a_job, creator in job_creators:
+            counters = dict(creator.counters)
+            if a_job is self.metric_job and runs_companions:
+                counters.update(self.metric_creator.counters)
+            a_job.detail['counters'] = counters
+            a_job.detail['threshold'] = creator.threshold
+            a_job.detail['pid'] = self.pid
+            flag_modified(a_job, 'detail')
+            self.db_session.add(a_job)
+        if not runs_companions:
+            # a fill group's jobs share the leader's creator
+            for a_job in self.fill_group_jobs:
+                a_job.detail['threshold'] = self.metric_creator.threshold
+                a_job.detail['pid'] = self.pid
+                flag_modified(a_job, 'detail')
+                self.db_session.add(a_job)
+
+    def _mirror_job_state_to_companion_jobs(self):
+        """the lattice or population group members succeed or fail together with the claimed job, errors are only
+        recorded on the claimed job"""
+        for companion_job in self._get_companion_jobs():
+            companion_job.job_state = self.metric_job.job_state
+            self.db_session.add(companion_job)
+
     def create(self):
         metric_run_start = time.time()
         self._generate_metric_combinations()
-        self._persist_metric_combinations_as_jobs()
+        if self.fill_group:
+            for metric_combination in self.metric_combinations:
+                # a fill group's jobs are run on their own, see _create_metric_creators
+                metric_combination.pop('lattice_root', None)
+                metric_combination.pop('population_group', None)
+            fills = list(zip(self.fill_group, self.fill_group_dates))
+        else:
+            fills = [(self.curr_fill, self.curr_fill_date)]
+        leader_fill = (self.curr_fill, self.curr_fill_date)
+        for fill_id, fill_date in fills:
+            # the job creation reads the fill from curr_fill
+            self.curr_fill, self.curr_fill_date = fill_id, fill_date
+            self.dimension_cardinalities = None
+            self._persist_metric_combinations_as_jobs()
+            if self.fill_coverage:
+                self.generate_fill_coverage()
+            if self.execute_strategy == 'duckdb':
+                self.export_fill_duck(self.curr_fill)
+        self.curr_fill, self.curr_fill_date = leader_fill
         metric_run_end = time.time()
         log.info(f'PID:{self.pid} Metric Factory creation took {metric_run_end - metric_run_start} seconds')
 
-    def execute(self):
+    def create_preview(self):
+        """
+        create the preview fill of the current fill, and a job for every combination on it, which samples the current
+        fill's humans. the jobs run on their own, as a lattice or population group would need the humans that aren't
+        sampled. :return: the preview fill's id
+        """
+        preview_config = self.config_generation.get('preview', {})
+        preview_detail = {'of_fill': self.curr_fill,
+                          'sample_rate': preview_config.get('sample_rate', 0.02),
+                          'min_sample_count': preview_config.get('min_sample_count', 10)}
+        deactivate_preview_fills(self.db_session, self.curr_fill)
+        preview_fill = create_new_fill(self.db_session, self.curr_fill_date, detection_type='preview',
+                                       fill_type=FillType.PREVIEW, extra_detail={'preview': preview_detail})
+        self._generate_metric_combinations()
+        # the costs are estimated from the previewed fill's humans, the preview fill has none
+        self._get_dimension_cardinalities()
+        for metric_combination in self.metric_combinations:
+            metric_combination.pop('lattice_root', None)
+            metric_combination.pop('population_group', None)
+            metric_combination['preview'] = preview_detail
+        previewed_fill = self.curr_fill
+        # the job creation reads the fill from curr_fill
+        self.curr_fill = preview_fill.id
+        try:
+            self._persist_metric_combinations_as_jobs()
+        finally:
+            self.curr_fill = previewed_fill
+        return preview_fill.id
+
+    def preview(self, procs=None):
+        """
+        every combination's metrics from a hash sample of the fill's humans, with scaled totals, written to a fill of
+        type PREVIEW that is active as soon as they are. so the backend has approximate numbers within minutes of the
+        insertion, instead of after the full run. the preview's detail records its sample rate, and it is deactivated
+        when the fill it previews is finalized.
+        the preview's jobs are run by a pool of procs workers, like the fill's own jobs.
+        """
+        preview_start = time.time()
+        preview_fill_id = self.create_preview()
+        preview_factory = MetricFactory(config=self.config_file, fill_date=self.curr_fill_date,
+                                        fill_type=FillType.PREVIEW)
+        preview_factory.pool(procs=procs)
+        update_fill_detail(self.db_session, preview_fill_id, 'active', True)
+        log.info(f'PID:{self.pid} Preview fill {preview_fill_id} of fill {self.curr_fill} took '
+                 f'{round(time.time() - preview_start)} seconds')
+        return preview_fill_id
+
+    def _make_property_mask_query(self):
+        """
+        one scan of the fill's humans (with a gender, like every metric) counted by the bitmask of the dimension
+        properties they have, see utils.COVERAGE_PROPERTIES, and by their population bucket, the largest
+        population_min_sitelinks their sitelink count reaches.
+        """
+        join_tables = {Properties.PROJECT: human_sitelink,
+                       Properties.CITIZENSHIP: human_country,
+                       Properties.OCCUPATION: human_occupation}
+        has_property = {Properties.DATE_OF_BIRTH: human.year_of_birth.isnot(None),
+                        Properties.DATE_OF_DEATH: human.year_of_death.isnot(None)}
+        for prop, join_table in join_tables.items():
+            has_property[prop] = exists().where(and_(join_table.fill_id == human.fill_id,
+                                                     join_table.human_id == human.qid))
+        mask_col = reduce(operator.add, [case([(has_property[prop], property_mask([prop]))], else_=0)
+                                         for prop in COVERAGE_PROPERTIES])
+        min_sitelinks = sorted(set(MetricCreator.population_min_sitelinks.values()), reverse=True)
+        bucket_col = case([(human.sitelink_count >= min_sitelink, min_sitelink) for min_sitelink in min_sitelinks],
+                          else_=0)
+        humans_q = self.db_session.query(mask_col.label('property_mask'),
+                                         bucket_col.label('population_bucket'),
+                                         func.coalesce(human.sitelink_count, 0).label('sitelink_count')) \
+            .filter(human.fill_id == self.curr_fill) \
+            .filter(isnot(human.gender, None))
+        humans = humans_q.subquery('human_masks')
+        return self.db_session.query(humans.c.property_mask, humans.c.population_bucket,
+                                     func.count().label('humans'),
+                                     func.sum(humans.c.sitelink_count).label('sitelinks')) \
+            .group_by(humans.c.property_mask, humans.c.population_bucket)
+
+    def generate_fill_coverage(self):
+        """
+        the metric_coverage rows of every job of the fill, from a single scan of the humans instead of one join and
+        group by per job. a combination's coverage is the sum over the property masks that have all of its properties.
+        the metric creators then skip their own coverage step.
+        """
+        coverage_start = time.time()
+        mask_totals = {(row.property_mask, row.population_bucket): (row.humans, int(row.sitelinks))
+                       for row in self._make_property_mask_query().all()}
+        fill_jobs = self.db_session.query(job) \
+            .filter(job.job_type == JobType.METRIC_CREATE.value) \
+            .filter(job.fill_id == self.curr_fill) \
+            .all()
+        coverage_rows = []
+        for a_job in fill_jobs:
+            population_definition = PopulationDefinition(a_job.detail['population_definition'])
+            total_with_properties, total_sitelinks_with_properties = coverage_from_property_masks(
+                mask_totals, [Properties(d) for d in a_job.detail['dimension_properties']],
+                MetricCreator.population_min_sitelinks[population_definition])
+            coverage_rows.append({'fill_id': self.curr_fill,
+                                  'properties_id': a_job.detail['properties_id'],
+                                  'population_id': population_definition.value,
+                                  'total_with_properties': total_with_properties,
+                                  'total_sitelinks_with_properties': total_sitelinks_with_properties})
+        rowcount = bulk_insert_ignore(self.db_session, metric_coverage, coverage_rows)
+        self.db_session.commit()
+        update_fill_detail(self.db_session, self.curr_fill, 'coverage', len(coverage_rows))
+        log.info(f'PID:{self.pid} Fill coverage of {len(mask_totals)} property masks into {rowcount} metric_coverage '
+                 f'rows took {round(time.time() - coverage_start)} seconds')
+        return rowcount
+
+    def execute(self, drain=False):
+        """
+        :param drain: keep on running jobs, and return once there are none left for the fill. otherwise a single job
+        is run, and if there are none _create_metric_creators exits with the special signal to the calling bash.
+        """
         metric_run_start = time.time()
-        self._get_uncompleted_metric_create_jobs()
-        self._create_metric_creators()
-        self._run_metric_creators()
+        # the columnar, incremental and duckdb strategies load the fill once, so they keep on running jobs too
+        keep_running = True
+        jobs_run = 0
+        while keep_running:
+            self._get_uncompleted_metric_create_jobs()
+            if drain and self.metric_job is None:
+                break
+            self._create_metric_creators()
+            self._run_metric_creators()
+            jobs_run += 1
+            keep_running = drain or self.execute_strategy in ('columnar', 'incremental', 'duckdb')
         metric_run_end = time.time()
-        log.info(f'PID:{self.pid} Metric Factory execute took {metric_run_end - metric_run_start} seconds')
+        log.info(f'PID:{self.pid} Metric Factory execute ran {jobs_run} jobs and took '
+                 f'{metric_run_end - metric_run_start} seconds')
+        return jobs_run
+
+    def pool(self, procs=None):
+        """
+        run the fill's jobs with procs worker processes, each of which claims jobs until there are none left.
+        replaces launching execute_metrics.sh's bash loops of one process per job.
+        """
+        procs = procs if procs else os.cpu_count()
+        pool_start = time.time()
+        # the workers make their own connections
+        self.db_session.close()
+        db_engine.dispose()
+        with multiprocessing.Pool(procs) as worker_pool:
+            jobs_run = worker_pool.starmap(_drain_metric_jobs,
+                                           [(self.config_file, self.curr_fill_date, self.fill_dates,
+                                             self.fill_type)] * procs)
+        log.info(f'PID:{self.pid} Metric pool of {procs} processes ran {sum(jobs_run)} jobs and took '
+                 f'{time.time() - pool_start} seconds')
+        return sum(jobs_run)
+
+
+def _drain_metric_jobs(config, fill_date, fill_dates=None, fill_type=FillType.DUMP):
+    # the forked engine's connections belong to the parent
+    db_engine.dispose()
+    mf = MetricFactory(config=config, fill_date=fill_date, fill_dates=fill_dates, fill_type=fill_type)
+    return mf.execute(drain=True)
 
 
 class MetricCreator():
@@ -237,31 +896,89 @@ class MetricCreator():
     Create a single "metric" (expands to multiple 'metric' rows) based on a population_defintion, bias property, dimension, property, and threshold
     """
 
-    def __init__(self, population_definition, bias_property, dimension_properties, threshold, fill_id, properties_id, db_session):
+    def __init__(self, population_definition, bias_property, dimension_properties, threshold, fill_id, properties_id, db_session,
+                 humans_source=None, materialize=False, prune_parents=None,
+                 skip_coverage=False, fill_ids=None, row_budget=None, humans_fill_id=None, sample_rate=None,
+                 min_sample_count=None):
         self.population_definition = population_definition
         self.population_filter = self._get_population_filter()
+        # an already joined, qid level table to group instead of the human tables, see MetricLattice
+        self.humans_source = humans_source
+        # with materialize, the join is written once into a session scoped temporary table as well as the group by
+        # (so db_session needs to be pinned to its connection), which the group by and coverage then read. see run
+        self.materialize = materialize
+        self.grouped_source = None
+        # [(properties_id, dimension properties)] of completed parent combinations whose cells the group by is
+        # restricted to, see MetricFactory._get_prune_parents
+        self.prune_parents = prune_parents if prune_parents else []
+        # the fill's coverage was already generated for every job, see MetricFactory.generate_fill_coverage
+        self.skip_coverage = skip_coverage
         self.coverage_q = None
         self.bias_property = bias_property
         self.dimension_properties = dimension_properties
         self.dimension_properties_pids = [p.value for p in self.dimension_properties]
         self.bias_dimension_properties_pids = [bias_property.value] + self.dimension_properties_pids
         self.dimension_cols = self._get_dim_cols_from_dim_props()
+        # small enough combinations are joined through metric_aggregations_wide instead of the metric_aggregations_n
+        # self join
+        self.use_wide_aggregations = len(self.dimension_properties) <= METRIC_AGGREGATIONS_WIDE_DIMENSIONS
         self.aggregation_ids = None
         self.threshold = threshold
+        # the most metric rows to write, see choose_threshold
+        self.row_budget = row_budget
         self.fill_id = fill_id
+        # with several fill ids, their human tables are grouped in one scan, by fill_id as well. see
+        # MetricFactory._get_fill_group_jobs
+        self.fill_ids = fill_ids
+        if self.fill_ids and (self.humans_source is not None or self.materialize or self.prune_parents):
+            raise ValueError('Only the human tables can be grouped for several fills at once')
+        # the fill whose humans are grouped, when the metrics are written to another one, see MetricFactory.preview
+        self.humans_fill_id = humans_fill_id if humans_fill_id is not None else fill_id
+        # only group a hash sample of the humans, and scale the totals back up. a cell needs min_sample_count sampled
+        # humans to be written, so that the scaled totals aren't made of a few humans
+        self.sample_rate = sample_rate
+        self.min_sample_count = min_sample_count
+        if self.sample_rate and (self.humans_source is not None or self.materialize or self.fill_ids):
+            raise ValueError('Only the human tables of a single fill can be sampled')
         self.db_session = db_session
         self.metric_q = None
         self.metric_res = None
         self.insert_metrics = []
         self.metric_properties_id = properties_id
+        # {step name: {'seconds':, 'rows':}}, filled in by _time_step and persisted in the job's detail
+        self.counters = {}
 
     def __str__(self):
         return f"MetricCreator. bias:{self.bias_property.name}; dimensions:{','.join([d.name for d in self.dimension_properties])}; population:{self.population_definition.name} "
 
 
-    def _get_population_filter(self):
+    # the fewest sitelinks a human needs to be in the population, which nest. see MetricPopulationGroup
+    population_min_sitelinks = {PopulationDefinition.ALL_WIKIDATA: 0,
+                                PopulationDefinition.GTE_ONE_SITELINK: 1}
+
+    def _get_fill_filter(self, fill_id_col=human.fill_id, qid_col=human.qid):
+        fill_filter = fill_id_col.in_(self.fill_ids) if self.fill_ids else fill_id_col == self.humans_fill_id
+        if self.sample_rate:
+            fill_filter = and_(fill_filter, make_qid_sample_filter(qid_col, self.sample_rate))
+        return fill_filter
+
+    def _scale_count(self, count_col):
+        """a count of sampled humans as an estimate of the count of all of them"""
+        return func.ROUND(count_col / self.sample_rate) if self.sample_rate else count_col
+
+    def _get_count_threshold(self):
+        """the threshold in the units the query counts, sampled humans when sampling"""
+        if not self.sample_rate:
+            return self.threshold
+        return max(math.ceil((self.threshold or 0) * self.sample_rate), self.min_sample_count or 1)
+
+    def _get_fill_id_col(self, grouped):
+        """the fill_id of the metric rows of the grouped humans"""
+        return grouped.c.fill_id if self.fill_ids else literal(self.fill_id)
+
+    def _get_population_filter(self, sitelink_count_col=human.sitelink_count):
         pop_filter = {PopulationDefinition.ALL_WIKIDATA: None,
-                      PopulationDefinition.GTE_ONE_SITELINK: human.sitelink_count > 0,
+                      PopulationDefinition.GTE_ONE_SITELINK: sitelink_count_col > 0,
                       }
         return pop_filter[self.population_definition]
 
@@ -302,40 +1019,73 @@ class MetricCreator():
                       Properties.OCCUPATION: None, }
         return filter_map[dim_prop]
 
-    def _count_metrics_before_and_after(fun):
-        def with_counts(self):
-            start_metrics_count = count_table_metrics(self.db_session)
-            start_metric_aggregations_j_count = count_table_metric_aggregations_j(self.db_session)
-            start_metric_aggregations_n_count = count_table_metric_aggregations_n(self.db_session)
-            fun(self)
-            end_metrics_count = count_table_metrics(self.db_session)
-            end_metric_aggregations_j_count = count_table_metric_aggregations_j(self.db_session)
-            end_metric_aggregations_n_count = count_table_metric_aggregations_n(self.db_session)
-            metric_additions = end_metrics_count - start_metrics_count
-            metric_aggregations_j_additions = end_metric_aggregations_j_count - start_metric_aggregations_j_count
-            metric_aggregations_n_additions = end_metric_aggregations_n_count - start_metric_aggregations_n_count
-            metric_n_j_ratio = metric_aggregations_n_additions / metric_aggregations_j_additions if metric_aggregations_j_additions != 0 else None
-            log.info(f'Metric Counter: {metric_additions} metrics added')
-            log.info(f'Metric Counter: {metric_aggregations_j_additions} metric_aggregations_j added')
-            log.info(f'Metric Counter: {metric_aggregations_n_additions} metric_aggregations_n added')
-            log.info(f'Metric Counter: {metric_n_j_ratio} n to j ratio')
-            if metric_n_j_ratio:
-                assert metric_n_j_ratio == len(
-                    self.bias_dimension_properties_pids), 'not adding aggregations in correct ratio. ratio was' \
-                                                          f'{metric_n_j_ratio} and we expected' \
-                                                          f' {len(self.bias_dimension_properties_pids)}'
-
-        return with_counts
-
     def _time_step(fun):
         def with_timing(self):
             start = time.time()
-            fun(self)
+            rowcount = fun(self)
             end = time.time()
-            log.info(f'Stage timing {fun.__name__} took: {round(end - start)} seconds')
+            rows_str = f', {rowcount} rows' if isinstance(rowcount, int) else ''
+            log.info(f'Stage timing {fun.__name__} took: {round(end - start)} seconds{rows_str}')
+            # the rowcount of the step's statement, rather than counting whole tables around it
+            self.counters[fun.__name__] = {'seconds': round(end - start, 3),
+                                           'rows': rowcount if isinstance(rowcount, int) else None}
+            return rowcount
 
         return with_timing
 
+    def make_humans_with_properties_query(self, isouter=False, all_populations=False):
+        """
+        the qid level rows of the fill, one per human and combination of their dimension values, before any grouping.
+        with isouter the multi-valued dimensions are left joined, so that humans without them are kept with nulls, and
+        the population filter is not applied. that is what a MetricLattice root materializes.
+        with all_populations only the population filter is not applied, see MetricPopulationGroup.
+        """
+        humans_q = self.db_session.query(human.qid.label('qid'),
+                                         human.gender.label('gender'),
+                                         human.sitelink_count.label('sitelink_count'),
+                                         *self.dimension_cols)
+        for dim_prop in self.dimension_properties:
+            join_table, join_on = self._get_dim_join_from_dim_prop(dim_prop)
+            if join_table is not None:
+                humans_q = humans_q.join(join_table, join_on, isouter=isouter)
+            filter = self._get_dim_filter_from_dim_prop(dim_prop)
+            if filter is not None and not isouter:
+                humans_q = humans_q.filter(filter)
+
+        if self.population_filter is not None and not (isouter or all_populations):
+            humans_q = humans_q.filter(self.population_filter)
+
+        humans_q = humans_q.filter(isnot(human.gender, None))
+        humans_q = humans_q.filter(self._get_fill_filter())
+        return humans_q
+
+    def _filter_humans_source(self, source_q):
+        """the dimension and population filters, applied to the columns of humans_source"""
+        for dim_col in self.dimension_cols:
+            source_q = source_q.filter(isnot(self.humans_source.c[dim_col.key], None))
+        population_filter = self._get_population_filter(self.humans_source.c.sitelink_count)
+        if population_filter is not None:
+            source_q = source_q.filter(population_filter)
+        return source_q
+
+    def make_agg_humans_from_source_query(self):
+        """group humans_source instead of the human tables. the source can have several rows per human and
+        combination of this creator's dimension values (it may have more dimensions), so humans are counted distinctly"""
+        bias_col = self.humans_source.c.gender.label('gender')
+        dimension_cols = [self.humans_source.c[dim_col.key].label(dim_col.key) for dim_col in self.dimension_cols]
+        count_col = func.count(func.distinct(self.humans_source.c.qid)).label('total')
+        group_bys = [bias_col] + dimension_cols
+
+        metric_q = self.db_session.query(*group_bys, count_col)
+        metric_q = self._filter_humans_source(metric_q)
+        metric_q = self._prune_to_parent_cells(metric_q, self.humans_source.c.gender,
+                                               lambda prop: self.humans_source.c[self.col_map[prop].key])
+        metric_q = metric_q.group_by(*group_bys)
+        if self.threshold:
+            metric_q = metric_q.having(count_col >= self.threshold)
+        self.metric_q = metric_q
+        return metric_q.subquery('grouped')
+
     def make_agg_humans_query(self):
         """        make something approximating
         metric_q = db_session.query(human.gender, human_sitelink.sitelink, human_country.country,
@@ -343,10 +1093,19 @@ class MetricCreator():
             .join(human_country, and_(human.qid == human_country.human_id, human.fill_id == human_country.fill_id)) \
             .join(human_sitelink, and_(human.qid == human_sitelink.human_id, human.fill_id == human_sitelink.fill_id)) \
             .group_by(human_country.country, human_sitelink.sitelink, human.gender)"""
+        if self.grouped_source is not None:
+            return self.grouped_source.alias('grouped')
+        if self.humans_source is not None:
+            return self.make_agg_humans_from_source_query()
+
         bias_col = human.gender.label('gender')  # maybe getattr(human, bias_property.name.lower()
-        count_col = func.count(bias_col).label('total')
-        metric_cols = [bias_col, *self.dimension_cols, count_col]
+        count_col = func.count(bias_col)
+        metric_cols = [bias_col, *self.dimension_cols, self._scale_count(count_col).label('total')]
         group_bys = [bias_col] + self.dimension_cols
+        if self.fill_ids:
+            fill_col = human.fill_id.label('fill_id')
+            metric_cols.insert(0, fill_col)
+            group_bys.insert(0, fill_col)
 
         metric_q = self.db_session.query(*metric_cols)
         # dimension joins and filters
@@ -367,49 +1126,79 @@ class MetricCreator():
         metric_q = metric_q.filter(isnot(human.gender, None))
 
         # current fill filter
-        metric_q = metric_q.filter(human.fill_id == self.fill_id)
+        metric_q = metric_q.filter(self._get_fill_filter())
+        metric_q = self._prune_to_parent_cells(metric_q, human.gender, lambda prop: self.col_map[prop].element)
         metric_q = metric_q.group_by(*group_bys)
-        if self.threshold:
-            metric_q = metric_q.having(count_col >= self.threshold)
+        count_threshold = self._get_count_threshold()
+        if count_threshold:
+            metric_q = metric_q.having(count_col >= count_threshold)
         metric_q_sub = metric_q.subquery('grouped')
         metric_raw_sql = metric_q.statement.compile(compile_kwargs={"literal_binds": True})
         # log.debug(f'compiled metric sql is: {metric_raw_sql}')
         self.metric_q = metric_q
         return metric_q_sub
 
+    def make_parent_cells_query(self, i, parent_properties_id, parent_dimension_properties):
+        """the gender and dimension values of the cells a parent combination kept in this fill and population"""
+        parent_wide = aliased(metric_aggregations_wide, name=f'parent_wide_{i}')
+        cell_cols = [parent_wide.bias_value.label('gender')]
+        parent_project = None
+        for pos, prop in enumerate(parent_dimension_properties, start=1):
+            val_col = getattr(parent_wide, f'val_{pos}')
+            if prop == Properties.PROJECT:
+                # the wide table has project ids, the human tables sitelink codes
+                parent_project = aliased(project, name=f'parent_project_{i}')
+                parent_project_on = parent_project.id == val_col
+                cell_cols.append(parent_project.code.label(self.col_map[prop].key))
+            else:
+                cell_cols.append(val_col.label(self.col_map[prop].key))
+
+        parent_cells_q = self.db_session.query(*cell_cols) \
+            .select_from(metric) \
+            .join(parent_wide, parent_wide.id == metric.aggregations_id)
+        if parent_project is not None:
+            parent_cells_q = parent_cells_q.join(parent_project, parent_project_on)
+        parent_cells_q = parent_cells_q \
+            .filter(metric.fill_id == self.fill_id) \
+            .filter(metric.population_id == self.population_definition.value) \
+            .filter(metric.properties_id == parent_properties_id) \
+            .distinct()
+        return parent_cells_q.subquery(f'parent_cells_{i}')
+
+    def _prune_to_parent_cells(self, metric_q, gender_col, get_dim_col):
+        """
+        semi join the humans to be grouped to the cells of each parent combination, a (project, citizenship, year of
+        birth) cell can't pass the threshold if its (project, citizenship) cell didn't.
+        :param get_dim_col: Properties -> the column to match the parent's cells on
+        """
+        for i, (parent_properties_id, parent_dimension_properties) in enumerate(self.prune_parents):
+            parent_cells = self.make_parent_cells_query(i, parent_properties_id, parent_dimension_properties)
+            metric_q = metric_q.join(parent_cells, and_(
+                gender_col == parent_cells.c.gender,
+                *[get_dim_col(prop) == parent_cells.c[self.col_map[prop].key] for prop in parent_dimension_properties]))
+        return metric_q
+
     def make_human_2_maj_insert_query(self, metric_q_sub):
-        maj_joins = []
-        dim_cols_of_metric_q_sub = []
-        for i, dim_col in enumerate(self.dimension_cols):
-            # grouped.sitelink = JSON_UNQUOTE(JSON_EXTRACT(existing_aggs.aggregations, '$[0]'))
-            dim_col_of_metric_q_sub = getattr(metric_q_sub.c, dim_col.key)
-            maj_join = dim_col_of_metric_q_sub == \
-                       func.JSON_UNQUOTE(func.JSON_EXTRACT(metric_aggregations_j.aggregations, f"$[{i}]"))
-            maj_joins.append(maj_join)
-            dim_cols_of_metric_q_sub.append(dim_col_of_metric_q_sub)
-
-        deduped_q = self.db_session.query(
+        dim_cols_of_metric_q_sub = [getattr(metric_q_sub.c, dim_col.key) for dim_col in self.dimension_cols]
+
+        # aggregations are content addressed, so the unique hash dedupes against the existing ones with an index probe
+        maj_q = self.db_session.query(
+            aggregations_hash_expr(metric_q_sub.c.gender, self.dimension_properties_pids,
+                                   dim_cols_of_metric_q_sub).label('hash'),
             metric_q_sub.c.gender.label('bias_value'),
             func.JSON_ARRAY(*dim_cols_of_metric_q_sub).label('aggregations'),
             literal(len(self.dimension_cols)).label('aggregations_len'),
             func.JSON_ARRAY(*self.dimension_properties_pids).label('properties'),
-        ).select_from(metric_q_sub) \
-            .join(metric_aggregations_j,
-                  and_(metric_q_sub.c.gender == metric_aggregations_j.bias_value,
-                       metric_aggregations_j.aggregations_len == len(self.dimension_properties),
-                       *maj_joins),
-                  isouter=True  # left join
-                  ) \
-            .filter(metric_aggregations_j.id.is_(None))  # not already present maj
-
-        # dedupe_raw_sql = deduped_q.statement.compile(compile_kwargs={"literal_binds": True})
-        # log.debug(f'compiled dedupe sql is: {dedupe_raw_sql}')
+        ).select_from(metric_q_sub)
+        if self.fill_ids:
+            # the same aggregation is grouped once per fill
+            maj_q = maj_q.distinct()
 
         maj_insert = sqlalchemy \
             .insert(metric_aggregations_j) \
             .prefix_with('IGNORE') \
-            .from_select(names=['bias_value', 'aggregations', 'aggregations_len', 'properties'],
-                         select=deduped_q)
+            .from_select(names=['hash', 'bias_value', 'aggregations', 'aggregations_len', 'properties'],
+                         select=maj_q)
         maj_sql = maj_insert.compile(compile_kwargs={'literal_binds': True})
         log.debug(maj_sql)
         return maj_insert
@@ -420,61 +1209,106 @@ class MetricCreator():
         metric_q_sub = self.make_agg_humans_query()
         maj_insert = self.make_human_2_maj_insert_query(metric_q_sub=metric_q_sub)
 
-        self.db_session.execute(maj_insert)
+        maj_res = self.db_session.execute(maj_insert)
         self.db_session.commit()
+        return maj_res.rowcount
+
+    def make_unnormalized_aggregations_query(self, normalized_id_col):
+        """
+        the ids of the aggregations this job groups into that normalized_id_col's table doesn't have yet: the job's
+        hashes probed into metric_aggregations_j, anti joined to the normalized table. jobs of the same properties share
+        aggregations, so these may have been inserted by another job's step one, that hasn't normalized them yet.
+        the hashes are those of the grouped humans run wrote once, not another group by.
+        """
+        metric_q_sub = self.make_agg_humans_query()
+        dim_cols = [getattr(metric_q_sub.c, dim_col.key) for dim_col in self.dimension_cols]
+        job_maj = aliased(metric_aggregations_j, name='job_maj')
+        return self.db_session.query(job_maj.id) \
+            .select_from(metric_q_sub) \
+            .join(job_maj, job_maj.hash == aggregations_hash_expr(metric_q_sub.c.gender,
+                                                                  self.dimension_properties_pids, dim_cols)) \
+            .outerjoin(normalized_id_col.class_, normalized_id_col == job_maj.id) \
+            .filter(normalized_id_col.is_(None)) \
+            .distinct()
 
     @_time_step
     def step_two_man_insert(self):
-        '''Doing this as raw sql because the JSON_TABLE function is particularly hard in sqlalchemy'''
-        when_temp = 'when aggregation_order - 1 = {i} then {prop_pid}'
-        whens = [when_temp.format(i=i, prop_pid=prop_pid) for i, prop_pid in
-                 enumerate(self.bias_dimension_properties_pids)]
-        whens_str = '\n'.join(whens)
-        properties_case_statement = f"""CASE {whens_str} END  as property"""
-
-        properties_eq_temp = """ metric_aggregations_j.properties->'$[{i}]' = {prop_pid}"""
-        # i reall dislike that in normalized version bias is included as tbe 0th agg, and in the json version not, but that's how it is
-        properties_eqs = [properties_eq_temp.format(i=i, prop_pid=prop_pid) for i, prop_pid in
-                          enumerate(self.dimension_properties_pids)]
-        properties_correct = ' AND '.join(properties_eqs)
-        another_and = 'AND' if len(self.dimension_properties) > 0 else ''
-        properties_correct = another_and + properties_correct
-
-        maj_to_man = text(f"""
-        INSERT IGNORE INTO metric_aggregations_n(id, property, value, aggregation_order)
-        with exploded as
-         (select id,
-                 v.*
-          FROM metric_aggregations_j,
+        """explode the job's unnormalized aggregations, bias value first, into metric_aggregations_n"""
+        maj_id = literal_column('metric_aggregations_j.id')
+        # the JSON_TABLE function is particularly hard in sqlalchemy, so the explode is a textual FROM
+        exploded_from = text("""metric_aggregations_j,
                JSON_TABLE(
                    -- since im going wide to long, make this really wide first
-                       JSON_ARRAY_INSERT(aggregations, '$[0]', bias_value),
+                       JSON_ARRAY_INSERT(metric_aggregations_j.aggregations, '$[0]', metric_aggregations_j.bias_value),
                        "$[*]"
                        COLUMNS (
                            aggregation_order for ordinality,
                             -- even though this will get converted into an int, needs to support alpha wikicodes first.
                            value varchar(255) path '$[0]'
                            )
-                   ) as v
-          where metric_aggregations_j.aggregations_len = {len(self.dimension_properties)}
-               {properties_correct}
-         ),
-        intified as (
-         select e.id,
-                {properties_case_statement},
-                -- select either the wikicode id if it was joinable, or the nowikicode value
-                COALESCE(p.id, e.value) as value, -- if the wiki does not exist, null will result, and that will get stored as a 0.
-                aggregation_order - 1   as aggregation_order
-         from exploded e
-                  left join project p
-                            on e.value = p.code
-             )
-        SELECT id, property, value, aggregation_order
-        FROM intified;
-        """)
+                   ) as v""")
+        unnormalized_ids = self.make_unnormalized_aggregations_query(metric_aggregations_n.id).subquery('unnormalized')
+        exploded = sqlalchemy.select([maj_id.label('id'),
+                                      literal_column('v.aggregation_order').label('aggregation_order'),
+                                      literal_column('v.value').label('value')]) \
+            .select_from(exploded_from) \
+            .where(maj_id.in_(sqlalchemy.select([unnormalized_ids.c.id]))) \
+            .alias('exploded')
+
+        # i reall dislike that in normalized version bias is included as tbe 0th agg, and in the json version not
+        property_col = case([(exploded.c.aggregation_order - 1 == i, prop_pid)
+                             for i, prop_pid in enumerate(self.bias_dimension_properties_pids)])
+        intified = sqlalchemy.select([exploded.c.id,
+                                      property_col.label('property'),
+                                      # either the wikicode id if it was joinable, or the nowikicode value. if the wiki
+                                      # does not exist, null will result, and that will get stored as a 0.
+                                      func.COALESCE(project.id, exploded.c.value).label('value'),
+                                      (exploded.c.aggregation_order - 1).label('aggregation_order')]) \
+            .select_from(exploded.outerjoin(project, exploded.c.value == project.code))
+
+        maj_to_man = sqlalchemy \
+            .insert(metric_aggregations_n) \
+            .prefix_with('IGNORE') \
+            .from_select(names=['id', 'property', 'value', 'aggregation_order'], select=intified)
         log.debug(f' man to maj statement: {maj_to_man}')
-        self.db_session.execute(maj_to_man)
+        man_res = self.db_session.execute(maj_to_man)
         self.db_session.commit()
+        return man_res.rowcount
+
+    @_time_step
+    def step_two_wide_insert(self):
+        """pivot the job's aggregations that aren't in metric_aggregations_wide yet into it, like step two"""
+        maj = metric_aggregations_j
+        val_cols = []
+        project_value = None
+        for i, prop in enumerate(self.dimension_properties):
+            value = func.JSON_UNQUOTE(func.JSON_EXTRACT(maj.aggregations, f'$[{i}]'))
+            if prop == Properties.PROJECT:
+                # as in step two, an unknown wiki can't be normalized and gets stored as a 0
+                project_value = value
+                value = func.COALESCE(project.id, value)
+            val_cols.append(value.label(f'val_{i + 1}'))
+
+        wide_q = self.db_session.query(
+            maj.id.label('id'),
+            literal(self.metric_properties_id).label('properties_id'),
+            maj.bias_value.label('bias_value'),
+            *val_cols
+        ).select_from(maj)
+        if project_value is not None:
+            wide_q = wide_q.outerjoin(project, project.code == project_value)
+        unnormalized_ids = self.make_unnormalized_aggregations_query(metric_aggregations_wide.id).subquery('unnormalized')
+        wide_q = wide_q.filter(maj.id.in_(sqlalchemy.select([unnormalized_ids.c.id])))
+
+        wide_insert = sqlalchemy \
+            .insert(metric_aggregations_wide) \
+            .prefix_with('IGNORE') \
+            .from_select(names=['id', 'properties_id', 'bias_value'] + [c.name for c in val_cols],
+                         select=wide_q)
+        log.debug(wide_insert.compile(compile_kwargs={'literal_binds': True}))
+        wide_res = self.db_session.execute(wide_insert)
+        self.db_session.commit()
+        return wide_res.rowcount
 
     def _make_agg_n_wide_project_case_statement(self, man):
         # when the property is project/sitelink return the project code
@@ -535,9 +1369,35 @@ class MetricCreator():
         # log.debug(f'man wide sql is: {man_wide_sql}')
         return man_wide_q.subquery('man_wide')
 
-    @_time_step
-    def step_three_human_with_man_insert(self):
-        metric_q_sub = self.make_agg_humans_query()
+    def make_metric_w_agg_wide_query(self, metric_q_sub):
+        """join the grouped humans to their aggregations with a probe of metric_aggregations_wide"""
+        wide = metric_aggregations_wide
+        on_clauses = [wide.properties_id == self.metric_properties_id,
+                      wide.bias_value == metric_q_sub.c.gender]
+        project_col = None
+        for i, prop in enumerate(self.dimension_properties):
+            metric_col = getattr(metric_q_sub.c, self.col_map[prop].name)
+            wide_col = getattr(wide, f'val_{i + 1}')
+            if prop == Properties.PROJECT:
+                # the wide table has the project's id, the humans the project's code
+                project_col = metric_col
+                on_clauses.append(wide_col == project.id)
+            else:
+                on_clauses.append(wide_col == metric_col)
+
+        metric_w_agg = self.db_session.query(
+            self._get_fill_id_col(metric_q_sub).label('fill_id'),
+            literal(self.population_definition.value).label('population_id'),
+            literal(self.metric_properties_id).label('properties_id'),
+            wide.id.label('aggrgations_id'),
+            metric_q_sub.c.gender.label('bias_value'),
+            metric_q_sub.c.total.label('total')
+        ).select_from(metric_q_sub)
+        if project_col is not None:
+            metric_w_agg = metric_w_agg.join(project, project.code == project_col)
+        return metric_w_agg.join(wide, and_(*on_clauses))
+
+    def make_metric_w_agg_n_wide_query(self, metric_q_sub):
         agg_n_wide = self.make_metric_agg_n_wide()
 
         on_clauses = []
@@ -548,8 +1408,8 @@ class MetricCreator():
             agg_n_col = getattr(agg_n_wide.c, agg_targ_col)
             on_clauses.append(metric_col == agg_n_col)
 
-        metric_w_agg = self.db_session.query(
-            literal(self.fill_id).label('fill_id'),
+        return self.db_session.query(
+            self._get_fill_id_col(metric_q_sub).label('fill_id'),
             literal(self.population_definition.value).label('population_id'),
             literal(self.metric_properties_id).label('properties_id'),
             agg_n_wide.c.id.label('aggrgations_id'),
@@ -562,6 +1422,14 @@ class MetricCreator():
             and_(*on_clauses)
         )
 
+    @_time_step
+    def step_three_human_with_man_insert(self):
+        metric_q_sub = self.make_agg_humans_query()
+        if self.use_wide_aggregations:
+            metric_w_agg = self.make_metric_w_agg_wide_query(metric_q_sub)
+        else:
+            metric_w_agg = self.make_metric_w_agg_n_wide_query(metric_q_sub)
+
         metric_w_agg_insert = sqlalchemy \
             .insert(metric) \
             .prefix_with('IGNORE') \
@@ -571,14 +1439,23 @@ class MetricCreator():
         metric_w_agg_insert_sql = metric_w_agg_insert.compile(compile_kwargs={'literal_binds': True})
         log.debug(f'man with agg sql is: {metric_w_agg_insert_sql}')
 
-        self.db_session.execute(metric_w_agg_insert)
+        metric_res = self.db_session.execute(metric_w_agg_insert)
         self.db_session.commit()
+        return metric_res.rowcount
 
-    @_count_metrics_before_and_after
     def compile(self):
         self.step_one_maj_insert()
         self.step_two_man_insert()
+        if self.use_wide_aggregations:
+            self.step_two_wide_insert()
         self.step_three_human_with_man_insert()
+        self._log_counters()
+
+    def _log_counters(self):
+        rows = {step: counter['rows'] for step, counter in self.counters.items()}
+        log.info(f'Metric Counter: {rows.get("step_three_human_with_man_insert")} metrics added')
+        log.info(f'Metric Counter: {rows.get("step_one_maj_insert")} metric_aggregations_j added')
+        log.info(f'Metric Counter: {rows.get("step_two_man_insert")} metric_aggregations_n added')
 
 
     @_time_step
@@ -596,40 +1473,52 @@ class MetricCreator():
         # group by qid) items_with_prop
 
         # first make a subquery of items with props
-        bias_col = human.gender  # maybe getattr(human, bias_property.name.lower()
-        group_bys = [human.qid]
-
-        item_prop_q = self.db_session.query(human.qid.label('qid'),
-                                            func.min(human.sitelink_count).label('sitelink_count'))
-        # dimension joins and filters
-        for dim_prop in self.dimension_properties:
-            ## apply joins
-            join_table, join_on = self._get_dim_join_from_dim_prop(dim_prop)
-            if join_table is not None:
-                item_prop_q = item_prop_q.join(join_table, join_on)
-            ## apply filters
-            filter = self._get_dim_filter_from_dim_prop(dim_prop)
-            if filter is not None:
-                item_prop_q = item_prop_q.filter(filter)
-
-        if self.population_filter is not None:
-            item_prop_q = item_prop_q.filter(self.population_filter)
-
-        # add gender is not null
-        item_prop_q = item_prop_q.filter(isnot(human.gender, None))
-
-        # current fill filter
-        item_prop_q = item_prop_q.filter(human.fill_id == self.fill_id)
-        item_prop_q = item_prop_q.group_by(*group_bys)
-        items_with = item_prop_q.subquery().alias('items_with')
+        if self.humans_source is not None:
+            item_prop_q = self.db_session.query(self.humans_source.c.qid.label('qid'),
+                                                func.min(self.humans_source.c.sitelink_count).label('sitelink_count'))
+            item_prop_q = self._filter_humans_source(item_prop_q)
+            item_prop_q = item_prop_q.group_by(self.humans_source.c.qid)
+            items_with = item_prop_q.subquery().alias('items_with')
+        else:
+            bias_col = human.gender  # maybe getattr(human, bias_property.name.lower()
+            group_bys = [human.qid]
+
+            if self.fill_ids:
+                group_bys.append(human.fill_id)
+            item_prop_q = self.db_session.query(human.qid.label('qid'),
+                                                *[human.fill_id.label('fill_id')] if self.fill_ids else [],
+                                                func.min(human.sitelink_count).label('sitelink_count'))
+            # dimension joins and filters
+            for dim_prop in self.dimension_properties:
+                ## apply joins
+                join_table, join_on = self._get_dim_join_from_dim_prop(dim_prop)
+                if join_table is not None:
+                    item_prop_q = item_prop_q.join(join_table, join_on)
+                ## apply filters
+                filter = self._get_dim_filter_from_dim_prop(dim_prop)
+                if filter is not None:
+                    item_prop_q = item_prop_q.filter(filter)
+
+            if self.population_filter is not None:
+                item_prop_q = item_prop_q.filter(self.population_filter)
+
+            # add gender is not null
+            item_prop_q = item_prop_q.filter(isnot(human.gender, None))
+
+            # current fill filter
+            item_prop_q = item_prop_q.filter(self._get_fill_filter())
+            item_prop_q = item_prop_q.group_by(*group_bys)
+            items_with = item_prop_q.subquery().alias('items_with')
 
         # second, count the number of items and sitelinks
         coverage_q = sqlalchemy.select(
-            literal(f'{self.fill_id}').label('fill_id'),
+            (items_with.c.fill_id if self.fill_ids else literal(f'{self.fill_id}')).label('fill_id'),
              literal(f'{self.metric_properties_id}').label('properties_id'),
              literal(f'{self.population_definition.value}').label('population_id'),
-             func.count(items_with.c.qid).label('total_with_properties'),
-             func.sum(items_with.c.sitelink_count).label('total_sitelinks_with_properties'))
+             self._scale_count(func.count(items_with.c.qid)).label('total_with_properties'),
+             self._scale_count(func.sum(items_with.c.sitelink_count)).label('total_sitelinks_with_properties'))
+        if self.fill_ids:
+            coverage_q = coverage_q.group_by(items_with.c.fill_id)
 
         # insert into metric_coverage
         coverage_insert = sqlalchemy \
@@ -645,22 +1534,393 @@ class MetricCreator():
         coverage_res = self.db_session.execute(coverage_insert)
         self.db_session.commit()
 
-        return coverage_res
+        return coverage_res.rowcount
+
+    def _get_group_size_counts(self):
+        """
+        {group size: the number of groups of that size} of the combination's grouped humans, read off the rows the job
+        grouped already. those are only the groups at or over the configured threshold, but a smaller group can't
+        change a threshold that only gets raised.
+        """
+        grouped = self.grouped_source.alias('grouped_sizes')
+        sizes_q = self.db_session.query(grouped.c.total, func.count().label('groups')).group_by(grouped.c.total)
+        return {total: groups for total, groups in sizes_q.all()}
+
+    def _apply_threshold_to_grouped(self):
+        """leave out the grouped humans under a threshold the row budget raised"""
+        grouped = self.grouped_source.alias('grouped_unbudgeted')
+        self.grouped_source = sqlalchemy.select([grouped]).where(grouped.c.total >= self.threshold)
+
+    @_time_step
+    def choose_threshold(self):
+        """raise the threshold to the smallest one that keeps the metric rows within the row budget"""
+        size_counts = self._get_group_size_counts()
+        # the budget is per fill
+        row_budget = self.row_budget * len(self.fill_ids) if self.fill_ids else self.row_budget
+        budget_threshold = threshold_for_row_budget(size_counts, row_budget)
+        if budget_threshold is not None and budget_threshold > (self.threshold or 0):
+            log.info(f'{self} raises its threshold from {self.threshold} to {budget_threshold} to write at most '
+                     f'{row_budget} rows')
+            self.threshold = budget_threshold
+            self._apply_threshold_to_grouped()
+        return len(size_counts)
+
+    @_time_step
+    def materialize_humans_with_properties(self):
+        """the one join over the human tables of this job, which coverage and the grouping then read"""
+        humans_q = self.make_humans_with_properties_query()
+        self.humans_source, rowcount = create_temporary_table(self.db_session, 'humans_with_properties', humans_q,
+                                                              index_cols=['qid'])
+        return rowcount
+
+    @_time_step
+    def materialize_grouped_humans(self):
+        """the one group by of this job, which steps one and three then read"""
+        self.make_agg_humans_query()
+        index_cols = ['gender'] + [dim_col.key for dim_col in self.dimension_cols]
+        self.grouped_source, rowcount = create_temporary_table(self.db_session, 'grouped_humans', self.metric_q,
+                                                               index_cols=index_cols)
+        return rowcount
+
+    def _drop_materialized(self):
+        for temp_table_name in ('humans_with_properties', 'grouped_humans'):
+            self.db_session.execute(text(f'DROP TEMPORARY TABLE IF EXISTS {temp_table_name}'))
+        self.grouped_source = None
+
+    def _has_pinned_session(self):
+        """whether db_session keeps its connection between statements, see db.pinned_session_factory"""
+        return isinstance(self.db_session.get_bind(), Connection)
 
     def run(self):
         # can do timing here
-        self.generate_coverage()
+        # the humans are grouped once, into a temporary table that the steps and a row budget's threshold then read,
+        # unless a population group grouped them already. a creator on an unpinned session (e.g. in a test) can't keep
+        # the table between its steps, so each step groups them itself
+        group_once = self.grouped_source is None and \
+                     (self.materialize or self.row_budget is not None or self._has_pinned_session())
+        if group_once:
+            try:
+                # a lattice may already have given us a source of humans
+                if self.materialize and self.humans_source is None:
+                    self.materialize_humans_with_properties()
+                self.materialize_grouped_humans()
+                if self.row_budget is not None:
+                    self.choose_threshold()
+                if not self.skip_coverage:
+                    self.generate_coverage()
+                self.compile()
+            finally:
+                self._drop_materialized()
+        else:
+            # a population group has already chosen, see MetricPopulationGroup.run
+            if not self.skip_coverage:
+                self.generate_coverage()
+            self.compile()
+
+
+
+class MetricLattice():
+    """
+    Runs a lattice root combination and the lower dimensional combinations it contains from one scan of the human
+    tables. The root's qid level rows are materialized into a session scoped temporary table, left joined so that
+    humans missing some of the root's dimensions are still there for the smaller combinations, and without the
+    population filter. Every member's MetricCreator then groups that table (counting distinct qids, because the
+    multi-valued dimensions fan rows out) instead of re-joining the human tables.
+    """
+
+    def __init__(self, root_creator, member_creators):
+        self.root_creator = root_creator
+        self.member_creators = member_creators
+        self.db_session = root_creator.db_session
+        self.counters = {}
+
+    def __str__(self):
+        return f"MetricLattice. root:{self.root_creator}; members:{len(self.member_creators)}"
+
+    @property
+    def creators(self):
+        return [self.root_creator, *self.member_creators]
+
+    @MetricCreator._time_step
+    def materialize_root(self):
+        root_q = self.root_creator.make_humans_with_properties_query(isouter=True)
+        index_cols = ['gender'] + [dim_col.key for dim_col in self.root_creator.dimension_cols]
+        self.humans_source, rowcount = create_temporary_table(self.db_session, 'lattice_root', root_q,
+                                                              index_cols=index_cols)
+        self.db_session.commit()
+        return rowcount
+
+    def run(self):
+        self.materialize_root()
+        try:
+            for creator in self.creators:
+                creator.humans_source = self.humans_source
+                log.info(f'Running lattice member: {creator}')
+                creator.run()
+        finally:
+            self.db_session.execute(text('DROP TEMPORARY TABLE IF EXISTS lattice_root'))
+            lattice_connection = self.db_session.get_bind()
+            self.db_session.close()
+            lattice_connection.close()
+
+
+class MetricPopulationGroup():
+    """
+    Runs the creators of one combination in several population definitions from one scan of the human tables.
+    The qid level rows are materialized without the population filter, and grouped once with a population bucket: the
+    largest population_min_sitelinks a human's sitelink count reaches. The populations nest, so each creator's grouped
+    humans are the sum of the buckets at or over its own minimum.
+    """
+
+    def __init__(self, creators):
+        self.creators = creators
+        self.leader = creators[0]
+        self.db_session = self.leader.db_session
+        self.humans_source = None
+        self.population_grouped = None
+        self.counters = {}
+
+    def __str__(self):
+        return f"MetricPopulationGroup. leader:{self.leader}; populations:{len(self.creators)}"
+
+    def _make_population_bucket(self, sitelink_count_col):
+        min_sitelinks = sorted({MetricCreator.population_min_sitelinks[creator.population_definition]
+                                for creator in self.creators}, reverse=True)
+        return case([(sitelink_count_col >= min_sitelink, min_sitelink) for min_sitelink in min_sitelinks], else_=0)
+
+    @MetricCreator._time_step
+    def materialize_humans(self):
+        humans_q = self.leader.make_humans_with_properties_query(all_populations=True)
+        self.humans_source, rowcount = create_temporary_table(self.db_session, 'population_humans', humans_q,
+                                                              index_cols=['qid'])
+        self.db_session.commit()
+        return rowcount
+
+    @MetricCreator._time_step
+    def materialize_population_grouped(self):
+        source = self.humans_source
+        group_bys = [source.c.gender.label('gender')] + \
+                    [source.c[dim_col.key].label(dim_col.key) for dim_col in self.leader.dimension_cols] + \
+                    [self._make_population_bucket(source.c.sitelink_count).label('population_bucket')]
+        grouped_q = self.db_session.query(*group_bys, func.count(func.distinct(source.c.qid)).label('total')) \
+            .group_by(*group_bys)
+        self.population_grouped, rowcount = create_temporary_table(self.db_session, 'population_grouped', grouped_q,
+                                                                   index_cols=['population_bucket'])
+        self.db_session.commit()
+        return rowcount
+
+    def make_population_grouped_query(self, creator):
+        """a creator's grouped humans, in the columns of MetricCreator.make_agg_humans_query"""
+        grouped = self.population_grouped
+        group_bys = [grouped.c.gender] + [grouped.c[dim_col.key] for dim_col in creator.dimension_cols]
+        total = func.sum(grouped.c.total)
+        grouped_q = sqlalchemy.select([*group_bys, total.label('total')]) \
+            .where(grouped.c.population_bucket >= MetricCreator.population_min_sitelinks[creator.population_definition]) \
+            .group_by(*group_bys)
+        if creator.threshold:
+            grouped_q = grouped_q.having(total >= creator.threshold)
+        return grouped_q
+
+    def run(self):
+        try:
+            self.materialize_humans()
+            self.materialize_population_grouped()
+            for creator in self.creators:
+                creator.humans_source = self.humans_source
+                creator.grouped_source = self.make_population_grouped_query(creator)
+                if creator.row_budget is not None:
+                    creator.choose_threshold()
+                creator.materialize = False  # the group materialized already
+                log.info(f'Running population group member: {creator}')
+                creator.run()
+        finally:
+            for temp_table_name in ('population_humans', 'population_grouped'):
+                self.db_session.execute(text(f'DROP TEMPORARY TABLE IF EXISTS {temp_table_name}'))
+            group_connection = self.db_session.get_bind()
+            self.db_session.close()
+            group_connection.close()
+
+
+class ColumnarMetricCreator(MetricCreator):
+    """
+    Creates the same rows as MetricCreator, but groups an in-memory FillColumns instead of querying the human tables,
+    and bulk-writes the aggregations and metrics.
+    """
+
+    def __init__(self, fill_columns, insert_chunk_size=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.fill_columns = fill_columns
+        self.materialize = False  # nothing to materialize, the fill is already in memory
+        self.insert_chunk_size = insert_chunk_size
+        self.unthresholded_totals = None  # the grouping choose_threshold did, which group_totals then reuses
+
+    def _bulk_insert(self, table, rows):
+        rowcount = bulk_insert_ignore(self.db_session, table, rows, self.insert_chunk_size)
+        self.db_session.commit()
+        return rowcount
+
+    @MetricCreator._time_step
+    def generate_coverage(self):
+        total_with_properties, total_sitelinks_with_properties = self.fill_columns.coverage(
+            self.dimension_properties, self.population_definition)
+        coverage_insert = sqlalchemy \
+            .insert(metric_coverage) \
+            .prefix_with('IGNORE') \
+            .values(fill_id=self.fill_id,
+                    properties_id=self.metric_properties_id,
+                    population_id=self.population_definition.value,
+                    total_with_properties=total_with_properties,
+                    total_sitelinks_with_properties=total_sitelinks_with_properties)
+        coverage_res = self.db_session.execute(coverage_insert)
+        self.db_session.commit()
+        return coverage_res.rowcount
+
+    def _group(self, fill_columns, mask=None, threshold=None):
+        """:return: {(gender, dimension values...): total} with the values decoded like the SQL engine groups them"""
+        keys, totals = fill_columns.groupby(self.dimension_properties, self.population_definition, threshold, mask)
+        return {(int(key_row[0]), *[fill_columns.decode(prop, value)
+                                    for prop, value in zip(self.dimension_properties, key_row[1:])]): int(total)
+                for key_row, total in zip(keys, totals)}
+
+    def group_totals(self):
+        if self.unthresholded_totals is not None:
+            # choose_threshold grouped already
+            return {key: total for key, total in self.unthresholded_totals.items()
+                    if not self.threshold or total >= self.threshold}
+        return self._group(self.fill_columns, threshold=self.threshold)
+
+    def _get_group_size_counts(self):
+        self.unthresholded_totals = self._group(self.fill_columns)
+        sizes, counts = np.unique(list(self.unthresholded_totals.values()), return_counts=True)
+        return {int(size): int(count) for size, count in zip(sizes, counts)}
+
+    def _apply_threshold_to_grouped(self):
+        # group_totals filters by the threshold
+        pass
+
+    def run(self):
+        if self.row_budget is not None:
+            self.choose_threshold()
+        if not self.skip_coverage:
+            self.generate_coverage()
         self.compile()
 
+    @MetricCreator._time_step
+    def compile(self):
+        project_ids = {code: project_id for project_id, code in get_project_wikiencoding_from_id(self.db_session)}
+        project_pos = self.bias_dimension_properties_pids.index(Properties.PROJECT.value) \
+            if Properties.PROJECT in self.dimension_properties else None
+
+        grouped = []
+        for key, total in self.group_totals().items():
+            # like in step three, sitelinks of a project we don't know can not be joined back to an aggregation
+            if project_pos is not None and key[project_pos] not in project_ids:
+                continue
+            grouped.append((key, total))
+        log.info(f'{self} grouped {len(grouped)} aggregations in memory')
+
+        # the bulk equivalent of steps one and two
+        aggregation_ids = register_aggregations(self.db_session,
+                                                bias_property=self.bias_property.value,
+                                                dimension_properties=self.dimension_properties_pids,
+                                                aggregations=[(key[0], list(key[1:])) for key, _ in grouped],
+                                                chunk_size=self.insert_chunk_size,
+                                                properties_id=self.metric_properties_id)
+
+        metric_rows = [{'fill_id': self.fill_id,
+                        'population_id': self.population_definition.value,
+                        'properties_id': self.metric_properties_id,
+                        'aggregations_id': aggregations_id,
+                        'bias_value': key[0],
+                        'total': total} for (key, total), aggregations_id in zip(grouped, aggregation_ids)]
+        return self._bulk_insert(metric, metric_rows)
+
+
+
+class DuckMetricCreator(ColumnarMetricCreator):
+    """
+    Creates the same rows as MetricCreator, but groups the fill's DuckDB copy (see duck.FillDuck), so MySQL only gets
+    the bulk-written aggregations, metrics and coverage.
+    """
+
+    def __init__(self, fill_duck, **kwargs):
+        super().__init__(fill_columns=fill_duck, **kwargs)
+
+    def __str__(self):
+        return f"DuckDB {super().__str__()}"
 
+    def _group(self, fill_duck, mask=None, threshold=None):
+        rows = fill_duck.groupby(self.dimension_properties, self.population_definition, threshold)
+        return {(int(row[0]), *row[1:-1]): int(row[-1]) for row in rows}
+
+
+class IncrementalMetricCreator(ColumnarMetricCreator):
+    """
+    Creates the metric of a fill as the previous fill's metric of the same combination, plus the difference made by
+    the humans that changed between the two fills. Only the changed humans get grouped, in both fills.
+    """
+
+    def __init__(self, previous_fill_columns, changed_masks, **kwargs):
+        """
+        :param previous_fill_columns: the FillColumns of the previous fill, whose metric has to be complete
+        :param changed_masks: fill_columns.changed_masks(previous_fill_columns), shared between a fill's jobs
+        """
+        super().__init__(**kwargs)
+        self.previous_fill_columns = previous_fill_columns
+        self.changed, self.previous_changed = changed_masks
+
+    def __str__(self):
+        return f"Incremental {super().__str__()} from fill {self.previous_fill_columns.fill_id}"
+
+    def _get_previous_totals(self):
+        previous_q = self.db_session.query(metric.bias_value, metric_aggregations_j.aggregations, metric.total) \
+            .join(metric_aggregations_j, metric.aggregations_id == metric_aggregations_j.id) \
+            .filter(metric.fill_id == self.previous_fill_columns.fill_id) \
+            .filter(metric.population_id == self.population_definition.value) \
+            .filter(metric.properties_id == self.metric_properties_id)
+        return {(bias_value, *aggregations): total for bias_value, aggregations, total in previous_q.all()}
+
+    def group_totals(self):
+        delta = self._group(self.fill_columns, mask=self.changed)
+        for key, previous_total in self._group(self.previous_fill_columns, mask=self.previous_changed).items():
+            delta[key] = delta.get(key, 0) - previous_total
+        previous_totals = self._get_previous_totals()
+        log.info(f'{self} {int(self.changed.sum())} changed humans make {len(delta)} aggregation deltas, on '
+                 f'{len(previous_totals)} previous aggregations')
+
+        totals = dict(previous_totals)
+        for key, key_delta in delta.items():
+            totals[key] = totals.get(key, 0) + key_delta
+
+        if self.threshold:
+            # an aggregation that was under the threshold has no previous total to add its delta to
+            crossing = [key for key, key_delta in delta.items() if key_delta > 0 and key not in previous_totals]
+            if crossing:
+                log.info(f'{self} {len(crossing)} aggregations may have crossed the threshold, recomputing them')
+                crossing_mask = self.fill_columns.cells_mask(self.dimension_properties, crossing)
+                crossing_totals = self._group(self.fill_columns, mask=crossing_mask)
+                for key in crossing:
+                    totals[key] = crossing_totals[key]
+            return {key: total for key, total in totals.items() if total >= self.threshold}
+        else:
+            return {key: total for key, total in totals.items() if total > 0}
 
 if __name__ == '__main__':
-    create_execute = sys.argv[1] if len(sys.argv) >= 2 else None
-    dump_date = sys.argv[2] if len(sys.argv) >= 3 else None
+    parser = argparse.ArgumentParser(description='create the metric jobs of a fill, or execute them')
+    parser.add_argument('create_execute', nargs='?', choices=['create', 'execute', 'pool', 'preview'])
+    parser.add_argument('dump_date', nargs='?', default=None)
+    parser.add_argument('--procs', type=int, default=None, help='worker processes for pool, defaults to cpu count')
+    parser.add_argument('--fill_dates', nargs='+', default=None,
+                        help='several dump dates to create or execute the jobs of in one pass, e.g. for a backfill')
+    args = parser.parse_args()
+    create_execute, dump_date = args.create_execute, args.dump_date
     this_pid = os.getpid()
     log.info(f'PID:{this_pid} Specified dump date: {dump_date}. Create or execute is: {create_execute}')
-    mf = MetricFactory(config=os.environ['HUMANIKI_YAML_CONFIG'], fill_date=dump_date)
-    if create_execute:
+    mf = MetricFactory(config=os.environ['HUMANIKI_YAML_CONFIG'], fill_date=dump_date, fill_dates=args.fill_dates)
+    if create_execute in ('pool', 'preview'):
+        log.info(f"Attempting to run {create_execute} on metrics factory")
+        getattr(mf, create_execute)(procs=args.procs)
+    elif create_execute:
         log.info(f"Attempting to run {create_execute} on metrics factory")
         getattr(mf, create_execute)()
 
@@ -1,25 +1,35 @@
 import datetime
+import gzip
+import heapq
+import io
 import json
 import os
+import re
+import shutil
 import sqlalchemy
 import sys
+import tempfile
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 from os import listdir
 
-from sqlalchemy import text
+from sqlalchemy import text, func
 from sqlalchemy.orm.attributes import flag_modified
 import humaniki_schema
 from humaniki_schema.queries import get_latest_fill_id, get_exact_fill_id, create_new_fill, \
-    update_fill_detail, get_exact_fill, determine_fill_item
+    update_fill_detail, get_exact_fill, determine_fill_item, get_fill_by_id, get_previous_active_fill_id
 from humaniki_schema.schema import fill, human, human_country, human_occupation, human_property, human_sitelink, label, \
     metric, metric_properties_j, metric_properties_n, metric_aggregations_j, metric_aggregations_n, metric_coverage, \
-    project, label_misc
+    project, label_misc, occupation_parent, HUMAN_FACT_UNKNOWN_PROJECT
 import humaniki_schema.utils as hs_utils
 from humaniki_schema.log import get_logger
 
 log = get_logger()
 
-from humaniki_schema.db import session_factory
+from humaniki_schema.db import session_factory, local_infile_session_factory
 
 
 class HumanikiDataInserter():
@@ -29,42 +39,89 @@ class HumanikiDataInserter():
         self.overwrite = self.config_insertion['overwrite'] if 'overwrite' in self.config_insertion else False
         self.only_files = self.config_insertion['only_files'] if 'only_files' in self.config_insertion else None
         self.insert_strategy = insert_strategy if insert_strategy is not None else "infile"
+        self.build_human_fact = self.config_insertion.get('build_human_fact', False)
+        self.collect_stats = self.config_insertion.get('collect_stats', False)
+        self.stats_top_k = self.config_insertion.get('stats_top_k', 20)
+        self.insert_concurrency = self.config_insertion.get('insert_concurrency', 3)
+        self.chunk_size_mb = self.config_insertion.get('chunk_size_mb', 256)
+        self.sort_csvs = self.config_insertion.get('sort_csvs', False)
+        self.sort_buffer_mb = self.config_insertion.get('sort_buffer_mb', 1024)
         self.dump_date = hs_utils.make_dump_date_from_str(dump_date) if dump_date else None
         self.dump_subset = dump_subset
         self.dump_date_str = None
         self.fill_id = None
         self.detection_type = None
-        self.db_session = session_factory()
+        # gzipped csvs are streamed from this host, which needs connections that allow LOAD DATA LOCAL INFILE
+        self.local_infile = self.config_insertion.get('local_infile', False)
+        self.session_factory = local_infile_session_factory if self.local_infile else session_factory
+        self.bulk_load = self.config_insertion.get('bulk_load', False)
+        # in bulk load mode, the csv rows each table's loads inserted, and the duplicates they skipped, for
+        # verify_bulk_load
+        self.load_records = {}
+        self.load_skipped = {}
+        self.db_session = self.make_session()
         # order is important becuse of foreign key constraint
         self.csvs = None
+        self.csv_paths = None  # {csv: the file its table is loaded from}
+        # sort_columns are the table's primary key after fill_id, the order sort_csvs_by_primary_key puts the rows in.
+        # only integer key columns are sorted by: a string would have to be in the column's collation order, so
+        # human_sitelink is sorted by its human_id prefix only, which still appends to the clustered index a human at a
+        # time. a label may be quoted over several lines, so label isn't sorted
         self.CSV_NA_VALUE = r'\N'
         self.table_column_map = {
             'human':
                 {"insert_columns": ['qid', 'gender', 'year_of_birth', 'sitelink_count'],
+                 "sort_columns": ['qid'],
                  "extra_const_columns": {},
                  "escaping_options": ""},
             'human_country':
                 {"insert_columns": ['human_id', 'country'],
+                 "sort_columns": ['human_id', 'country'],
                  "extra_const_columns": {},
                  "escaping_options": ""},
             'human_occupation':
                 {"insert_columns": ['human_id', 'occupation'],
+                 "sort_columns": ['human_id', 'occupation'],
                  "extra_const_columns": {},
                  "escaping_options": ""},
             'human_sitelink':
                 {"insert_columns": ['human_id', 'sitelink'],
+                 "sort_columns": ['human_id'],
                  "extra_const_columns": {},
                  "escaping_options": ""},
             'label':
                 {"insert_columns": ['qid', 'label'],
+                 "sort_columns": None,
                  "extra_const_columns": {'lang': 'en'},
                  "escaping_options": """OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\'"""},
             'occupation_parent':
                 {"insert_columns": ['occupation', 'parent'],
+                 "sort_columns": ['occupation', 'parent'],
                  "extra_const_columns": {},
                  "escaping_options": ""},
         }
 
+    def make_session(self):
+        """
+        in bulk load mode a session keeps its one connection, with unique and foreign key checks off, so that the
+        loads don't check row by row what verify_bulk_load checks once afterwards
+        """
+        if not self.bulk_load:
+            return self.session_factory()
+        session = self.session_factory(bind=self.session_factory.kw['bind'].connect())
+        session.execute(text('SET SESSION unique_checks = 0, foreign_key_checks = 0'))
+        return session
+
+    def close_session(self, session):
+        """restore the checks before the connection goes back to the pool"""
+        if self.bulk_load:
+            session.execute(text('SET SESSION unique_checks = 1, foreign_key_checks = 1'))
+            connection = session.bind
+            session.close()
+            connection.close()
+        else:
+            session.close()
+
     def detect_fill_date(self):
         if self.dump_date is not None:
             self.detection_type = 'explicit'
@@ -83,14 +140,21 @@ class HumanikiDataInserter():
 
         all_files = os.listdir(self.csv_dir)
         allowable_csvs = [f"{table_name}.csv" for table_name in self.table_column_map.keys()]
-        extant_csvs = [f for f in all_files if f.endswith('.csv')]
+        extant_csvs = [f for f in all_files if f.endswith('.csv') or f.endswith('.csv.gz')]
         self.csvs = []
         for csv in extant_csvs:
-            if csv not in allowable_csvs:
+            if csv.endswith('.gz') and csv[:-len('.gz')] in extant_csvs:
+                log.info(f'Using the uncompressed CSV instead of {csv}')
+            elif csv.split('.csv')[0] + '.csv' not in allowable_csvs:
                 log.info(f'Not an allowable CSV: {csv}')
             else:
                 self.csvs.append(csv)
         assert len(self.csvs) == len(allowable_csvs)
+        self.csv_paths = {csv: os.path.join(self.csv_dir, csv) for csv in self.csvs}
+        if any(csv.endswith('.gz') for csv in self.csvs) and not self.local_infile:
+            raise ValueError('Gzipped CSVs are streamed with LOAD DATA LOCAL INFILE, set insertion.local_infile')
+        if self.insert_strategy == 'chunked' and not self.local_infile:
+            raise ValueError('Chunks are streamed with LOAD DATA LOCAL INFILE, set insertion.local_infile')
 
     def create_fill_item(self):
         prev_latest_fill_id, prev_latest_fill_dt = determine_fill_item(self.db_session, self.dump_date)
@@ -100,8 +164,12 @@ class HumanikiDataInserter():
             a_fill = get_exact_fill(self.db_session, prev_latest_fill_dt)
             csvs_in_detail = 'extant_csvs' in a_fill.detail
 
-            # overwrite if set, unless we have already a record of adding the csvs
-            if self.overwrite and csvs_in_detail:
+            # overwrite if set, unless we have already a record of adding the csvs. a chunked insert that stopped part
+            # way resumes into its fill instead, see insert_csvs_chunked
+            resumes_chunks = self.insert_strategy == 'chunked' and has_unloaded_chunks(a_fill.detail)
+            if resumes_chunks:
+                log.info(f'previous fill item found for {self.dump_date} with csvs left to load, resuming it')
+            if self.overwrite and csvs_in_detail and not resumes_chunks:
                 # mark as inactive create new
                 log.info(f'previous fill item found for {self.dump_date} and overwriting')
                 update_fill_detail(self.db_session, prev_latest_fill_id, 'active', False)
@@ -117,38 +185,290 @@ class HumanikiDataInserter():
             self.fill_id = new_fill.id
 
         # finally
-        update_fill_detail(self.db_session, self.fill_id, 'extant_csvs', self.csvs)
+        extant_csvs = self.csvs
+        if self.insert_strategy == 'chunked':
+            # {csv: its loaded chunks}, keeping what an earlier run of this fill already loaded
+            previous_extant_csvs = get_fill_by_id(self.db_session, self.fill_id).detail.get('extant_csvs')
+            previous_extant_csvs = previous_extant_csvs if isinstance(previous_extant_csvs, dict) else {}
+            extant_csvs = {csv: previous_extant_csvs.get(csv, []) for csv in self.csvs}
+        update_fill_detail(self.db_session, self.fill_id, 'extant_csvs', extant_csvs)
         self.db_session.commit() # release the lock hopefully for orchestrate.py
 
 
-    def execute_single_infile(self, csv_f, csv_table_name, column_insertion_order, extra_const_cols, escaping_options):
+    def sort_csvs_by_primary_key(self):
+        """
+        sort the csvs with sort_columns by their table's primary key into a sorted/ directory, which the loading then
+        reads them from, so that InnoDB appends to the clustered indexes instead of splitting pages all over them. the
+        csvs sort in parallel, each with an external merge sort that holds at most sort_buffer_mb of it in memory.
+        which csvs are sorted by which columns is recorded in fill.detail['sorted_csvs'], and a rerun of the fill
+        reuses them.
+        """
+        sorted_dir = os.path.join(self.csv_dir, 'sorted')
+        os.makedirs(sorted_dir, exist_ok=True)
+        sorted_csvs = get_fill_by_id(self.db_session, self.fill_id).detail.get('sorted_csvs', {})
+        sort_args = {}
+        for csv in self.csvs:
+            table_columns = self.table_column_map[csv.split('.csv')[0]]
+            if table_columns['sort_columns'] is None:
+                continue
+            self.csv_paths[csv] = os.path.join(sorted_dir, csv)
+            if sorted_csvs.get(csv) == table_columns['sort_columns'] and os.path.exists(os.path.join(sorted_dir, csv)):
+                log.info(f'{csv} is already sorted')
+                continue
+            key_positions = [table_columns['insert_columns'].index(col) for col in table_columns['sort_columns']]
+            sort_args[csv] = (os.path.join(self.csv_dir, csv), os.path.join(sorted_dir, csv), key_positions,
+                              self.sort_buffer_mb * 1024 * 1024, sorted_dir)
+        sort_start = time.time()
+        with ProcessPoolExecutor(max_workers=self.insert_concurrency) as executor:
+            sort_futures = {csv: executor.submit(external_sort_csv, *args) for csv, args in sort_args.items()}
+            for csv, sort_future in sort_futures.items():
+                log.info(f'Sorted the {sort_future.result()} lines of {csv}')
+                sorted_csvs[csv] = self.table_column_map[csv.split('.csv')[0]]['sort_columns']
+        log.info(f'Sorting the csvs took {time.time() - sort_start} seconds')
+        update_fill_detail(self.db_session, self.fill_id, 'sorted_csvs', sorted_csvs)
+
+    def execute_single_infile(self, csv_f, csv_table_name, column_insertion_order, extra_const_cols, escaping_options,
+                              session=None, local=False):
+        """:return: the number of rows inserted"""
+        session = session if session is not None else self.db_session
         column_list_str = ','.join(column_insertion_order)
         # TODO supports just one extra const col for now
         extra_const_str = (',' + [f"{k}='{v}'" for k, v in extra_const_cols.items()][0]) if extra_const_cols else ''
         infile_sql = f"""
-        LOAD DATA INFILE '{csv_f}' IGNORE
+        LOAD DATA {'LOCAL ' if local else ''}INFILE '{csv_f}' IGNORE
             INTO TABLE `{csv_table_name}` FIELDS TERMINATED BY ',' {escaping_options}
                 ({column_list_str})
                 set fill_id={self.fill_id} {extra_const_str};
         """
         log.info(infile_sql)
-        self.db_session.execute(text(infile_sql))
+        infile_res = session.execute(text(infile_sql))
+        if self.bulk_load:
+            self.count_load_records(csv_table_name, session)
+        return infile_res.rowcount
+
+    def count_load_records(self, csv_table_name, session):
+        """
+        add the rows the session's last LOAD DATA inserted to the table's load_records, which are the csv rows it read
+        less the duplicates IGNORE skipped, and those to its load_skipped
+        """
+        # the mysqlclient connection under the pool's proxy, which has an info dict of its own
+        dbapi_connection = session.connection().connection.connection
+        load_info = dbapi_connection.info() or ''
+        records_match = re.search(r'Records: (\d+)', load_info)
+        skipped_match = re.search(r'Skipped: (\d+)', load_info)
+        if records_match is None or skipped_match is None:
+            raise ValueError(f'LOAD DATA into {csv_table_name} reported no record count: {load_info!r}')
+        skipped = int(skipped_match.group(1))
+        self.load_records[csv_table_name] = self.load_records.get(csv_table_name, 0) + \
+                                            int(records_match.group(1)) - skipped
+        self.load_skipped[csv_table_name] = self.load_skipped.get(csv_table_name, 0) + skipped
+
+    def execute_streamed_infile(self, csv_in, csv_table_name, session=None):
+        """load a binary file object of csv rows, from this host through a named pipe, without writing it anywhere"""
+        table_columns = self.table_column_map[csv_table_name]
+        with streamed_through_fifo(csv_in) as fifo_f:
+            return self.execute_single_infile(fifo_f, csv_table_name, table_columns['insert_columns'],
+                                              table_columns['extra_const_columns'], table_columns['escaping_options'],
+                                              session=session, local=True)
+
+    def execute_csv_infile(self, csv_f, csv_table_name, session=None):
+        """a csv is loaded by the server from its path, a gzipped csv is decompressed here and streamed to it"""
+        if csv_f.endswith('.gz'):
+            with gzip.open(csv_f, 'rb') as csv_in:
+                return self.execute_streamed_infile(csv_in, csv_table_name, session=session)
+        table_columns = self.table_column_map[csv_table_name]
+        return self.execute_single_infile(csv_f, csv_table_name, table_columns['insert_columns'],
+                                          table_columns['extra_const_columns'], table_columns['escaping_options'],
+                                          session=session)
 
     def insert_csvs_infile(self):
         for csv in self.csvs:
-            csv_f = os.path.join(self.csv_dir, csv)
+            csv_f = self.csv_paths[csv]
+            csv_table_name = csv.split('.csv')[0]
+            insert_start = time.time()
+            self.execute_csv_infile(csv_f, csv_table_name)
+            insert_end = time.time()
+            log.info(f'Inserting {csv_table_name} took {insert_end - insert_start} seconds')
+
+    def insert_csvs_chunked(self):
+        """
+        load each csv in line aligned chunks of chunk_size_mb, committing each one and recording it (offset, length,
+        rows and crc32) in fill.detail['extant_csvs'], and each csv once all of it loaded in fill.detail['loaded_csvs'],
+        so that a retry of the fill resumes after the chunks that already landed instead of reloading the whole table.
+        the chunks load in order on the one session: recording a chunk updates the fill row, which would wait on the
+        shared locks the foreign keys of any other in flight load hold on it. so the loaded chunks are always the start
+        of the csv, which a retry seeks past without reading it back. a gzipped csv can't be seeked though, its loaded
+        chunks are decompressed again, and its offsets are into its decompressed rows.
+        the chunks are streamed from memory with LOAD DATA LOCAL INFILE rather than written out next to the csvs.
+        assumes one row per line, which is how wdtk writes its csvs.
+        """
+        fill_detail = get_fill_by_id(self.db_session, self.fill_id).detail
+        extant_csvs = fill_detail['extant_csvs']
+        loaded_csvs = fill_detail.get('loaded_csvs', [])
+        for csv in self.csvs:
+            csv_f = self.csv_paths[csv]
             csv_table_name = csv.split('.csv')[0]
-            column_insertion_order = self.table_column_map[csv_table_name]['insert_columns']
-            extra_const_cols = self.table_column_map[csv_table_name]['extra_const_columns']
-            escaping_options = self.table_column_map[csv_table_name]['escaping_options']
+            loaded_chunks = extant_csvs[csv]
+            if self.bulk_load:
+                self.load_records[csv_table_name] = self.load_records.get(csv_table_name, 0) + \
+                                                    sum(chunk['rows'] for chunk in loaded_chunks)
+            if csv in loaded_csvs:
+                log.info(f'{csv} is already loaded')
+                continue
+            resume_offset = loaded_chunks[-1]['offset'] + loaded_chunks[-1]['length'] if loaded_chunks else 0
             insert_start = time.time()
-            self.execute_single_infile(csv_f, csv_table_name, column_insertion_order, extra_const_cols,
-                                       escaping_options)
+            csv_chunks = iter_csv_chunks(csv_f, int(self.chunk_size_mb * 1024 * 1024), start_offset=resume_offset)
+            for chunk_i, (offset, chunk_data) in enumerate(csv_chunks, start=len(loaded_chunks)):
+                rowcount = self.execute_streamed_infile(io.BytesIO(chunk_data), csv_table_name)
+                self.db_session.commit()
+                loaded_chunks.append({'offset': offset, 'length': len(chunk_data), 'rows': rowcount,
+                                      'checksum': zlib.crc32(chunk_data)})
+                update_fill_detail(self.db_session, self.fill_id, 'extant_csvs', extant_csvs)
+                log.info(f'Inserted chunk {chunk_i} of {csv_table_name}, {rowcount} rows from offset {offset}')
+            loaded_csvs.append(csv)
+            update_fill_detail(self.db_session, self.fill_id, 'loaded_csvs', loaded_csvs)
             insert_end = time.time()
             log.info(f'Inserting {csv_table_name} took {insert_end - insert_start} seconds')
 
+    def insert_single_csv_own_session(self, csv):
+        """load one csv on its own pooled connection, so that several can load at once"""
+        csv_f = self.csv_paths[csv]
+        csv_table_name = csv.split('.csv')[0]
+        session = self.make_session()
+        try:
+            insert_start = time.time()
+            rowcount = self.execute_csv_infile(csv_f, csv_table_name, session=session)
+            session.commit()
+            insert_end = time.time()
+        finally:
+            self.close_session(session)
+        log.info(f'Inserting {rowcount} {csv_table_name} rows took {insert_end - insert_start} seconds')
+        return csv_table_name, {'seconds': round(insert_end - insert_start, 3), 'rows': rowcount}
+
+    def insert_csvs_concurrent(self):
+        """
+        the tables only reference fill, not each other, so their csvs can load in parallel, at most
+        insert_concurrency at a time. the biggest csvs start first, so the longest load isn't left until last.
+        """
+        csvs = sorted(self.csvs, key=lambda csv: os.path.getsize(self.csv_paths[csv]), reverse=True)
+        with ThreadPoolExecutor(max_workers=self.insert_concurrency) as executor:
+            insert_timings = dict(executor.map(self.insert_single_csv_own_session, csvs))
+        # only now, since the loads hold shared locks on the fill row through their foreign keys
+        update_fill_detail(self.db_session, self.fill_id, 'insert_timings', insert_timings)
+
+    def end_bulk_load(self):
+        self.db_session.commit()
+        self.db_session.execute(text('SET SESSION unique_checks = 1, foreign_key_checks = 1'))
+
+    def verify_bulk_load(self):
+        """
+        what the relaxed checks let through, in one query: whether the fill the rows reference exists, the rows whose
+        human is missing, and whether each table of the fill has the rows its loads inserted. the duplicate csv rows
+        LOAD DATA IGNORE skipped are recorded, but don't fail the fill, as they would with the checks on. label is
+        left out, its rows are shared between fills.
+        any of the others fails the fill.
+        """
+        orphans_sql = {f'orphan_{name}': f"""(SELECT COUNT(*) FROM {table} t LEFT JOIN human h
+                                               ON h.fill_id = t.fill_id AND h.qid = t.human_id
+                                               WHERE t.fill_id = {self.fill_id} AND h.qid IS NULL)"""
+                       for name, table in [('sitelinks', 'human_sitelink'), ('countries', 'human_country'),
+                                           ('occupations', 'human_occupation')]}
+        fill_tables = {table.__tablename__ for table in (human, human_country, human_occupation, human_sitelink,
+                                                         occupation_parent)}
+        counted_tables = [table_name for table_name in self.load_records if table_name in fill_tables]
+        rows_sql = {f'rows_{table_name}': f"(SELECT COUNT(*) FROM {table_name} WHERE fill_id = {self.fill_id})"
+                    for table_name in counted_tables}
+        verify_sql = f"""
+        SELECT (SELECT COUNT(*) FROM fill WHERE id = {self.fill_id}) AS fill_rows,
+               {', '.join(f'{check_sql} AS {name}' for name, check_sql in {**orphans_sql, **rows_sql}.items())};"""
+        verify_start = time.time()
+        integrity = dict(self.db_session.execute(text(verify_sql)).fetchone().items())
+        integrity.update({f'records_{table_name}': self.load_records[table_name] for table_name in counted_tables})
+        integrity.update({f'skipped_{table_name}': self.load_skipped.get(table_name, 0)
+                          for table_name in counted_tables})
+        log.info(f'Verifying fill {self.fill_id} took {time.time() - verify_start} seconds: {integrity}')
+        if integrity['fill_rows'] != 1:
+            raise ValueError(f'Fill {self.fill_id} failed verification after bulk loading: {integrity}')
+        # recorded before failing, so that the fill shows what went wrong
+        update_fill_detail(self.db_session, self.fill_id, 'integrity', integrity)
+        orphans = {k: v for k, v in integrity.items() if k.startswith('orphan') and v}
+        count_mismatches = {table_name: (integrity[f'rows_{table_name}'], integrity[f'records_{table_name}'])
+                            for table_name in counted_tables
+                            if integrity[f'rows_{table_name}'] != integrity[f'records_{table_name}']}
+        if orphans or count_mismatches:
+            raise ValueError(f'Fill {self.fill_id} failed verification after bulk loading, rows of missing humans: '
+                             f'{orphans}, (rows, inserted rows) of tables: {count_mismatches}')
+
     def validate(self):
-        pass
+        if self.bulk_load:
+            self.verify_bulk_load()
+
+    def collect_fill_stats(self):
+        """
+        the fill's row counts per table, distinct and most frequent values per dimension, and how many values the
+        multi-valued dimensions have per human, into fill.detail['stats']. metric generation reads them instead of
+        scanning the human tables again, see MetricFactory._get_dimension_cardinalities.
+        """
+        stats_start = time.time()
+        tables = {'human': human, 'human_country': human_country, 'human_occupation': human_occupation,
+                  'human_sitelink': human_sitelink, 'label': label, 'occupation_parent': occupation_parent}
+        rows = {table_name: self.db_session.query(func.count()).select_from(table)
+                    .filter(table.fill_id == self.fill_id).scalar()
+                for table_name, table in tables.items()}
+
+        value_cols = {hs_utils.Properties.GENDER: (human.gender, human.fill_id),
+                      hs_utils.Properties.PROJECT: (human_sitelink.sitelink, human_sitelink.fill_id),
+                      hs_utils.Properties.CITIZENSHIP: (human_country.country, human_country.fill_id),
+                      hs_utils.Properties.OCCUPATION: (human_occupation.occupation, human_occupation.fill_id),
+                      hs_utils.Properties.DATE_OF_BIRTH: (human.year_of_birth, human.fill_id),
+                      hs_utils.Properties.DATE_OF_DEATH: (human.year_of_death, human.fill_id)}
+        distinct, top = {}, {}
+        for prop, (value_col, fill_id_col) in value_cols.items():
+            prop_name = prop.name.lower()
+            distinct[prop_name] = self.db_session.query(func.count(func.distinct(value_col))) \
+                .filter(fill_id_col == self.fill_id).scalar()
+            top_q = self.db_session.query(value_col, func.count().label('total')) \
+                .filter(fill_id_col == self.fill_id) \
+                .filter(value_col.isnot(None)) \
+                .group_by(value_col) \
+                .order_by(func.count().desc()) \
+                .limit(self.stats_top_k)
+            top[prop_name] = [[value, total] for value, total in top_q.all()]
+
+        fan_out = {}
+        for fan_out_name, (join_table, value_col) in {'sitelinks_per_human': (human_sitelink, human_sitelink.sitelink),
+                                                      'citizenships_per_human': (human_country, human_country.country),
+                                                      'occupations_per_human': (human_occupation,
+                                                                                human_occupation.occupation)}.items():
+            per_human = self.db_session.query(func.count(value_col).label('value_count')) \
+                .filter(join_table.fill_id == self.fill_id) \
+                .group_by(join_table.human_id) \
+                .subquery('per_human')
+            humans_with, mean, maximum = self.db_session.query(func.count(), func.avg(per_human.c.value_count),
+                                                               func.max(per_human.c.value_count)).one()
+            fan_out[fan_out_name] = {'humans_with': humans_with,
+                                     'mean': float(mean) if mean is not None else 0,
+                                     'max': maximum or 0}
+
+        stats = {'rows': rows, 'distinct': distinct, 'top': top, 'fan_out': fan_out}
+        self.check_fill_stats(stats)
+        update_fill_detail(self.db_session, self.fill_id, 'stats', stats)
+        log.info(f'Collecting the stats of fill {self.fill_id} took {time.time() - stats_start} seconds: {rows}')
+
+    def check_fill_stats(self, stats):
+        """warn about tables that shrank to less than half of the previous fill's, usually a truncated csv"""
+        fill_date = get_fill_by_id(self.db_session, self.fill_id).date
+        previous_fill_id, _ = get_previous_active_fill_id(self.db_session, fill_date)
+        if previous_fill_id is None:
+            return
+        previous_stats = get_fill_by_id(self.db_session, previous_fill_id).detail.get('stats')
+        if not previous_stats:
+            return
+        for table_name, rowcount in stats['rows'].items():
+            previous_rowcount = previous_stats['rows'].get(table_name)
+            if previous_rowcount and rowcount < previous_rowcount / 2:
+                log.warning(f'Fill {self.fill_id} has {rowcount} {table_name} rows, fill {previous_fill_id} had '
+                            f'{previous_rowcount}')
 
     def create_occupation_superclasses(self, superclass_levels=1):
         """update the human_occupation table for fill by looking into the occupation_parent table for the superclasses,
@@ -218,10 +538,49 @@ class HumanikiDataInserter():
         insert_end = time.time()
         log.info(f'Inserting superclass_sql took {insert_end - insert_start} seconds')
 
+    def create_human_fact(self):
+        """
+        join the fill's human, human_sitelink and human_country once, into human_fact, so that the metric jobs don't
+        each have to. sitelinks are stored as their project's id. sitelinks to projects we don't know are kept as
+        HUMAN_FACT_UNKNOWN_PROJECT: step three of metric generation drops their cells anyway, but like in the human
+        tables a human with only those still has sitelinks, for the coverage and the population filters.
+        """
+        human_fact_sql = f"""
+        INSERT IGNORE INTO human_fact(fill_id, project_id, country, qid, gender, year_of_birth, year_of_death,
+                                      sitelink_count)
+        SELECT h.fill_id,
+               CASE WHEN hs.human_id IS NULL THEN 0 ELSE COALESCE(p.id, {HUMAN_FACT_UNKNOWN_PROJECT}) END AS project_id,
+               COALESCE(hc.country, 0) AS country,
+               h.qid,
+               h.gender,
+               h.year_of_birth,
+               h.year_of_death,
+               h.sitelink_count
+        FROM human h
+                 LEFT JOIN human_sitelink hs
+                           ON h.qid = hs.human_id AND h.fill_id = hs.fill_id
+                 LEFT JOIN project p
+                           ON p.code = hs.sitelink
+                 LEFT JOIN human_country hc
+                           ON h.qid = hc.human_id AND h.fill_id = hc.fill_id
+        WHERE h.fill_id = {self.fill_id}
+          AND h.gender IS NOT NULL
+        ORDER BY project_id, country, h.qid;"""
+        log.info(human_fact_sql)
+        insert_start = time.time()
+        human_fact_res = self.db_session.execute(text(human_fact_sql))
+        self.db_session.commit()
+        insert_end = time.time()
+        log.info(f'Inserting {human_fact_res.rowcount} human_fact rows took {insert_end - insert_start} seconds')
+        # lets the metric generation know that the fill's human_fact is complete
+        update_fill_detail(self.db_session, self.fill_id, 'human_fact', human_fact_res.rowcount)
+
     def post_insert_hook(self):
         log.info('executing post_insert_hook')
         # TODO turn on occupation superclassing when performance is fixed
         # self.create_occupation_superclasses()
+        if self.build_human_fact:
+            self.create_human_fact()
         self.db_session.commit()
         self.db_session.expire_all()
         log.info('finished post_insert_tasks')
@@ -231,16 +590,134 @@ class HumanikiDataInserter():
         self.detect_fill_date()
         self.validate_extant_csvs()
         self.create_fill_item()
+        if self.sort_csvs:
+            self.sort_csvs_by_primary_key()
         if self.insert_strategy == 'infile':
             self.insert_csvs_infile()
+        elif self.insert_strategy == 'concurrent':
+            self.insert_csvs_concurrent()
+        elif self.insert_strategy == 'chunked':
+            self.insert_csvs_chunked()
         else:
             raise ValueError("No valid insertion strategy provided")
+        if self.bulk_load:
+            self.end_bulk_load()
         self.validate()
+        if self.collect_stats:
+            self.collect_fill_stats()
         self.post_insert_hook()
         run_end = time.time()
         log.info(f'Running took {run_end - run_start}')
 
 
+def open_csv(csv_f):
+    return gzip.open(csv_f, 'rb') if csv_f.endswith('.gz') else open(csv_f, 'rb')
+
+
+@contextmanager
+def streamed_through_fifo(source, copy_bytes=1024 * 1024):
+    """
+    a named pipe, that a thread copies the binary file object source into, for LOAD DATA LOCAL INFILE to read as if it
+    were a file. raises what the copying raised, so that a corrupt source isn't taken for a short one.
+    """
+    fifo_dir = tempfile.mkdtemp(prefix='humaniki_')
+    fifo_f = os.path.join(fifo_dir, 'stream.csv')
+    os.mkfifo(fifo_f)
+    feed_errors = []
+
+    def feed():
+        try:
+            with open(fifo_f, 'wb') as fifo_out:
+                shutil.copyfileobj(source, fifo_out, copy_bytes)
+        except Exception as e:
+            feed_errors.append(e)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        yield fifo_f
+    finally:
+        feeder.join(timeout=1)
+        while feeder.is_alive():
+            # the load failed before opening the pipe, or stopped reading it. opening and closing its read end lets
+            # the feeder's open or write return
+            os.close(os.open(fifo_f, os.O_RDONLY | os.O_NONBLOCK))
+            feeder.join(timeout=1)
+        shutil.rmtree(fifo_dir)
+    if feed_errors:
+        raise feed_errors[0]
+
+
+def csv_sort_key(line, key_positions):
+    """the integer key fields of a csv line"""
+    fields = line.split(b',')
+    return tuple(int(fields[pos]) for pos in key_positions)
+
+
+def external_sort_csv(csv_f, sorted_f, key_positions, buffer_bytes, tmp_dir):
+    """
+    sort the lines of csv_f by the fields at key_positions into sorted_f: runs of about buffer_bytes are sorted in
+    memory and written to temporary files, which are then merged. gzipped in, gzipped out. the sort is stable, lines
+    with the same key stay in the order they had in csv_f.
+    :return: the number of lines
+    """
+    run_dir = tempfile.mkdtemp(prefix='humaniki_sort_', dir=tmp_dir)
+    sort_key = lambda line: csv_sort_key(line, key_positions)
+    try:
+        run_fs, lines = [], 0
+        with open_csv(csv_f) as csv_in:
+            while True:
+                run = csv_in.readlines(buffer_bytes)
+                if not run:
+                    break
+                if not run[-1].endswith(b'\n'):
+                    run[-1] += b'\n'
+                run.sort(key=sort_key)
+                run_f = os.path.join(run_dir, f'run.{len(run_fs):05d}')
+                with open(run_f, 'wb') as run_out:
+                    run_out.writelines(run)
+                run_fs.append(run_f)
+                lines += len(run)
+        tmp_sorted_f = f'{sorted_f}.tmp'
+        run_ins = [open(run_f, 'rb') for run_f in run_fs]
+        try:
+            with (gzip.open(tmp_sorted_f, 'wb', compresslevel=1) if sorted_f.endswith('.gz')
+                  else open(tmp_sorted_f, 'wb')) as sorted_out:
+                sorted_out.writelines(heapq.merge(*run_ins, key=sort_key))
+        finally:
+            for run_in in run_ins:
+                run_in.close()
+        # only a complete sort gets the name the loading reads
+        os.replace(tmp_sorted_f, sorted_f)
+        return lines
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def has_unloaded_chunks(fill_detail):
+    """whether a chunked insert of the fill stopped before all of its csvs loaded, see insert_csvs_chunked"""
+    extant_csvs = fill_detail.get('extant_csvs')
+    return isinstance(extant_csvs, dict) and not set(extant_csvs) <= set(fill_detail.get('loaded_csvs', []))
+
+
+def iter_csv_chunks(csv_f, chunk_bytes, start_offset=0):
+    """
+    (offset, bytes) of consecutive chunks of about chunk_bytes, each extended to the end of its last line, from
+    start_offset on, which has to be the start of a line
+    """
+    with open_csv(csv_f) as csv_in:
+        csv_in.seek(start_offset)
+        offset = start_offset
+        while True:
+            chunk_data = csv_in.read(chunk_bytes)
+            if not chunk_data:
+                break
+            if not chunk_data.endswith(b'\n'):
+                chunk_data += csv_in.readline()
+            yield offset, chunk_data
+            offset += len(chunk_data)
+
+
 if __name__ == '__main__':
     dump_date = sys.argv[1] if len(sys.argv) >= 2 else None
     dump_subset = sys.argv[2] if len(sys.argv) >= 3 else None
@@ -11,7 +11,7 @@ from humaniki_schema import db
 from humaniki_schema.generate_metrics import MetricFactory
 from humaniki_schema.insert import HumanikiDataInserter
 from humaniki_schema.queries import get_latest_fill_id, determine_fill_item, create_new_fill, update_fill_detail, \
-    get_exact_fill, get_fill_by_id
+    get_exact_fill, get_fill_by_id, deactivate_preview_fills
 from humaniki_schema.utils import read_config_file, make_dump_date_from_str, HUMANIKI_SNAPSHOT_DATE_FMT, \
     is_wikimedia_cloud_dump_format, numeric_part_of_filename
 from humaniki_schema.log import get_logger
@@ -128,7 +128,7 @@ class HumanikiOrchestrator(object):
         hdi = HumanikiDataInserter(config=os.environ['HUMANIKI_YAML_CONFIG'],
                                    dump_date=self.working_fill_date,
                                    dump_subset=dump_subset,
-                                   insert_strategy='infile')
+                                   insert_strategy=self.config_insertion.get('insert_strategy', 'infile'))
         hdi.run()
 
     def _get_metrics_factory(self):
@@ -138,6 +138,14 @@ class HumanikiOrchestrator(object):
         else:
             pass
 
+    @_record_stage_on_fill_item
+    def execute_preview_metrics(self):
+        """sampled metrics the backend can serve until the fill is finalized, only if the config asks for them"""
+        if 'preview' not in self.config['generation']:
+            return
+        self._get_metrics_factory()
+        self.metrics_factory.preview(procs=int(self.num_procs))
+
     @_record_stage_on_fill_item
     def execute_create_metric_jobs(self):
         self._get_metrics_factory()
@@ -190,6 +198,7 @@ class HumanikiOrchestrator(object):
     def finalize_fill_obj(self):
         '''set the fill obj to active=true'''
         update_fill_detail(self.db_session, self.fill_id, 'active', True)
+        deactivate_preview_fills(self.db_session, self.fill_id)
 
 
     @_record_stage_on_fill_item
@@ -251,6 +260,7 @@ class HumanikiOrchestrator(object):
             self.create_fill_obj,
             self.execute_java,
             self.execute_inserter,
+            self.execute_preview_metrics,
             self.execute_create_metric_jobs,
             self.execute_metric_jobs_multi,
             self.finalize_fill_obj,
@@ -2,15 +2,15 @@ import datetime
 
 import sqlalchemy
 
-from sqlalchemy import func, and_, or_, cast, String
+from sqlalchemy import func, and_, or_, cast, String, case, literal
 from sqlalchemy.dialects.mysql import JSON
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm.attributes import flag_modified
 
 from humaniki_schema import utils as hs_utils
 from humaniki_schema.schema import fill, metric_properties_j, metric_properties_n, metric_aggregations_j, \
-    metric_aggregations_n, \
-    project, metric
+    metric_aggregations_n, metric_aggregations_wide, METRIC_AGGREGATIONS_WIDE_DIMENSIONS, \
+    project, metric, human_fact, HUMAN_FACT_UNKNOWN_PROJECT
 import humaniki_schema.utils as hs_utils
 
 from humaniki_schema.db import session_factory
@@ -59,7 +59,7 @@ def get_aggregations_obj(bias_value, dimension_values, session=None, table=metri
     :param bias_value: either a scalar the qid, eg. for male, or in the case of insertion a dict{bias_prop:bias_value}
     :param dimension_values: [val] list or {prop:val} dict. the sitelink, citizenship, year of birth, or other. dict is useful when creating.
     :param session:
-    :param table: which table to query, json or normalized
+    :param table: which table to query, json, normalized, or wide (only for up to METRIC_AGGREGATIONS_WIDE_DIMENSIONS)
     :param as_subquery:
     :param create_if_no_exist:
     :return:
@@ -72,6 +72,9 @@ def get_aggregations_obj(bias_value, dimension_values, session=None, table=metri
     elif table == metric_aggregations_n:
         return get_aggregations_obj_normal(bias_value, dimension_values, session, as_subquery,
                                            create_if_no_exist)
+    elif table == metric_aggregations_wide:
+        return get_aggregations_obj_wide(bias_value, dimension_values, session, as_subquery,
+                                         create_if_no_exist)
 
 
 def create_properties_obj(bias_property, dimension_properties, session):
@@ -86,7 +89,8 @@ def create_properties_obj(bias_property, dimension_properties, session):
 def create_properties_obj_json(bias_property, dimension_properties, session):
     a_metric_properties = metric_properties_j(properties=dimension_properties,
                                               properties_len=len(dimension_properties),
-                                              bias_property=bias_property)
+                                              bias_property=bias_property,
+                                              hash=hs_utils.properties_hash(bias_property, dimension_properties))
     session.add(a_metric_properties)
     session.commit()
     return a_metric_properties
@@ -105,11 +109,9 @@ def create_properties_obj_normal(prop_id, bias_property, dimension_properties, s
 
 
 def get_properties_obj_json(bias_property, dimension_properties, session, as_subquery, create_if_no_exist):
+    # properties are content addressed, so this is an index probe
     properties_id_q = session.query(metric_properties_j) \
-        .filter(metric_properties_j.bias_property == bias_property) \
-        .filter(metric_properties_j.properties_len == len(dimension_properties))
-    for pos, prop_num in enumerate(dimension_properties):
-        properties_id_q = properties_id_q.filter(metric_properties_j.properties[pos] == prop_num)
+        .filter(metric_properties_j.hash == hs_utils.properties_hash(bias_property, dimension_properties))
 
     if as_subquery:
         return properties_id_q.subquery('props')
@@ -222,57 +224,171 @@ def get_aggregations_obj_normal(bias_value, dimension_values, session, as_subque
             return aggregations_id_objs  # return a known empty list
 
 
+def get_aggregations_obj_wide(bias_value, dimension_values, session, as_subquery, create_if_no_exist):
+    """
+    like get_aggregations_obj_normal, but a single probe of the properties' rows in metric_aggregations_wide.
+    :param dimension_values: {prop: val} with all of the properties of the aggregations, in order
+    """
+    if isinstance(bias_value, dict):
+        (bias_prop, bias_qid), = bias_value.items()
+    else:
+        # the bias is still always gender
+        bias_prop, bias_qid = hs_utils.Properties.GENDER.value, bias_value
+
+    if not isinstance(dimension_values, dict):
+        raise ReferenceError("I don't know what you're attempting to query on")
+    if len(dimension_values) > METRIC_AGGREGATIONS_WIDE_DIMENSIONS:
+        raise ValueError(f'metric_aggregations_wide only has {METRIC_AGGREGATIONS_WIDE_DIMENSIONS} dimensions')
+
+    properties_obj = get_properties_obj(bias_prop, list(dimension_values.keys()), session=session,
+                                        create_if_no_exist=create_if_no_exist)
+    aggregations_id_q = session.query(metric_aggregations_wide) \
+        .filter(metric_aggregations_wide.properties_id == properties_obj.id)
+    if bias_qid is not None and bias_qid != 'all':
+        aggregations_id_q = aggregations_id_q.filter(metric_aggregations_wide.bias_value == bias_qid)
+
+    for pos, (agg_prop, agg_val) in enumerate(dimension_values.items(), start=1):
+        val_col = getattr(metric_aggregations_wide, f'val_{pos}')
+        if agg_val == 'all' or agg_val is None:
+            continue
+        # in cases where we are searching a range we may get a function of the column
+        elif callable(agg_val):
+            aggregations_id_q = aggregations_id_q.filter(agg_val(val_col))
+        else:
+            agg_val = get_exact_project_id(session,
+                                           agg_val) if agg_prop == hs_utils.Properties.PROJECT.value else agg_val
+            aggregations_id_q = aggregations_id_q.filter(val_col == agg_val)
+
+    if as_subquery:
+        return aggregations_id_q.subquery('aggs')
+
+    aggregations_id_objs = aggregations_id_q.all()
+    if len(aggregations_id_objs) > 0 or not create_if_no_exist:
+        return aggregations_id_objs
+    else:
+        create_aggregations_obj({bias_prop: bias_qid}, dimension_values, session)
+        return aggregations_id_q.all()
+
+
 def create_aggregations_obj(bias_value, dimension_aggregations, session):
-    a_metric_aggregations_j = create_aggregations_obj_json(bias_value, dimension_aggregations, session)
+    """
+    :param bias_value: {bias_prop: bias_value}
+    :param dimension_aggregations: {prop: val}, in the order of the properties
+    """
+    (bias_property, bias_qid), = bias_value.items()
+    aggregations_id, = register_aggregations(session,
+                                             bias_property=bias_property,
+                                             dimension_properties=list(dimension_aggregations.keys()),
+                                             aggregations=[(bias_qid, list(dimension_aggregations.values()))])
+    return session.query(metric_aggregations_j).filter(metric_aggregations_j.id == aggregations_id).one()
+
+
+def aggregations_hash_expr(bias_value_col, properties, aggregation_cols):
+    """the sql twin of hs_utils.aggregations_hash, to content address aggregations inside an INSERT ... SELECT"""
+    return func.UNHEX(func.MD5(func.JSON_ARRAY(bias_value_col,
+                                               func.JSON_ARRAY(*properties),
+                                               func.JSON_ARRAY(*aggregation_cols))))
 
-    try:
-        metric_aggregations_n = create_aggregations_obj_normal(agg_id=a_metric_aggregations_j.id,
-                                                               bias_value=bias_value,
-                                                               dimension_aggregations=dimension_aggregations,
-                                                               session=session)
-    except NoSuchWikiError:
-        raise
-
-    return a_metric_aggregations_j
-
-
-def create_aggregations_obj_json(bias_value, dimension_aggregations, session):
-    bias_qid = list(bias_value.values())[0] if isinstance(bias_value, dict) else bias_value
-    aggregations = list(dimension_aggregations.values()) if isinstance(dimension_aggregations,
-                                                                       dict) else dimension_aggregations
-    a_metric_aggregations = metric_aggregations_j(aggregations=aggregations,
-                                                  aggregations_len=len(dimension_aggregations),
-                                                  bias_value=bias_qid)
-    session.add(a_metric_aggregations)
-    session.commit()
-    return a_metric_aggregations
 
+# qids are sampled by which of this many buckets their hash falls in
+SAMPLE_BUCKETS = 10000
 
-def create_aggregations_obj_normal(agg_id, bias_value, dimension_aggregations, session):
+
+def make_qid_sample_filter(qid_col, sample_rate):
+    """a deterministic sample of about sample_rate of the humans, the same qids in every fill"""
+    return func.CRC32(qid_col) % SAMPLE_BUCKETS < round(sample_rate * SAMPLE_BUCKETS)
+
+
+def get_aggregations_ids_by_hash(session, hashes, chunk_size=5000, lock=False):
+    """
+    :param lock: read with a shared lock, which sees rows other transactions committed after ours started
+    :return: {hash: aggregations_id} for the hashes that exist
+    """
+    ids_by_hash = {}
+    for chunk_start in range(0, len(hashes), chunk_size):
+        chunk = hashes[chunk_start:chunk_start + chunk_size]
+        ids_q = session.query(metric_aggregations_j.hash, metric_aggregations_j.id) \
+            .filter(metric_aggregations_j.hash.in_(chunk))
+        if lock:
+            ids_q = ids_q.with_for_update(read=True)
+        ids_by_hash.update(dict(ids_q.all()))
+    return ids_by_hash
+
+
+def bulk_insert_ignore(session, table, rows, chunk_size=5000):
+    """:return: the number of rows inserted"""
+    rowcount = 0
+    for chunk_start in range(0, len(rows), chunk_size):
+        chunk = rows[chunk_start:chunk_start + chunk_size]
+        rowcount += session.execute(table.__table__.insert().prefix_with('IGNORE'), chunk).rowcount
+    return rowcount
+
+
+def register_aggregations(session, bias_property, dimension_properties, aggregations, chunk_size=5000,
+                          properties_id=None):
     """
-    we only create one aggregations-group (one agg_id) at a time.
+    idempotently store many aggregations of the same properties, in the json, normalized and wide tables, with
+    a single commit. aggregations are content addressed (hs_utils.aggregations_hash), so which ones exist already is an
+    index probe, and a concurrent registration of the same aggregation is ignored by the unique hash.
+    :param aggregations: list of (bias_value, [dimension_value, ...]) with projects as their wiki codes
+    :param properties_id: the metric_properties_j id of the properties, looked up if not given
+    :return: the aggregations ids, in the order of aggregations
     """
-    # our order is that the first kv pair are the bias, and the the sorted dimensional aggregations
-    aggregations_dict = {**bias_value, **dimension_aggregations}
-
-    metric_aggregations_n_s = []
-    for i, (prop_id, value) in enumerate(aggregations_dict.items()):
-        value_code = value
-        if prop_id == 0:
-            # recall we fake sitelink as property id 0.
-            try:
-                value_code = get_project_internal_id_from_wikiencoding(value, session)
-            except NoSuchWikiError:
-                # if the wiki is new
-                raise
-        a_metric_aggregations = metric_aggregations_n(id=agg_id,
-                                                      property=prop_id,
-                                                      value=value_code,
-                                                      aggregation_order=i)
-        metric_aggregations_n_s.append(a_metric_aggregations)
-    session.add_all(metric_aggregations_n_s)
+    hashes = [hs_utils.aggregations_hash(bias_value, dimension_properties, dimension_values)
+              for bias_value, dimension_values in aggregations]
+    ids_by_hash = get_aggregations_ids_by_hash(session, hashes, chunk_size)
+    new_aggregations = {agg_hash: aggregation for agg_hash, aggregation in zip(hashes, aggregations)
+                        if agg_hash not in ids_by_hash}
+
+    if new_aggregations:
+        # recall we fake sitelink as property id 0, and normalize it to the project's internal id
+        project_ids = {code: project_id for project_id, code in get_project_wikiencoding_from_id(session)} \
+            if hs_utils.Properties.PROJECT.value in dimension_properties else {}
+        bias_dimension_properties = [bias_property, *dimension_properties]
+
+        maj_rows, man_values = [], []
+        for agg_hash, (bias_value, dimension_values) in new_aggregations.items():
+            maj_rows.append({'hash': agg_hash,
+                             'bias_value': bias_value,
+                             'aggregations': list(dimension_values),
+                             'aggregations_len': len(dimension_values),
+                             'properties': list(dimension_properties)})
+            value_codes = []
+            for prop_id, value in zip(bias_dimension_properties, [bias_value, *dimension_values]):
+                if prop_id == hs_utils.Properties.PROJECT.value:
+                    if value not in project_ids:
+                        raise NoSuchWikiError(f'Probably a new Wiki was added: {value}')
+                    value = project_ids[value]
+                value_codes.append(value)
+            man_values.append((agg_hash, value_codes))
+        bulk_insert_ignore(session, metric_aggregations_j, maj_rows, chunk_size)
+
+        new_ids_by_hash = get_aggregations_ids_by_hash(session, list(new_aggregations.keys()), chunk_size, lock=True)
+        man_rows = [{'id': new_ids_by_hash[agg_hash],
+                     'property': prop_id,
+                     'value': value_code,
+                     'aggregation_order': aggregation_order}
+                    for agg_hash, value_codes in man_values
+                    for aggregation_order, (prop_id, value_code) in enumerate(zip(bias_dimension_properties,
+                                                                                  value_codes))]
+        bulk_insert_ignore(session, metric_aggregations_n, man_rows, chunk_size)
+
+        if len(dimension_properties) <= METRIC_AGGREGATIONS_WIDE_DIMENSIONS:
+            if properties_id is None:
+                properties_id = get_properties_obj(bias_property, dimension_properties, session=session,
+                                                   create_if_no_exist=True).id
+            wide_rows = []
+            for agg_hash, value_codes in man_values:
+                wide_row = {'id': new_ids_by_hash[agg_hash], 'properties_id': properties_id,
+                            'bias_value': value_codes[0]}
+                wide_row.update({f'val_{pos}': value_codes[pos] if pos < len(value_codes) else None
+                                 for pos in range(1, METRIC_AGGREGATIONS_WIDE_DIMENSIONS + 1)})
+                wide_rows.append(wide_row)
+            bulk_insert_ignore(session, metric_aggregations_wide, wide_rows, chunk_size)
+        ids_by_hash.update(new_ids_by_hash)
+
     session.commit()
-    return metric_aggregations_n_s
+    return [ids_by_hash[agg_hash] for agg_hash in hashes]
 
 
 def get_project_internal_id_from_wikiencoding(wikiencoding, session):
@@ -293,20 +409,49 @@ def get_project_wikiencoding_from_id(session, internal_project_id=None):
         return project_q.all()
 
 
-def get_latest_fill_id(session):
-    latest_q = session.query(func.max(fill.date)).filter(fill.detail['active'] == True).subquery()
-    q = session.query(fill.id, fill.date).filter(fill.date == latest_q).filter(fill.detail['active'] == True)
+def get_latest_fill_id(session, fill_type=hs_utils.FillType.DUMP):
+    latest_q = session.query(func.max(fill.date)).filter(fill.detail['active'] == True) \
+        .filter(fill.type == fill_type.value).subquery()
+    q = session.query(fill.id, fill.date).filter(fill.date == latest_q).filter(fill.detail['active'] == True) \
+        .filter(fill.type == fill_type.value)
     latest_fill_id, latest_fill_date = q.one()
     return latest_fill_id, latest_fill_date
 
 
-def get_exact_fill_id(session, exact_fill_dt):
-    a_fill = get_exact_fill(session, exact_fill_dt)
+def get_latest_metrics_fill(session):
+    """
+    the latest active fill a reader can serve metrics of: a dump fill, or the preview of a newer dump whose own metrics
+    are still being generated. a preview's totals are estimates, scaled up from a sample of the dump's humans.
+    :return: (fill_id, fill_date, FillType, the preview's sample rate or None)
+    """
+    latest_fill = session.query(fill).filter(fill.detail['active'] == True) \
+        .filter(fill.type.in_([hs_utils.FillType.DUMP.value, hs_utils.FillType.PREVIEW.value])) \
+        .order_by(fill.date.desc(), fill.type) \
+        .first()
+    fill_type = hs_utils.FillType(latest_fill.type)
+    sample_rate = latest_fill.detail['preview']['sample_rate'] if fill_type == hs_utils.FillType.PREVIEW else None
+    return latest_fill.id, latest_fill.date, fill_type, sample_rate
+
+
+def get_previous_active_fill_id(session, before_fill_dt, fill_type=hs_utils.FillType.DUMP):
+    """the latest active fill before a date, or (None, None) if there is none"""
+    previous_q = session.query(fill.id, fill.date).filter(fill.date < before_fill_dt) \
+        .filter(fill.detail['active'] == True) \
+        .filter(fill.type == fill_type.value) \
+        .order_by(fill.date.desc())
+    previous_fill = previous_q.first()
+    return (previous_fill.id, previous_fill.date) if previous_fill else (None, None)
+
+
+def get_exact_fill_id(session, exact_fill_dt, fill_type=hs_utils.FillType.DUMP):
+    a_fill = get_exact_fill(session, exact_fill_dt, fill_type=fill_type)
     return a_fill.id, a_fill.date
 
 
-def get_exact_fill(session, exact_fill_dt, include_nulls=False):
+def get_exact_fill(session, exact_fill_dt, include_nulls=False, fill_type=hs_utils.FillType.DUMP):
+    # a dump's preview fill has the same date
     q = session.query(fill).filter(fill.date == exact_fill_dt) \
+        .filter(fill.type == fill_type.value) \
         .filter(or_(fill.detail['active'] == True,
                     (cast(fill.detail['active'], String) == 'null')))
     # # the cast to string in necessary here because sqlalchemy has a bug where you can't directly compare the nnull
@@ -321,21 +466,31 @@ def get_fill_by_id(session, fill_id):
     return q.one()
 
 
-def create_new_fill(session, dump_date, detection_type=None):
-    fill_type = hs_utils.FillType.DUMP.value
+def create_new_fill(session, dump_date, detection_type=None, fill_type=hs_utils.FillType.DUMP, extra_detail=None):
     now = datetime.datetime.utcnow()
     detail = {'fill_process_dt': now.strftime(hs_utils.HUMANIKI_SNAPSHOT_DATE_FMT),
               'active': None,  # the user must set actvie to true when they finishe processing the dump
               'detection_type': detection_type,
               'stages': {},
               }
-    a_fill = fill(date=dump_date, type=fill_type, detail=detail)
+    if extra_detail:
+        detail.update(extra_detail)
+    a_fill = fill(date=dump_date, type=fill_type.value, detail=detail)
     session.add(a_fill)
     session.commit()
     session.refresh(a_fill)
     return a_fill
 
 
+def deactivate_preview_fills(session, of_fill_id):
+    """the preview fills of a dump fill are superseded by a newer preview, or by the dump fill itself"""
+    preview_fills = session.query(fill).filter(fill.type == hs_utils.FillType.PREVIEW.value) \
+        .filter(fill.detail['preview']['of_fill'] == of_fill_id).all()
+    for preview_fill in preview_fills:
+        update_fill_detail(session, preview_fill.id, 'active', False)
+    return len(preview_fills)
+
+
 def update_fill_detail(session, fill_id, detail_key, detail_value):
     a_fill = session.query(fill).filter_by(id=fill_id).one()
     a_fill.detail[detail_key] = detail_value
@@ -377,6 +532,41 @@ def count_table_metric_aggregations_j(session):
 def count_table_metric_aggregations_n(session):
     return count_table(session, metric_aggregations_n)
 
+def make_human_fact_source(session, fill_id):
+    """
+    a fill's human_fact in the columns of MetricCreator.make_humans_with_properties_query, to be its humans_source.
+    the 0s that stand for no sitelink or citizenship become nulls again. the sitelinks to unknown projects become an
+    empty code, which, like their own codes in the human tables, matches no project.
+    """
+    human_fact_q = session.query(human_fact.qid.label('qid'),
+                                 human_fact.gender.label('gender'),
+                                 human_fact.sitelink_count.label('sitelink_count'),
+                                 case([(human_fact.project_id == HUMAN_FACT_UNKNOWN_PROJECT, literal(''))],
+                                      else_=project.code).label('sitelink'),
+                                 func.NULLIF(human_fact.country, 0).label('country'),
+                                 human_fact.year_of_birth.label('year_of_birth'),
+                                 human_fact.year_of_death.label('year_of_death')) \
+        .outerjoin(project, project.id == human_fact.project_id) \
+        .filter(human_fact.fill_id == fill_id)
+    return human_fact_q.subquery('human_fact_source')
+
+
+def create_temporary_table(session, table_name, query, index_cols=None):
+    """
+    materialize a query into a session scoped temporary table.
+    the session must keep its connection between statements (see db.pinned_session_factory).
+    :return: a Table object to query the temporary table with, and the number of rows it was created with
+    """
+    query_sub = query.subquery()
+    temp_table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(),
+                                  *[sqlalchemy.Column(col.key, col.type) for col in query_sub.c],
+                                  prefixes=['TEMPORARY'])
+    select_sql = query.statement.compile(dialect=session.get_bind().dialect, compile_kwargs={"literal_binds": True})
+    index_str = f"(INDEX ({','.join(index_cols)}))" if index_cols else ''
+    session.execute(sqlalchemy.text(f"DROP TEMPORARY TABLE IF EXISTS {table_name}"))
+    create_res = session.execute(sqlalchemy.text(f"CREATE TEMPORARY TABLE {table_name} {index_str} {select_sql}"))
+    return temp_table, create_res.rowcount
+
 
 class NoSuchWikiError(Exception):
     pass
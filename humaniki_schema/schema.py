@@ -2,7 +2,7 @@
 import os
 import sys
 from sqlalchemy import Column, Integer, SMALLINT, String, Text, DateTime, Date, Enum, Boolean, BigInteger, Index, Float, ForeignKey, JSON
-from sqlalchemy.dialects.mysql import MEDIUMTEXT, LONGTEXT, TINYTEXT, TEXT, VARCHAR, TINYINT
+from sqlalchemy.dialects.mysql import MEDIUMTEXT, LONGTEXT, TINYTEXT, TEXT, VARCHAR, TINYINT, BINARY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
@@ -54,6 +54,7 @@ class metric_properties_j(Base):
     bias_property       = Column(Integer) # the bias property, eg gender
     properties          = Column(JSON) # list of p-values of the properties in ascending order
     properties_len      = Column(TINYINT)
+    hash                = Column(BINARY(16), index=True, unique=True) # content address, see hs_utils.properties_hash
 
 
 class metric_aggregations_j(Base):
@@ -63,6 +64,7 @@ class metric_aggregations_j(Base):
     aggregations        = Column(JSON) # ordered list to zip with properties to get {property:val}
     aggregations_len    = Column(TINYINT)
     properties          = Column(JSON) # ordered list to zip with aggregations to get {property:val}
+    hash                = Column(BINARY(16), index=True, unique=True) # content address, see hs_utils.aggregations_hash
 
 
 class metric_properties_n(Base):
@@ -80,6 +82,25 @@ class metric_aggregations_n(Base):
     aggregation_order   = Column(Integer, primary_key=True)
 
 
+# human_fact's project_id for sitelinks to projects that aren't in the project table
+HUMAN_FACT_UNKNOWN_PROJECT = -1
+
+# combinations with up to this many dimensions get a row in metric_aggregations_wide
+METRIC_AGGREGATIONS_WIDE_DIMENSIONS = 3
+
+class metric_aggregations_wide(Base):
+    """metric_aggregations_n pivoted to one row per aggregation, so that it can be probed without a self join"""
+    __tablename__ = 'metric_aggregations_wide'
+    id                  = Column(Integer, primary_key=True) # the metric_aggregations_j id
+    properties_id       = Column(Integer) # the metric_properties_j id, which fixes what the val columns hold
+    bias_value          = Column(Integer)
+    val_1               = Column(Integer) # dimension values in property order, projects as their internal id
+    val_2               = Column(Integer)
+    val_3               = Column(Integer)
+    __table_args__ = (Index('ix_metric_aggregations_wide_vals', 'properties_id', 'val_1', 'val_2', 'val_3', 'bias_value'),
+                      Index('ix_metric_aggregations_wide_bias', 'properties_id', 'bias_value'),)
+
+
 class metric_coverage(Base):
     __tablename__ = 'metric_coverage'
     fill_id                         = Column(Integer, ForeignKey('fill.id'), primary_key=True)
@@ -126,6 +147,25 @@ class human_sitelink(Base):
     sitelink           = Column(VARCHAR(32), primary_key=True)
 
 
+class human_fact(Base):
+    """
+    the human tables of a fill joined once after insertion: one row per human, sitelink and citizenship, only for
+    humans with a gender. a human without sitelinks or citizenships has a single 0 in that column, and the sitelinks
+    of a human to projects that aren't in the project table a single HUMAN_FACT_UNKNOWN_PROJECT.
+    clustered by project and country, the common group by order.
+    """
+    __tablename__ = 'human_fact'
+    fill_id            = Column(Integer, primary_key=True)
+    project_id         = Column(SMALLINT, primary_key=True) # the project's internal id, 0 for no sitelink
+    country            = Column(Integer, primary_key=True) # 0 for no citizenship
+    qid                = Column(Integer, primary_key=True)
+    gender             = Column(Integer)
+    year_of_birth      = Column(SMALLINT)
+    year_of_death      = Column(SMALLINT)
+    sitelink_count     = Column(SMALLINT)
+    __table_args__ = (Index('ix_human_fact_qid', 'fill_id', 'qid'),)
+
+
 class occupation_parent(Base):
     __tablename__ = 'occupation_parent'
     fill_id            = Column(Integer, ForeignKey('fill.id'), primary_key=True)
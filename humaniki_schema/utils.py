@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 from enum import Enum
 # TODO, consider Immutable dict instead
@@ -31,6 +33,7 @@ def order_props(props):
 class FillType(Enum):
     DUMP = 1
     RECENT_CHANGES = 2
+    PREVIEW = 3  # metrics of a sample of a dump's humans, see MetricFactory.preview
 
 
 class MetricFacets(Enum):
@@ -58,6 +61,61 @@ class JobState(Enum):
     FAILED = 5
 
 
+def _json_md5(obj):
+    """md5 of the json text of obj, serialized the way MySQL serializes a JSON value to a string"""
+    return hashlib.md5(json.dumps(obj, ensure_ascii=False).encode('utf-8')).digest()
+
+
+def aggregations_hash(bias_value, properties, aggregations):
+    """the content address of an aggregation. equal to UNHEX(MD5(JSON_ARRAY(bias_value, JSON_ARRAY(*properties),
+    JSON_ARRAY(*aggregations)))) in MySQL, see queries.aggregations_hash_expr"""
+    return _json_md5([bias_value, list(properties), list(aggregations)])
+
+
+def properties_hash(bias_property, properties):
+    """the content address of a properties combination."""
+    return _json_md5([bias_property, list(properties)])
+
+
+# the bit each dimension property has in a human's property mask, see MetricFactory.generate_fill_coverage
+COVERAGE_PROPERTIES = (Properties.PROJECT, Properties.CITIZENSHIP, Properties.DATE_OF_BIRTH, Properties.DATE_OF_DEATH,
+                       Properties.OCCUPATION)
+
+
+def property_mask(properties):
+    return sum(1 << COVERAGE_PROPERTIES.index(p) for p in set(properties))
+
+
+def coverage_from_property_masks(mask_totals, properties, min_sitelinks):
+    """
+    the coverage of a combination, from the humans counted by which properties they have.
+    :param mask_totals: {(property mask, population bucket): (humans, sitelinks)}
+    :param min_sitelinks: the population's bucket, every bucket at or over it is in the population
+    :return: (humans, sitelinks) summed over the masks that have all of the properties
+    """
+    required = property_mask(properties)
+    total_with_properties, total_sitelinks_with_properties = 0, 0
+    for (mask, population_bucket), (humans, sitelinks) in mask_totals.items():
+        if mask & required == required and population_bucket >= min_sitelinks:
+            total_with_properties += humans
+            total_sitelinks_with_properties += sitelinks
+    return total_with_properties, total_sitelinks_with_properties
+
+
+def threshold_for_row_budget(size_counts, row_budget):
+    """
+    the smallest threshold that keeps a combination's number of metric rows within row_budget.
+    :param size_counts: {group size: the number of groups of that size}
+    :return: None if every group fits
+    """
+    rows = 0
+    for size in sorted(size_counts, reverse=True):
+        rows += size_counts[size]
+        if rows > row_budget:
+            return size + 1
+    return None
+
+
 def get_enum_from_str(enum_class, s):
     try:
         return getattr(enum_class, s.upper())
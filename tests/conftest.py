@@ -0,0 +1,25 @@
+import threading
+from collections import namedtuple
+
+import pytest
+from sqlalchemy import event
+
+ExecutedStatement = namedtuple('ExecutedStatement', ['sql', 'thread'])
+
+
+@pytest.fixture
+def executed_sql():
+    """the ExecutedStatements of the database engines, from when the test asks for them until it ends"""
+    from humaniki_schema import db  # only the tests that use the database need it configured
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(ExecutedStatement(sql=statement, thread=threading.get_ident()))
+
+    engines = (db.engine, db.local_infile_engine)
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', record)
+    yield statements
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', record)
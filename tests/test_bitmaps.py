@@ -0,0 +1,49 @@
+import numpy as np
+
+from humaniki_schema.bitmaps import FillBitmaps
+from humaniki_schema.columnar import NULL_VALUE
+from humaniki_schema.utils import Properties, PopulationDefinition
+from test_columnar import make_fill_columns
+
+
+def make_humans(n):
+    """{qid: (gender, year_of_birth, sitelink_count, [sitelinks], [countries])}, some values common and some rare"""
+    rng = np.random.RandomState(0)
+    humans = {}
+    for qid in range(1, n + 1):
+        sitelinks = [s for s in ['enwiki', 'frwiki', 'be_x_oldwiki'] if rng.rand() < {'enwiki': 0.5}.get(s, 0.02)]
+        countries = [c for c in [30, 142, 183] if rng.rand() < (0.4 if c == 30 else 0.01)]
+        year_of_birth = int(rng.choice([1950, 1960, NULL_VALUE]))
+        humans[qid] = (int(rng.choice([6581097, 6581072])), year_of_birth, len(sitelinks), sitelinks, countries)
+    return humans
+
+
+def brute_force_count(humans, sitelinks=None, countries=None, year_of_birth=None, gender=None, min_sitelinks=0):
+    return sum(1 for (h_gender, h_yob, h_sitelink_count, h_sitelinks, h_countries) in humans.values()
+               if (sitelinks is None or set(sitelinks) & set(h_sitelinks))
+               and (countries is None or set(countries) & set(h_countries))
+               and (year_of_birth is None or h_yob == year_of_birth)
+               and (gender is None or h_gender == gender)
+               and h_sitelink_count >= min_sitelinks)
+
+
+def test_counts_match_brute_force(tmp_path):
+    humans = make_humans(2000)
+    fill_bitmaps = FillBitmaps.from_fill_columns(make_fill_columns(1, humans))
+    # both kinds of container are exercised
+    assert {c.dtype for c in fill_bitmaps.containers.values()} == {np.dtype(np.int32), np.dtype(np.uint8)}
+
+    path = str(tmp_path / 'bitmaps.npz')
+    fill_bitmaps.save(path)
+    for bitmaps in (fill_bitmaps, FillBitmaps.load(path)):
+        assert bitmaps.count({Properties.PROJECT: 'enwiki'}) == brute_force_count(humans, sitelinks=['enwiki'])
+        assert bitmaps.count({Properties.PROJECT: 'be_x_oldwiki', Properties.CITIZENSHIP: 30}) == \
+               brute_force_count(humans, sitelinks=['be_x_oldwiki'], countries=[30])
+        assert bitmaps.count({Properties.PROJECT: ['frwiki', 'be_x_oldwiki'], Properties.DATE_OF_BIRTH: 1950},
+                             PopulationDefinition.GTE_ONE_SITELINK) == \
+               brute_force_count(humans, sitelinks=['frwiki', 'be_x_oldwiki'], year_of_birth=1950, min_sitelinks=1)
+        assert bitmaps.count({Properties.CITIZENSHIP: 999}) == 0
+        assert bitmaps.count_by_bias({Properties.CITIZENSHIP: [142, 183]}) == \
+               {gender: brute_force_count(humans, countries=[142, 183], gender=gender)
+                for gender in (6581097, 6581072)
+                if brute_force_count(humans, countries=[142, 183], gender=gender)}
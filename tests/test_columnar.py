@@ -0,0 +1,58 @@
+import numpy as np
+
+from humaniki_schema.columnar import FillColumns, NULL_VALUE, _make_csr
+from humaniki_schema.utils import Properties, PopulationDefinition
+
+
+def make_fill_columns(fill_id, humans):
+    """:param humans: {qid: (gender, year_of_birth, sitelink_count, [sitelinks], [countries])}"""
+    qid = np.array(sorted(humans))
+    gender, year_of_birth, sitelink_count, sitelinks, countries = zip(*[humans[q] for q in qid])
+    sitelink_pairs = [(q, s) for q in qid for s in humans[q][3]]
+    country_pairs = [(q, c) for q in qid for c in humans[q][4]]
+    sitelink_codes, sitelink_values = np.unique(np.array([s for _, s in sitelink_pairs], dtype=str),
+                                                return_inverse=True)
+    multi_valued = {
+        Properties.PROJECT: _make_csr(qid, np.array([q for q, _ in sitelink_pairs]), sitelink_values),
+        Properties.CITIZENSHIP: _make_csr(qid, np.array([q for q, _ in country_pairs]),
+                                          np.array([c for _, c in country_pairs])),
+        Properties.OCCUPATION: _make_csr(qid, np.array([], dtype=np.int64), np.array([], dtype=np.int64))}
+    return FillColumns(fill_id=fill_id, qid=qid, gender=np.array(gender), year_of_birth=np.array(year_of_birth),
+                       year_of_death=np.full(len(qid), NULL_VALUE), sitelink_count=np.array(sitelink_count),
+                       multi_valued=multi_valued, sitelink_codes=sitelink_codes)
+
+
+def test_changed_masks():
+    previous = make_fill_columns(1, {1: (6581097, 1950, 2, ['enwiki', 'frwiki'], [30]),
+                                     2: (6581072, NULL_VALUE, 1, ['dewiki'], []),
+                                     3: (6581072, 1960, 0, [], [142]),
+                                     4: (6581097, 1970, 1, ['enwiki'], [30])})
+    current = make_fill_columns(2, {1: (6581097, 1950, 2, ['frwiki', 'enwiki'], [30]),  # same, sitelinks reordered
+                                    2: (6581072, NULL_VALUE, 1, ['eswiki'], []),  # sitelink changed
+                                    3: (6581072, 1961, 0, [], [142]),  # year of birth changed
+                                    5: (6581097, 1980, 1, ['enwiki'], [183])})  # added, and 4 removed
+    changed, previous_changed = current.changed_masks(previous)
+    assert list(current.qid[changed]) == [2, 3, 5]
+    assert list(previous.qid[previous_changed]) == [2, 3, 4]
+
+
+def test_cells_mask():
+    fill_columns = make_fill_columns(1, {1: (6581097, 1950, 2, ['enwiki', 'frwiki'], [30]),
+                                         2: (6581072, 1950, 1, ['enwiki'], [30]),
+                                         3: (6581097, 1960, 1, ['dewiki'], [30]),
+                                         4: (6581097, 1970, 1, ['frwiki'], [142])})
+    mask = fill_columns.cells_mask([Properties.PROJECT, Properties.CITIZENSHIP], [(6581097, 'frwiki', 30)])
+    assert list(fill_columns.qid[mask]) == [1]
+    keys, totals = fill_columns.groupby([Properties.CITIZENSHIP], PopulationDefinition.ALL_WIKIDATA,
+                                        mask=fill_columns.cells_mask([Properties.CITIZENSHIP], [(6581097, 30)]))
+    assert [tuple(key) for key in keys] == [(6581097, 30)]
+    assert list(totals) == [2]
+
+
+def test_groupby_mask():
+    fill_columns = make_fill_columns(1, {1: (6581097, 1950, 2, ['enwiki', 'frwiki'], [30]),
+                                         2: (6581072, 1950, 1, ['enwiki'], [])})
+    only_second = fill_columns.qid == 2
+    keys, totals = fill_columns.groupby([Properties.PROJECT], PopulationDefinition.ALL_WIKIDATA, mask=only_second)
+    assert [fill_columns.decode(Properties.PROJECT, key[1]) for key in keys] == ['enwiki']
+    assert list(totals) == [1]
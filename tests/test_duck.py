@@ -0,0 +1,71 @@
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+
+from humaniki_schema.duck import FillDuck, _insert_batch
+from humaniki_schema.utils import Properties, PopulationDefinition
+
+
+def make_fill_duck(fill_id, humans):
+    """:param humans: {qid: (gender, year_of_birth, sitelink_count, [sitelinks], [countries])}"""
+    connection = duckdb.connect()
+    FillDuck.create_tables(connection)
+    for qid, (gender, year_of_birth, sitelink_count, sitelinks, countries) in humans.items():
+        connection.execute('INSERT INTO human VALUES (?, ?, ?, NULL, ?)', [qid, gender, year_of_birth, sitelink_count])
+        for sitelink in sitelinks:
+            connection.execute('INSERT INTO human_sitelink VALUES (?, ?)', [qid, sitelink])
+        for country in countries:
+            connection.execute('INSERT INTO human_country VALUES (?, ?)', [qid, country])
+    connection.execute('INSERT INTO fill_info VALUES (?)', [fill_id])
+    return FillDuck(fill_id=fill_id, connection=connection)
+
+
+humans = {1: (6581097, 1950, 2, ['enwiki', 'frwiki'], [30]),
+          2: (6581072, None, 1, ['enwiki'], []),
+          3: (6581072, 1960, 0, [], [142]),
+          4: (6581097, 1950, 1, ['enwiki'], [30])}
+
+
+def test_groupby():
+    fill_duck = make_fill_duck(1, humans)
+    grouped = fill_duck.groupby([Properties.PROJECT], PopulationDefinition.GTE_ONE_SITELINK)
+    assert sorted(grouped) == [(6581072, 'enwiki', 1), (6581097, 'enwiki', 2), (6581097, 'frwiki', 1)]
+
+    grouped = fill_duck.groupby([Properties.CITIZENSHIP, Properties.DATE_OF_BIRTH], PopulationDefinition.ALL_WIKIDATA)
+    assert sorted(grouped) == [(6581072, 142, 1960, 1), (6581097, 30, 1950, 2)]
+
+    grouped = fill_duck.groupby([Properties.PROJECT], PopulationDefinition.ALL_WIKIDATA, threshold=2)
+    assert grouped == [(6581097, 'enwiki', 2)]
+
+
+def test_coverage():
+    fill_duck = make_fill_duck(1, humans)
+    # a human with several sitelinks is counted once
+    assert fill_duck.coverage([Properties.PROJECT], PopulationDefinition.ALL_WIKIDATA) == (3, 4)
+    assert fill_duck.coverage([Properties.CITIZENSHIP], PopulationDefinition.GTE_ONE_SITELINK) == (2, 3)
+    assert fill_duck.coverage([], PopulationDefinition.ALL_WIKIDATA) == (4, 4)
+
+
+def test_open_exported_file(tmp_path):
+    # what export writes, through the batch inserts it copies MySQL with, opens read only for the same fill only
+    path = str(tmp_path / 'fill.duckdb')
+    connection = duckdb.connect(path)
+    FillDuck.create_tables(connection)
+    _insert_batch(connection, 'human', FillDuck.TABLES['human'][1],
+                  [(qid, gender, year_of_birth, None, sitelink_count)
+                   for qid, (gender, year_of_birth, sitelink_count, _, _) in humans.items()])
+    _insert_batch(connection, 'human_sitelink', FillDuck.TABLES['human_sitelink'][1],
+                  [(qid, sitelink) for qid, (_, _, _, sitelinks, _) in humans.items() for sitelink in sitelinks])
+    connection.execute('INSERT INTO fill_info VALUES (?)', [1])
+    connection.close()
+
+    fill_duck = FillDuck.open(1, path)
+    try:
+        grouped = fill_duck.groupby([Properties.PROJECT], PopulationDefinition.GTE_ONE_SITELINK)
+        assert sorted(grouped) == [(6581072, 'enwiki', 1), (6581097, 'enwiki', 2), (6581097, 'frwiki', 1)]
+        with pytest.raises(Exception):
+            fill_duck.connection.execute('INSERT INTO fill_info VALUES (2)')
+    finally:
+        fill_duck.close()
+    with pytest.raises(ValueError):
+        FillDuck.open(2, path)
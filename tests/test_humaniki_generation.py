@@ -1,17 +1,25 @@
 import json
 import os
+import re
 import pandas as pd
 import time
 
 import pytest
+import yaml
 from sqlalchemy import func
+from sqlalchemy.orm.attributes import flag_modified
 
 from humaniki_schema import db
 from humaniki_schema.generate_insert import insert_data
-from humaniki_schema.generate_metrics import MetricCreator, MetricFactory
-from humaniki_schema.queries import get_aggregations_obj, get_latest_fill_id, get_properties_obj
-from humaniki_schema.schema import metric, metric_aggregations_n, project, human_country, metric_aggregations_j
-from humaniki_schema.utils import read_config_file, Properties, PopulationDefinition
+from humaniki_schema.insert import HumanikiDataInserter
+from humaniki_schema.columnar import FillColumns
+from humaniki_schema.generate_metrics import MetricCreator, MetricFactory, ColumnarMetricCreator, MetricLattice, \
+    MetricPopulationGroup, IncrementalMetricCreator
+from humaniki_schema.queries import get_aggregations_obj, get_latest_fill_id, get_properties_obj, \
+    get_previous_active_fill_id, create_new_fill, make_human_fact_source, get_fill_by_id, get_latest_metrics_fill
+from humaniki_schema.schema import metric, metric_aggregations_n, project, human_country, metric_aggregations_j, \
+    metric_aggregations_wide, job, human, human_sitelink, human_fact, metric_coverage, fill
+from humaniki_schema.utils import read_config_file, Properties, PopulationDefinition, FillType, JobState, JobType
 
 config = read_config_file(os.environ['HUMANIKI_YAML_CONFIG'], __file__)
 session = db.session_factory()
@@ -49,6 +57,78 @@ def test_csvs():
         test_files[csv_f] = df
     return test_files
 
+def get_metric_cells(fill_id, properties_id, population_id=PopulationDefinition.GTE_ONE_SITELINK.value):
+    """the (aggregation values, gender, total) of a fill's metrics for a combination, to compare engines by"""
+    cells_q = session.query(metric_aggregations_j.aggregations, metric.bias_value, metric.total) \
+        .join(metric_aggregations_j, metric_aggregations_j.id == metric.aggregations_id) \
+        .filter(metric.fill_id == fill_id) \
+        .filter(metric.properties_id == properties_id) \
+        .filter(metric.population_id == population_id)
+    return sorted((tuple(aggregations), bias_value, total) for aggregations, bias_value, total in cells_q.all())
+
+
+def delete_metrics(fill_id, properties_id):
+    session.query(metric).filter(metric.fill_id == fill_id).filter(metric.properties_id == properties_id).delete()
+    session.commit()
+
+
+def get_coverage(fill_id, properties_id, population_id=PopulationDefinition.GTE_ONE_SITELINK.value):
+    coverage_q = session.query(metric_coverage.total_with_properties, metric_coverage.total_sitelinks_with_properties) \
+        .filter(metric_coverage.fill_id == fill_id) \
+        .filter(metric_coverage.properties_id == properties_id) \
+        .filter(metric_coverage.population_id == population_id)
+    coverage = coverage_q.one_or_none()
+    return tuple(coverage) if coverage is not None else None
+
+
+def delete_coverage(fill_id, properties_id):
+    session.query(metric_coverage).filter(metric_coverage.fill_id == fill_id) \
+        .filter(metric_coverage.properties_id == properties_id).delete()
+    session.commit()
+
+
+def take_results(fill_id, properties_populations):
+    """
+    the (metric cells, coverage) of each (properties_id, population_id) of a fill, which are then deleted, so that the
+    next run of the same combinations starts from none
+    """
+    results = [(get_metric_cells(fill_id, properties_id, population_id),
+                get_coverage(fill_id, properties_id, population_id))
+               for properties_id, population_id in properties_populations]
+    for properties_id, _ in properties_populations:
+        delete_metrics(fill_id, properties_id)
+        delete_coverage(fill_id, properties_id)
+    return results
+
+
+def get_properties_id(dimension_properties):
+    return get_properties_obj(bias_property=Properties.GENDER.value,
+                              dimension_properties=[p.value for p in dimension_properties],
+                              session=session, create_if_no_exist=True).id
+
+
+def make_creator(db_session, dimension_properties, population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                 **kwargs):
+    """a MetricCreator of the current fill without a threshold, unless kwargs say otherwise"""
+    creator_kwargs = dict(population_definition=population_definition,
+                          bias_property=Properties.GENDER,
+                          dimension_properties=dimension_properties,
+                          fill_id=get_latest_fill_id(session)[0],
+                          threshold=None,
+                          properties_id=get_properties_id(dimension_properties),
+                          db_session=db_session)
+    creator_kwargs.update(kwargs)
+    return MetricCreator(**creator_kwargs)
+
+
+# a statement that reads the human table itself, rather than a temporary table made from it
+HUMAN_SCAN = re.compile(r'\b(?:FROM|JOIN) human\b')
+
+
+def count_human_scans(executed_sql):
+    return sum(1 for statement in executed_sql if HUMAN_SCAN.search(statement.sql))
+
+
 @pytest.fixture
 def metric_factory():
     mf = MetricFactory(config=os.environ['HUMANIKI_YAML_CONFIG'])
@@ -146,3 +226,626 @@ def test_single_dim_proj_gen(test_csvs, metric_factory):
     sorted_agg_group = sorted(aggs_with_first_id, key=lambda agg: agg.aggregation_order)
     assert sorted_agg_group[0].property == Properties.GENDER.value
     assert sorted_agg_group[1].property == Properties.PROJECT.value
+
+
+def test_single_dim_proj_gen_columnar(test_csvs, metric_factory):
+    # the columnar engine should produce exactly the same metrics as the sql one
+    session.query(metric).delete(); session.commit()
+    session.query(metric_aggregations_j).delete(); session.commit()
+    session.query(metric_aggregations_n).delete(); session.commit()
+
+    bias_property = Properties.GENDER.value
+    dimension_properties = [Properties.PROJECT.value]
+    proj_prop = get_properties_obj(bias_property=bias_property, dimension_properties=dimension_properties,
+                                   session=session, create_if_no_exist=True)
+
+    MetricCreator(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                  bias_property=Properties.GENDER,
+                  dimension_properties=[Properties.PROJECT],
+                  fill_id=metric_factory.curr_fill,
+                  threshold=None,
+                  properties_id=proj_prop.id,
+                  db_session=metric_factory.db_session).run()
+    sql_cells = get_metric_cells(metric_factory.curr_fill, proj_prop.id)
+    delete_metrics(metric_factory.curr_fill, proj_prop.id)
+
+    fill_columns = FillColumns.from_db(metric_factory.db_session, metric_factory.curr_fill)
+    mc = ColumnarMetricCreator(fill_columns=fill_columns,
+                               population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                               bias_property=Properties.GENDER,
+                               dimension_properties=[Properties.PROJECT],
+                               fill_id=metric_factory.curr_fill,
+                               threshold=None,
+                               properties_id=proj_prop.id,
+                               db_session=metric_factory.db_session)
+    mc.run()
+
+    actual_metrics = session.query(metric).filter(metric.properties_id == proj_prop.id).all()
+    dimension_values = {dim_prop: None for dim_prop in dimension_properties}
+    actual_aggs = get_aggregations_obj(bias_value=None, dimension_values=dimension_values, table=metric_aggregations_n, session=session)
+
+    expected_metrics = test_csvs['10_humans_proj_metrics.csv']
+    expected_aggs = test_csvs['10_humans_proj_metric_aggregations_n.csv']
+
+    assert len(actual_metrics) == len(expected_metrics)
+    assert len(actual_aggs) == len(expected_aggs)
+    assert get_metric_cells(metric_factory.curr_fill, proj_prop.id) == sql_cells
+
+
+def test_two_dim_proj_cit_gen_pruned(test_csvs, metric_factory):
+    # pruning to the cells of the completed single dimension parent shouldn't lose any metrics
+    session.query(metric).delete(); session.commit()
+    session.query(metric_aggregations_j).delete(); session.commit()
+    session.query(metric_aggregations_n).delete(); session.commit()
+
+    bias_property = Properties.GENDER.value
+    proj_prop = get_properties_obj(bias_property=bias_property, dimension_properties=[Properties.PROJECT.value],
+                                   session=session, create_if_no_exist=True)
+    proj_cit_prop = get_properties_obj(bias_property=bias_property,
+                                       dimension_properties=[Properties.PROJECT.value, Properties.CITIZENSHIP.value],
+                                       session=session, create_if_no_exist=True)
+
+    parent_mc = MetricCreator(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                              bias_property=Properties.GENDER,
+                              dimension_properties=[Properties.PROJECT],
+                              fill_id=metric_factory.curr_fill,
+                              threshold=None,
+                              properties_id=proj_prop.id,
+                              db_session=metric_factory.db_session)
+    parent_mc.run()
+
+    unpruned_kwargs = dict(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                           bias_property=Properties.GENDER,
+                           dimension_properties=[Properties.PROJECT, Properties.CITIZENSHIP],
+                           fill_id=metric_factory.curr_fill,
+                           threshold=None,
+                           properties_id=proj_cit_prop.id,
+                           db_session=metric_factory.db_session)
+    MetricCreator(**unpruned_kwargs).run()
+    unpruned_cells = get_metric_cells(metric_factory.curr_fill, proj_cit_prop.id)
+    delete_metrics(metric_factory.curr_fill, proj_cit_prop.id)
+
+    mc = MetricCreator(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                       bias_property=Properties.GENDER,
+                       dimension_properties=[Properties.PROJECT, Properties.CITIZENSHIP],
+                       fill_id=metric_factory.curr_fill,
+                       threshold=None,
+                       properties_id=proj_cit_prop.id,
+                       db_session=metric_factory.db_session,
+                       prune_parents=[(proj_prop.id, [Properties.PROJECT])])
+    mc.run()
+
+    actual_metrics = session.query(metric).filter(metric.properties_id == proj_cit_prop.id).all()
+    expected_metrics = test_csvs['10_humans_proj_cit_metrics.csv']
+    assert len(actual_metrics) == len(expected_metrics)
+    assert get_metric_cells(metric_factory.curr_fill, proj_cit_prop.id) == unpruned_cells
+
+
+def test_single_dim_proj_gen_multi_fill(metric_factory):
+    # one scan of two fills should give each fill the metrics it gets on its own
+    session.query(metric).delete(); session.commit()
+    session.query(metric_aggregations_j).delete(); session.commit()
+    session.query(metric_aggregations_n).delete(); session.commit()
+
+    proj_prop = get_properties_obj(bias_property=Properties.GENDER.value,
+                                   dimension_properties=[Properties.PROJECT.value],
+                                   session=session, create_if_no_exist=True)
+    previous_fill_id, _ = get_previous_active_fill_id(session, metric_factory.curr_fill_date)
+    fill_ids = [previous_fill_id, metric_factory.curr_fill]
+    creator_kwargs = dict(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                          bias_property=Properties.GENDER,
+                          dimension_properties=[Properties.PROJECT],
+                          threshold=None,
+                          properties_id=proj_prop.id,
+                          db_session=metric_factory.db_session)
+
+    single_fill_cells = {}
+    for fill_id in fill_ids:
+        MetricCreator(fill_id=fill_id, **creator_kwargs).run()
+        single_fill_cells[fill_id] = get_metric_cells(fill_id, proj_prop.id)
+    session.query(metric).delete(); session.commit()
+
+    MetricCreator(fill_id=fill_ids[0], fill_ids=fill_ids, **creator_kwargs).run()
+    for fill_id in fill_ids:
+        assert get_metric_cells(fill_id, proj_prop.id) == single_fill_cells[fill_id]
+
+
+def test_single_dim_proj_gen_preview(metric_factory):
+    # a preview sampling every human should have the metrics of the full run
+    session.query(metric).delete(); session.commit()
+    session.query(metric_aggregations_j).delete(); session.commit()
+    session.query(metric_aggregations_n).delete(); session.commit()
+
+    proj_prop = get_properties_obj(bias_property=Properties.GENDER.value,
+                                   dimension_properties=[Properties.PROJECT.value],
+                                   session=session, create_if_no_exist=True)
+    creator_kwargs = dict(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                          bias_property=Properties.GENDER,
+                          dimension_properties=[Properties.PROJECT],
+                          threshold=None,
+                          properties_id=proj_prop.id,
+                          db_session=metric_factory.db_session)
+    MetricCreator(fill_id=metric_factory.curr_fill, **creator_kwargs).run()
+    full_cells = get_metric_cells(metric_factory.curr_fill, proj_prop.id)
+
+    preview_fill = create_new_fill(session, metric_factory.curr_fill_date, detection_type='preview',
+                                   fill_type=FillType.PREVIEW)
+    MetricCreator(fill_id=preview_fill.id, humans_fill_id=metric_factory.curr_fill, sample_rate=1.0,
+                  min_sample_count=1, **creator_kwargs).run()
+    assert get_metric_cells(preview_fill.id, proj_prop.id) == full_cells
+
+
+def test_preview_jobs_run_like_the_fill_jobs(tmp_path, metric_factory):
+    # a preview's jobs should be claimed and run on the preview fill like a fill's, sampling the previewed fill
+    factory_config = dict(config)
+    factory_config['generation'] = {**config['generation'], 'preview': {'sample_rate': 1.0, 'min_sample_count': 1}}
+    config_f = os.path.join(tmp_path, 'preview_config.yaml')
+    with open(config_f, 'w') as config_out:
+        yaml.safe_dump(factory_config, config_out)
+    fill_id = metric_factory.curr_fill
+    preview_fill_id = MetricFactory(config=config_f).create_preview()
+    preview_jobs_q = session.query(job).filter(job.fill_id == preview_fill_id)
+    try:
+        preview_factory = MetricFactory(config=config_f, fill_date=metric_factory.curr_fill_date,
+                                        fill_type=FillType.PREVIEW)
+        assert preview_factory.curr_fill == preview_fill_id
+        jobs_run = preview_factory.execute(drain=True)
+        preview_jobs = preview_jobs_q.all()
+        assert jobs_run == len(preview_jobs)
+        assert all(a_job.job_state == JobState.COMPLETE.value for a_job in preview_jobs)
+
+        # sampling every human, a preview job makes the cells of the fill's own job
+        a_job = next(a_job for a_job in preview_jobs
+                     if a_job.detail['dimension_properties'] == [Properties.PROJECT.value])
+        properties_populations = get_job_properties_populations([a_job])
+        take_results(fill_id, properties_populations)
+        make_creator(session, [Properties.PROJECT],
+                     PopulationDefinition(a_job.detail['population_definition']),
+                     fill_id=fill_id, threshold=a_job.detail['threshold']).run()
+        assert take_results(preview_fill_id, properties_populations) == take_results(fill_id, properties_populations)
+    finally:
+        for table in (metric, metric_coverage, job):
+            session.query(table).filter(table.fill_id == preview_fill_id).delete()
+        session.query(fill).filter(fill.id == preview_fill_id).delete()
+        session.commit()
+
+
+def test_latest_metrics_fill_is_a_newer_preview(metric_factory):
+    # until a dump's own metrics are generated, readers should get its preview, with the sample rate of its estimates
+    assert get_latest_metrics_fill(session)[2] == FillType.DUMP
+    preview_fill = create_new_fill(session, '2100-01-01', detection_type='preview', fill_type=FillType.PREVIEW,
+                                   extra_detail={'active': True,
+                                                 'preview': {'of_fill': metric_factory.curr_fill,
+                                                             'sample_rate': 0.02, 'min_sample_count': 10}})
+    try:
+        latest_fill_id, _, fill_type, sample_rate = get_latest_metrics_fill(session)
+        assert (latest_fill_id, fill_type, sample_rate) == (preview_fill.id, FillType.PREVIEW, 0.02)
+    finally:
+        session.delete(preview_fill)
+        session.commit()
+
+
+def test_step_two_normalizes_shared_aggregations(metric_factory):
+    # a job whose aggregations another job of the same properties inserted, but didn't normalize yet, still gets all
+    # of its metrics
+    def clear_aggregations():
+        for table in (metric, metric_aggregations_j, metric_aggregations_n, metric_aggregations_wide):
+            session.query(table).delete(); session.commit()
+
+    proj_prop = get_properties_obj(bias_property=Properties.GENDER.value,
+                                   dimension_properties=[Properties.PROJECT.value],
+                                   session=session, create_if_no_exist=True)
+    creator_kwargs = dict(bias_property=Properties.GENDER,
+                          dimension_properties=[Properties.PROJECT],
+                          fill_id=metric_factory.curr_fill,
+                          threshold=None,
+                          properties_id=proj_prop.id,
+                          db_session=metric_factory.db_session)
+    clear_aggregations()
+    MetricCreator(population_definition=PopulationDefinition.ALL_WIKIDATA, **creator_kwargs).run()
+    expected_cells = get_metric_cells(metric_factory.curr_fill, proj_prop.id, PopulationDefinition.ALL_WIKIDATA.value)
+
+    clear_aggregations()
+    MetricCreator(population_definition=PopulationDefinition.GTE_ONE_SITELINK, **creator_kwargs).step_one_maj_insert()
+    MetricCreator(population_definition=PopulationDefinition.ALL_WIKIDATA, **creator_kwargs).run()
+    assert get_metric_cells(metric_factory.curr_fill, proj_prop.id, PopulationDefinition.ALL_WIKIDATA.value) == \
+        expected_cells
+
+
+# the group by of a combination's cells, rather than of a human's properties
+CELL_GROUPING = re.compile(r'GROUP BY human\.gender\b')
+
+
+def test_pinned_creator_groups_once(metric_factory, executed_sql):
+    # on a pinned session, as the factory runs its jobs, the humans should be grouped by one statement, which steps one
+    # to three then read, to the metrics of grouping them in each step
+    fill_id = metric_factory.curr_fill
+    dimension_properties = [Properties.PROJECT, Properties.CITIZENSHIP]
+    properties_populations = [(get_properties_id(dimension_properties), PopulationDefinition.GTE_ONE_SITELINK.value)]
+
+    take_results(fill_id, properties_populations)
+    make_creator(metric_factory.db_session, dimension_properties).run()
+    expected_results = take_results(fill_id, properties_populations)
+    assert all(cells for cells, _ in expected_results)
+
+    creator = make_creator(db.pinned_session_factory(), dimension_properties)
+    executed_sql.clear()
+    creator.run()
+    assert sum(1 for statement in executed_sql if CELL_GROUPING.search(statement.sql)) == 1
+    assert take_results(fill_id, properties_populations) == expected_results
+
+
+def test_two_workers_claim_different_jobs(metric_factory):
+    metric_factory.create()
+    other_factory = MetricFactory(config=os.environ['HUMANIKI_YAML_CONFIG'], db_session=db.session_factory())
+    claimed_jobs = []
+    try:
+        for mf in (metric_factory, other_factory):
+            mf._get_uncompleted_metric_create_jobs()
+            assert mf.metric_job is not None
+            claimed_jobs.append((mf.metric_job.id, mf.metric_job.job_state))
+    finally:
+        # hand the claimed jobs back for the other tests
+        claimed_ids = [job_id for job_id, _ in claimed_jobs]
+        session.query(job).filter(job.id.in_(claimed_ids)) \
+            .update({job.job_state: JobState.UNATTEMPTED.value}, synchronize_session=False)
+        session.commit()
+        other_factory.db_session.close()
+    (first_id, first_state), (second_id, second_state) = claimed_jobs
+    assert first_id != second_id
+    assert first_state == second_state == JobState.IN_PROGRESS.value
+
+
+def test_human_fact_source_matches_human_tables(metric_factory):
+    # metrics and coverage from human_fact should be the ones from joining the human tables, also for a human whose
+    # only sitelink is to a project we don't know
+    fill_id = metric_factory.curr_fill
+    unknown_qid = session.query(func.max(human.qid)).filter(human.fill_id == fill_id).scalar() + 1
+    a_gender = session.query(human.gender).filter(human.fill_id == fill_id).filter(human.gender.isnot(None)).first()[0]
+    session.add(human(fill_id=fill_id, qid=unknown_qid, gender=a_gender, sitelink_count=1))
+    session.add(human_sitelink(fill_id=fill_id, human_id=unknown_qid, sitelink='notaprojectwiki'))
+    session.commit()
+    try:
+        inserter = HumanikiDataInserter(os.environ['HUMANIKI_YAML_CONFIG'])
+        inserter.fill_id = fill_id
+        inserter.create_human_fact()
+
+        for dimension_properties in ([Properties.PROJECT], [Properties.CITIZENSHIP],
+                                     [Properties.PROJECT, Properties.CITIZENSHIP]):
+            props = get_properties_obj(bias_property=Properties.GENDER.value,
+                                       dimension_properties=[p.value for p in dimension_properties],
+                                       session=session, create_if_no_exist=True)
+            results = []
+            for humans_source in (None, make_human_fact_source(metric_factory.db_session, fill_id)):
+                delete_metrics(fill_id, props.id)
+                session.query(metric_coverage).filter(metric_coverage.fill_id == fill_id) \
+                    .filter(metric_coverage.properties_id == props.id).delete()
+                session.commit()
+                MetricCreator(population_definition=PopulationDefinition.GTE_ONE_SITELINK,
+                              bias_property=Properties.GENDER,
+                              dimension_properties=dimension_properties,
+                              fill_id=fill_id,
+                              threshold=None,
+                              properties_id=props.id,
+                              db_session=metric_factory.db_session,
+                              humans_source=humans_source).run()
+                coverage = session.query(metric_coverage.total_with_properties,
+                                         metric_coverage.total_sitelinks_with_properties) \
+                    .filter(metric_coverage.fill_id == fill_id) \
+                    .filter(metric_coverage.properties_id == props.id) \
+                    .filter(metric_coverage.population_id == PopulationDefinition.GTE_ONE_SITELINK.value).one()
+                results.append((get_metric_cells(fill_id, props.id), tuple(coverage)))
+            sql_result, human_fact_result = results
+            assert human_fact_result == sql_result
+    finally:
+        session.query(human_fact).filter(human_fact.fill_id == fill_id).delete()
+        session.query(human_sitelink).filter(human_sitelink.fill_id == fill_id) \
+            .filter(human_sitelink.human_id == unknown_qid).delete()
+        session.query(human).filter(human.fill_id == fill_id).filter(human.qid == unknown_qid).delete()
+        session.commit()
+
+
+def test_lattice_matches_separate_creators(metric_factory, executed_sql):
+    # rolling the smaller combinations up from the root's scan should give each the metrics and coverage of its own
+    # run, with the human tables read once
+    fill_id = metric_factory.curr_fill
+    combinations = [[Properties.PROJECT, Properties.CITIZENSHIP], [Properties.PROJECT], [Properties.CITIZENSHIP]]
+    properties_populations = [(get_properties_id(dimension_properties), PopulationDefinition.GTE_ONE_SITELINK.value)
+                              for dimension_properties in combinations]
+
+    take_results(fill_id, properties_populations)
+    for dimension_properties in combinations:
+        make_creator(metric_factory.db_session, dimension_properties).run()
+    expected_results = take_results(fill_id, properties_populations)
+    assert all(cells for cells, _ in expected_results)
+
+    lattice_session = db.pinned_session_factory()
+    root_creator, *member_creators = [make_creator(lattice_session, dimension_properties)
+                                      for dimension_properties in combinations]
+    executed_sql.clear()
+    MetricLattice(root_creator=root_creator, member_creators=member_creators).run()
+    assert count_human_scans(executed_sql) == 1
+    assert take_results(fill_id, properties_populations) == expected_results
+
+
+def test_materialized_matches_unmaterialized(metric_factory, executed_sql):
+    # materializing a job's join and group by should make the metrics and coverage of the plain run, with the human
+    # tables read once
+    fill_id = metric_factory.curr_fill
+    dimension_properties = [Properties.PROJECT, Properties.CITIZENSHIP]
+    properties_populations = [(get_properties_id(dimension_properties), PopulationDefinition.GTE_ONE_SITELINK.value)]
+
+    take_results(fill_id, properties_populations)
+    make_creator(metric_factory.db_session, dimension_properties).run()
+    expected_results = take_results(fill_id, properties_populations)
+    assert all(cells for cells, _ in expected_results)
+
+    creator = make_creator(db.pinned_session_factory(), dimension_properties, materialize=True)
+    executed_sql.clear()
+    creator.run()
+    assert count_human_scans(executed_sql) == 1
+    assert take_results(fill_id, properties_populations) == expected_results
+
+
+def make_job_creator(a_job, db_session):
+    """a MetricCreator that runs a job on its own"""
+    return MetricCreator(population_definition=PopulationDefinition(a_job.detail['population_definition']),
+                         bias_property=Properties(a_job.detail['bias_property']),
+                         dimension_properties=[Properties(d) for d in a_job.detail['dimension_properties']],
+                         fill_id=a_job.fill_id,
+                         threshold=a_job.detail['threshold'],
+                         properties_id=a_job.detail['properties_id'],
+                         db_session=db_session)
+
+
+def get_job_properties_populations(jobs):
+    return [(a_job.detail['properties_id'], a_job.detail['population_definition']) for a_job in jobs]
+
+
+def test_pool_drains_the_fill_jobs(metric_factory):
+    # the pool's workers should run every job of the fill once, to the metrics the jobs make when run on their own
+    fill_id = metric_factory.curr_fill
+    metric_factory.create()
+    fill_jobs_q = session.query(job).filter(job.fill_id == fill_id).filter(job.job_type == JobType.METRIC_CREATE.value)
+    fill_jobs_q.update({job.job_state: JobState.UNATTEMPTED.value, job.errors: None}, synchronize_session=False)
+    session.query(metric).filter(metric.fill_id == fill_id).delete()
+    session.query(metric_coverage).filter(metric_coverage.fill_id == fill_id).delete()
+    session.commit()
+
+    jobs_run = metric_factory.pool(procs=2)
+    session.expire_all()
+    fill_jobs = fill_jobs_q.all()
+    assert jobs_run == len(fill_jobs)
+    assert all(a_job.job_state == JobState.COMPLETE.value for a_job in fill_jobs)
+    # run by the pool's worker processes, not by this one
+    worker_pids = {a_job.detail['pid'] for a_job in fill_jobs}
+    assert os.getpid() not in worker_pids and len(worker_pids) <= 2
+
+    properties_populations = get_job_properties_populations(fill_jobs)
+    pooled_results = take_results(fill_id, properties_populations)
+    for a_job in fill_jobs:
+        make_job_creator(a_job, session).run()
+    assert take_results(fill_id, properties_populations) == pooled_results
+
+
+def test_population_group_matches_separate_creators(metric_factory, executed_sql):
+    # grouping the populations of a combination from one scan should give each the metrics and coverage of its own run,
+    # with the human tables read once
+    fill_id = metric_factory.curr_fill
+    populations = [PopulationDefinition.GTE_ONE_SITELINK, PopulationDefinition.ALL_WIKIDATA]
+    dimension_properties = [Properties.PROJECT, Properties.CITIZENSHIP]
+    properties_populations = [(get_properties_id(dimension_properties), population_definition.value)
+                              for population_definition in populations]
+
+    take_results(fill_id, properties_populations)
+    for population_definition in populations:
+        make_creator(metric_factory.db_session, dimension_properties, population_definition).run()
+    expected_results = take_results(fill_id, properties_populations)
+    assert all(cells for cells, _ in expected_results)
+
+    group_session = db.pinned_session_factory()
+    population_group = MetricPopulationGroup(creators=[make_creator(group_session, dimension_properties,
+                                                                    population_definition)
+                                                       for population_definition in populations])
+    executed_sql.clear()
+    population_group.run()
+    assert count_human_scans(executed_sql) == 1
+    assert take_results(fill_id, properties_populations) == expected_results
+
+
+def test_fill_coverage_matches_job_coverage(metric_factory, executed_sql):
+    # the coverage of every job from one scan of the fill should be the coverage each job's own join makes
+    fill_id = metric_factory.curr_fill
+    metric_factory.create()
+    fill_jobs = session.query(job).filter(job.fill_id == fill_id) \
+        .filter(job.job_type == JobType.METRIC_CREATE.value).all()
+    properties_populations = get_job_properties_populations(fill_jobs)
+
+    take_results(fill_id, properties_populations)
+    for a_job in fill_jobs:
+        make_job_creator(a_job, session).generate_coverage()
+    expected_results = take_results(fill_id, properties_populations)
+    assert all(coverage is not None for _, coverage in expected_results)
+
+    try:
+        executed_sql.clear()
+        metric_factory.generate_fill_coverage()
+        assert count_human_scans(executed_sql) == 1
+        assert take_results(fill_id, properties_populations) == expected_results
+    finally:
+        # the other tests' jobs make their own coverage
+        a_fill = get_fill_by_id(session, fill_id)
+        a_fill.detail.pop('coverage', None)
+        flag_modified(a_fill, 'detail')
+        session.commit()
+
+
+def test_job_counters_record_each_step(metric_factory):
+    # a job's detail should have each step's duration and rowcount, step three's being the metrics the job wrote
+    fill_id = metric_factory.curr_fill
+    metric_factory.create()
+    fill_jobs_q = session.query(job).filter(job.fill_id == fill_id).filter(job.job_type == JobType.METRIC_CREATE.value)
+    fill_jobs_q.update({job.job_state: JobState.UNATTEMPTED.value, job.errors: None}, synchronize_session=False)
+    session.commit()
+    take_results(fill_id, get_job_properties_populations(fill_jobs_q.all()))
+
+    metric_factory._get_uncompleted_metric_create_jobs()
+    metric_factory._create_metric_creators()
+    metric_factory._run_metric_creators()
+    session.expire_all()
+    a_job = session.query(job).get(metric_factory.metric_job.id)
+    assert a_job.job_state == JobState.COMPLETE.value
+
+    counters = a_job.detail['counters']
+    assert {'step_one_maj_insert', 'step_two_man_insert', 'step_three_human_with_man_insert'} <= set(counters)
+    assert all(counter['seconds'] >= 0 for counter in counters.values())
+    [(cells, _)] = take_results(fill_id, get_job_properties_populations([a_job]))
+    assert counters['step_three_human_with_man_insert']['rows'] == len(cells)
+
+
+def test_estimated_costs_from_previous_durations(metric_factory, monkeypatch):
+    # a combination that completed before costs its previous duration, the others their worst case number of
+    # aggregations at the seconds per aggregation of the timed one
+    metric_factory._generate_metric_combinations()
+    metric_factory.dimension_cardinalities = {prop: 3 + i for i, prop in enumerate(Properties)}
+    timed_combination = next(mc for mc in metric_factory.metric_combinations
+                             if list(mc['dimensions']) == [Properties.PROJECT])
+    monkeypatch.setattr(metric_factory, '_get_previous_duration',
+                        lambda mc: 8.0 if mc is timed_combination else None)
+    metric_factory._estimate_metric_combination_costs()
+
+    seconds_per_aggregation = 8.0 / metric_factory.dimension_cardinalities[Properties.PROJECT]
+    for metric_combination in metric_factory.metric_combinations:
+        max_aggregations = 1
+        for dimension in metric_combination['dimensions']:
+            max_aggregations *= metric_factory.dimension_cardinalities[dimension]
+        expected_cost = 8.0 if metric_combination is timed_combination else seconds_per_aggregation * max_aggregations
+        assert metric_combination['estimated_cost'] == pytest.approx(expected_cost)
+
+
+def test_workers_claim_the_longest_job_first(metric_factory):
+    fill_id = metric_factory.curr_fill
+    metric_factory.create()
+    fill_jobs = metric_factory.db_session.query(job).filter(job.fill_id == fill_id) \
+        .filter(job.job_type == JobType.METRIC_CREATE.value).order_by(job.id).all()
+    for estimated_cost, a_job in enumerate(reversed(fill_jobs)):
+        a_job.job_state = JobState.UNATTEMPTED.value
+        a_job.detail['estimated_cost'] = estimated_cost
+        flag_modified(a_job, 'detail')
+    metric_factory.db_session.commit()
+    try:
+        metric_factory._get_uncompleted_metric_create_jobs()
+        # the first job was given the highest cost
+        assert metric_factory.metric_job.id == fill_jobs[0].id
+    finally:
+        session.query(job).filter(job.id == fill_jobs[0].id) \
+            .update({job.job_state: JobState.UNATTEMPTED.value}, synchronize_session=False)
+        session.commit()
+
+
+def test_incremental_matches_full_run():
+    # fill b moves a human of country 1003 to 1002, so at a threshold of 2, 1002 crosses it up and 1003 down
+    male = 6581097
+    fill_humans = [{1: 1001, 2: 1001, 3: 1001, 4: 1002, 5: 1003, 6: 1003},
+                   {1: 1001, 2: 1001, 3: 1001, 4: 1002, 5: 1003, 6: 1002}]
+    fill_ids = [create_new_fill(session, dump_date).id
+                for dump_date in ('2100-01-01', '2100-01-02')]
+    properties_id = get_properties_id([Properties.CITIZENSHIP])
+    try:
+        for fill_id, humans in zip(fill_ids, fill_humans):
+            for qid, country in humans.items():
+                session.add(human(fill_id=fill_id, qid=qid, gender=male, sitelink_count=1))
+                session.add(human_country(fill_id=fill_id, human_id=qid, country=country))
+        session.commit()
+        previous_fill_id, curr_fill_id = fill_ids
+
+        make_creator(session, [Properties.CITIZENSHIP], fill_id=previous_fill_id, threshold=2).run()
+        previous_fill_columns = FillColumns.from_db(session, previous_fill_id)
+        fill_columns = FillColumns.from_db(session, curr_fill_id)
+        incremental_creator = IncrementalMetricCreator(
+            fill_columns=fill_columns, previous_fill_columns=previous_fill_columns,
+            changed_masks=fill_columns.changed_masks(previous_fill_columns),
+            population_definition=PopulationDefinition.GTE_ONE_SITELINK, bias_property=Properties.GENDER,
+            dimension_properties=[Properties.CITIZENSHIP], threshold=2, fill_id=curr_fill_id,
+            properties_id=properties_id, db_session=session)
+        incremental_creator.run()
+        (incremental_cells, _), = take_results(curr_fill_id, [(properties_id,
+                                                               PopulationDefinition.GTE_ONE_SITELINK.value)])
+
+        make_creator(session, [Properties.CITIZENSHIP], fill_id=curr_fill_id, threshold=2).run()
+        assert incremental_cells == get_metric_cells(curr_fill_id, properties_id)
+        assert incremental_cells == [((1001,), male, 3), ((1002,), male, 2)]
+    finally:
+        for fill_id in fill_ids:
+            delete_metrics(fill_id, properties_id)
+            delete_coverage(fill_id, properties_id)
+            for table in (human, human_country):
+                session.query(table).filter(table.fill_id == fill_id).delete()
+            session.query(fill).filter(fill.id == fill_id).delete()
+        session.commit()
+
+
+@pytest.mark.parametrize('combination, fill_group', [({'lattice_rollup': True, 'merge_populations': True}, False),
+                                                     ({'prune_from_len': 2}, True)])
+def test_conflicting_generation_options(tmp_path, combination, fill_group):
+    factory_config = dict(config)
+    factory_config['generation'] = {**config['generation'],
+                                    'combination': {**config['generation']['combination'], **combination}}
+    config_f = os.path.join(tmp_path, 'generation_config.yaml')
+    with open(config_f, 'w') as config_out:
+        yaml.safe_dump(factory_config, config_out)
+    fill_dates = None
+    if fill_group:
+        _, curr_fill_date = get_latest_fill_id(session)
+        fill_dates = [get_previous_active_fill_id(session, curr_fill_date)[1], curr_fill_date]
+    with pytest.raises(ValueError):
+        MetricFactory(config=config_f, fill_dates=fill_dates)
+
+
+def test_budgeted_job_writes_within_its_budget(metric_factory):
+    # a job with a row budget should write at most that many metrics, and record the threshold that kept it within
+    fill_id = metric_factory.curr_fill
+    metric_factory.create()
+    fill_jobs_q = session.query(job).filter(job.fill_id == fill_id).filter(job.job_type == JobType.METRIC_CREATE.value)
+    budgeted_job = next(a_job for a_job in fill_jobs_q.all()
+                        if a_job.detail['dimension_properties'] == [Properties.PROJECT.value,
+                                                                    Properties.CITIZENSHIP.value]
+                        and a_job.detail['population_definition'] == PopulationDefinition.GTE_ONE_SITELINK.value)
+    fill_jobs_q.filter(job.id != budgeted_job.id) \
+        .update({job.job_state: JobState.COMPLETE.value}, synchronize_session=False)
+    fill_jobs_q.filter(job.id == budgeted_job.id) \
+        .update({job.job_state: JobState.UNATTEMPTED.value, job.errors: None}, synchronize_session=False)
+    session.commit()
+    configured_threshold = budgeted_job.detail['threshold']
+    properties_populations = get_job_properties_populations([budgeted_job])
+    take_results(fill_id, properties_populations)
+    make_job_creator(budgeted_job, session).run()
+    [(unbudgeted_cells, _)] = take_results(fill_id, properties_populations)
+    row_budget = len(unbudgeted_cells) // 2
+    assert row_budget > 0
+
+    metric_factory.db_session.commit()  # to see the job states set above
+    try:
+        metric_factory._get_uncompleted_metric_create_jobs()
+        assert metric_factory.metric_job.id == budgeted_job.id
+        metric_factory.metric_job.detail['row_budget'] = row_budget
+        flag_modified(metric_factory.metric_job, 'detail')
+        metric_factory._create_metric_creators()
+        metric_factory._run_metric_creators()
+        session.expire_all()
+        a_job = session.query(job).get(budgeted_job.id)
+        assert a_job.job_state == JobState.COMPLETE.value
+
+        [(budgeted_cells, _)] = take_results(fill_id, properties_populations)
+        applied_threshold = a_job.detail['threshold']
+        assert len(budgeted_cells) <= row_budget
+        assert applied_threshold > (configured_threshold or 0)
+        assert budgeted_cells == [cell for cell in unbudgeted_cells if cell[2] >= applied_threshold]
+    finally:
+        # the other tests run the job with its configured threshold
+        session.expire_all()
+        a_job = session.query(job).get(budgeted_job.id)
+        a_job.detail.pop('row_budget', None)
+        a_job.detail['threshold'] = configured_threshold
+        flag_modified(a_job, 'detail')
+        session.commit()
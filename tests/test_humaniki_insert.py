@@ -0,0 +1,227 @@
+import gzip
+import os
+
+import pytest
+import yaml
+
+from humaniki_schema import db, insert
+from humaniki_schema.insert import HumanikiDataInserter, external_sort_csv
+from humaniki_schema.queries import get_latest_fill_id, get_fill_by_id, update_fill_detail, get_exact_fill
+from humaniki_schema.schema import fill, human, human_country, human_occupation, human_sitelink, occupation_parent
+from humaniki_schema.utils import read_config_file, make_dump_date_from_str
+
+config = read_config_file(os.environ['HUMANIKI_YAML_CONFIG'], __file__)
+session = db.session_factory()
+
+# the columns of each table that the wdtk csvs have, in their order
+CSV_COLUMNS = {human: ['qid', 'gender', 'year_of_birth', 'sitelink_count'],
+               human_country: ['human_id', 'country'],
+               human_occupation: ['human_id', 'occupation'],
+               human_sitelink: ['human_id', 'sitelink'],
+               occupation_parent: ['occupation', 'parent']}
+
+
+def get_fill_rows(fill_id):
+    """{table name: the sorted csv columns of the fill's rows}"""
+    return {table.__tablename__: sorted(tuple(row) for row in
+                                        session.query(*[getattr(table, col) for col in columns])
+                                        .filter(table.fill_id == fill_id).all())
+            for table, columns in CSV_COLUMNS.items()}
+
+
+def write_fill_csvs(fill_id, csv_dir, compress=False):
+    """write a fill's human tables out like wdtk does, with no labels"""
+    os.makedirs(csv_dir)
+    open_f = (lambda f: gzip.open(f'{f}.gz', 'wt')) if compress else (lambda f: open(f, 'w'))
+    for table_name, rows in get_fill_rows(fill_id).items():
+        with open_f(os.path.join(csv_dir, f'{table_name}.csv')) as csv_out:
+            for row in rows:
+                csv_out.write(','.join(r'\N' if value is None else str(value) for value in row) + '\n')
+    with open_f(os.path.join(csv_dir, 'label.csv')):
+        pass
+
+
+def make_config(tmp_path, **insertion):
+    """the test config with some insertion settings overridden, for HumanikiDataInserter to read"""
+    inserter_config = dict(config)
+    inserter_config['insertion'] = {**config['insertion'], 'wdtk_processing_output': str(tmp_path),
+                                    'build_human_fact': False, 'collect_stats': False, 'bulk_load': False,
+                                    'sort_csvs': False, **insertion}
+    config_f = os.path.join(tmp_path, 'insert_config.yaml')
+    with open(config_f, 'w') as config_out:
+        yaml.safe_dump(inserter_config, config_out)
+    return config_f
+
+
+@pytest.fixture
+def inserted_fills():
+    """the ids of the fills a test inserted, which are deleted afterwards"""
+    fill_ids = []
+    yield fill_ids
+    for fill_id in fill_ids:
+        for table in [*CSV_COLUMNS, fill]:
+            id_col = table.id if table is fill else table.fill_id
+            session.query(table).filter(id_col == fill_id).delete()
+        session.commit()
+
+
+def insert_fill(tmp_path, dump_date, insert_strategy, **insertion):
+    inserter = HumanikiDataInserter(make_config(tmp_path, **insertion), dump_date=dump_date,
+                                    insert_strategy=insert_strategy)
+    inserter.run()
+    return inserter.fill_id
+
+
+def get_load_threads(executed_sql):
+    """the threads that ran LOAD DATA statements"""
+    return {statement.thread for statement in executed_sql if statement.sql.lstrip().startswith('LOAD DATA')}
+
+
+def test_concurrent_insert_matches_infile(tmp_path, inserted_fills, executed_sql):
+    source_fill_id, _ = get_latest_fill_id(session)
+    source_rows = get_fill_rows(source_fill_id)
+    for dump_date in ('20300101', '20300102'):
+        write_fill_csvs(source_fill_id, os.path.join(tmp_path, dump_date))
+
+    inserted_fills.append(insert_fill(tmp_path, '20300101', 'infile'))
+    executed_sql.clear()
+    inserted_fills.append(insert_fill(tmp_path, '20300102', 'concurrent', insert_concurrency=3))
+    infile_fill_id, concurrent_fill_id = inserted_fills
+    # the csvs were loaded side by side, by at most insert_concurrency threads
+    assert 1 < len(get_load_threads(executed_sql)) <= 3
+
+    assert get_fill_rows(infile_fill_id) == source_rows
+    assert get_fill_rows(concurrent_fill_id) == source_rows
+    insert_timings = get_fill_by_id(session, concurrent_fill_id).detail['insert_timings']
+    assert {table_name: timing['rows'] for table_name, timing in insert_timings.items()} == \
+        {**{table_name: len(rows) for table_name, rows in source_rows.items()}, 'label': 0}
+
+
+def test_gzipped_insert_matches_infile(tmp_path, inserted_fills, executed_sql):
+    source_fill_id, _ = get_latest_fill_id(session)
+    source_rows = get_fill_rows(source_fill_id)
+    write_fill_csvs(source_fill_id, os.path.join(tmp_path, '20300101'))
+    write_fill_csvs(source_fill_id, os.path.join(tmp_path, '20300102'), compress=True)
+
+    inserted_fills.append(insert_fill(tmp_path, '20300101', 'infile'))
+    executed_sql.clear()
+    inserted_fills.append(insert_fill(tmp_path, '20300102', 'infile', local_infile=True))
+    infile_fill_id, gzipped_fill_id = inserted_fills
+    # every csv was decompressed here and streamed to the server, which never got a .gz path
+    loads = [statement.sql for statement in executed_sql if statement.sql.lstrip().startswith('LOAD DATA')]
+    assert len(loads) == len(CSV_COLUMNS) + 1
+    assert all(load.lstrip().startswith('LOAD DATA LOCAL INFILE') and '.gz' not in load for load in loads)
+
+    assert get_fill_rows(infile_fill_id) == source_rows
+    assert get_fill_rows(gzipped_fill_id) == source_rows
+
+
+def test_fill_stats_warn_of_a_shrunk_table(tmp_path, inserted_fills, monkeypatch):
+    source_fill_id, _ = get_latest_fill_id(session)
+    source_rows = get_fill_rows(source_fill_id)
+    for dump_date in ('20300101', '20300102'):
+        write_fill_csvs(source_fill_id, os.path.join(tmp_path, dump_date))
+    # the second dump's human csv is truncated to a quarter of it
+    human_csv = os.path.join(tmp_path, '20300102', 'human.csv')
+    with open(human_csv) as csv_in:
+        human_lines = csv_in.readlines()
+    with open(human_csv, 'w') as csv_out:
+        csv_out.writelines(human_lines[:len(human_lines) // 4])
+    warned = []
+    monkeypatch.setattr(insert.log, 'warning', warned.append)
+
+    inserted_fills.append(insert_fill(tmp_path, '20300101', 'infile', collect_stats=True))
+    stats = get_fill_by_id(session, inserted_fills[0]).detail['stats']
+    assert stats['rows'] == {**{table_name: len(rows) for table_name, rows in source_rows.items()}, 'label': 0}
+    assert stats['distinct']['gender'] == len({row[1] for row in source_rows['human'] if row[1] is not None})
+    assert not warned
+
+    update_fill_detail(session, inserted_fills[0], 'active', True)
+    inserted_fills.append(insert_fill(tmp_path, '20300102', 'infile', collect_stats=True))
+    stats = get_fill_by_id(session, inserted_fills[1]).detail['stats']
+    assert stats['rows']['human'] == len(human_lines) // 4
+    assert len(warned) == 1 and 'human rows' in warned[0]
+
+
+def test_chunked_insert_resumes_after_a_failure(tmp_path, inserted_fills, executed_sql, monkeypatch):
+    source_fill_id, _ = get_latest_fill_id(session)
+    source_rows = get_fill_rows(source_fill_id)
+    write_fill_csvs(source_fill_id, os.path.join(tmp_path, '20300101'))
+    chunk_insertion = dict(local_infile=True, chunk_size_mb=1 / 1024, overwrite=True)
+
+    # the load fails after a few chunks
+    execute_streamed_infile = HumanikiDataInserter.execute_streamed_infile
+    loads_before_failure = 4
+    chunks_loaded = []
+
+    def fail_after_some_loads(self, *args, **kwargs):
+        if len(chunks_loaded) == loads_before_failure:
+            raise RuntimeError('connection lost')
+        chunks_loaded.append(execute_streamed_infile(self, *args, **kwargs))
+        return chunks_loaded[-1]
+
+    monkeypatch.setattr(HumanikiDataInserter, 'execute_streamed_infile', fail_after_some_loads)
+    with pytest.raises(RuntimeError):
+        insert_fill(tmp_path, '20300101', 'chunked', **chunk_insertion)
+    failed_fill = get_exact_fill(session, make_dump_date_from_str('20300101'))
+    inserted_fills.append(failed_fill.id)
+    monkeypatch.setattr(HumanikiDataInserter, 'execute_streamed_infile', execute_streamed_infile)
+
+    # the rerun, even with overwrite set, loads the rest of the chunks into the same fill
+    executed_sql.clear()
+    assert insert_fill(tmp_path, '20300101', 'chunked', **chunk_insertion) == failed_fill.id
+    session.expire_all()
+    extant_csvs = get_fill_by_id(session, failed_fill.id).detail['extant_csvs']
+    resumed_loads = [statement for statement in executed_sql if statement.sql.lstrip().startswith('LOAD DATA')]
+    # no chunk was loaded twice
+    assert len(resumed_loads) == sum(len(chunks) for chunks in extant_csvs.values()) - loads_before_failure
+    assert get_fill_rows(failed_fill.id) == source_rows
+
+
+def get_session_checks(db_session):
+    return tuple(db_session.execute('SELECT @@SESSION.unique_checks, @@SESSION.foreign_key_checks').fetchone())
+
+
+def test_bulk_load_verifies_the_fill(tmp_path, inserted_fills):
+    source_fill_id, _ = get_latest_fill_id(session)
+    source_rows = get_fill_rows(source_fill_id)
+    for dump_date in ('20300101', '20300102'):
+        write_fill_csvs(source_fill_id, os.path.join(tmp_path, dump_date))
+    # a duplicate row, which LOAD DATA IGNORE skips, and a citizenship of a human that isn't in the csvs
+    country_csv = os.path.join(tmp_path, '20300101', 'human_country.csv')
+    with open(country_csv) as csv_in:
+        duplicate_line = csv_in.readline()
+    with open(country_csv, 'a') as csv_out:
+        csv_out.write(duplicate_line)
+    with open(os.path.join(tmp_path, '20300102', 'human_country.csv'), 'a') as csv_out:
+        csv_out.write(f'{max(row[0] for row in source_rows["human"]) + 1},30\n')
+
+    inserter = HumanikiDataInserter(make_config(tmp_path, bulk_load=True), dump_date='20300101',
+                                    insert_strategy='infile')
+    inserter.run()
+    inserted_fills.append(inserter.fill_id)
+    assert get_session_checks(inserter.db_session) == (1, 1)
+    assert get_fill_rows(inserter.fill_id) == source_rows
+    assert get_fill_by_id(session, inserter.fill_id).detail['integrity']['skipped_human_country'] == 1
+
+    inserter = HumanikiDataInserter(make_config(tmp_path, bulk_load=True), dump_date='20300102',
+                                    insert_strategy='infile')
+    with pytest.raises(ValueError, match='orphan_countries'):
+        inserter.run()
+    inserted_fills.append(inserter.fill_id)
+    assert get_session_checks(inserter.db_session) == (1, 1)
+
+
+def test_external_sort_csv(tmp_path):
+    # sorted by the integer human_id only, the sitelinks of a human keep their order, across the merge of the runs too
+    lines = [b'100,enwiki\n', b'9,zzwiki\n', b'10,frwiki\n', b'9,aawiki\n', b'100,dewiki\n', b'10,eswiki\n']
+    csv_f = os.path.join(tmp_path, 'human_sitelink.csv')
+    with open(csv_f, 'wb') as csv_out:
+        csv_out.writelines(lines)
+    sorted_f = os.path.join(tmp_path, 'human_sitelink.csv.gz')
+    # a buffer of a couple of lines sorts the csv in three runs
+    assert external_sort_csv(csv_f, sorted_f, [0], buffer_bytes=12, tmp_dir=str(tmp_path)) == len(lines)
+    with gzip.open(sorted_f, 'rb') as sorted_in:
+        assert sorted_in.readlines() == [b'9,zzwiki\n', b'9,aawiki\n', b'10,frwiki\n', b'10,eswiki\n',
+                                         b'100,enwiki\n', b'100,dewiki\n']
+    assert sorted(os.listdir(tmp_path)) == ['human_sitelink.csv', 'human_sitelink.csv.gz']
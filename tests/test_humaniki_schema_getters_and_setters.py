@@ -8,7 +8,7 @@ from sqlalchemy import func
 
 from humaniki_schema import db
 from humaniki_schema.queries import get_aggregations_obj, get_latest_fill_id
-from humaniki_schema.schema import metric, metric_aggregations_n
+from humaniki_schema.schema import metric, metric_aggregations_n, metric_aggregations_wide
 from humaniki_schema.utils import read_config_file
 
 config = read_config_file(os.environ['HUMANIKI_YAML_CONFIG'], __file__)
@@ -50,3 +50,18 @@ def test_get_aggregations_n(test_jsons):
     dob_rows = [row for row in aggregation_objs if row.property == 569]
     assert len(dob_rows) == 1
     assert dob_rows[0].value == 1952
+
+
+def test_get_aggregations_wide(test_jsons):
+    ordered_aggregations = {569: '1952'}
+    aggregation_objs = get_aggregations_obj(bias_value=None, dimension_values=ordered_aggregations,
+                                            session=session, table=metric_aggregations_wide)
+    assert isinstance(aggregation_objs, list)
+    assert len(aggregation_objs) >= 1  # one row per gender born in 1952
+    assert all(row.val_1 == 1952 for row in aggregation_objs)
+    assert all(row.val_2 is None for row in aggregation_objs)
+
+    # the wide table has the same aggregations as the normalized one
+    n_ids = {row.id for row in get_aggregations_obj(bias_value=None, dimension_values=ordered_aggregations,
+                                                    session=session, table=metric_aggregations_n)}
+    assert {row.id for row in aggregation_objs} <= n_ids
@@ -0,0 +1,54 @@
+import hashlib
+
+from humaniki_schema.utils import aggregations_hash, properties_hash, property_mask, coverage_from_property_masks, \
+    Properties, threshold_for_row_budget
+
+
+def test_aggregations_hash_matches_mysql_json_serialization():
+    # MySQL's MD5(JSON_ARRAY(6581097, JSON_ARRAY(0, 27), JSON_ARRAY('enwiki', 30))) hashes this exact text
+    mysql_json_text = '[6581097, [0, 27], ["enwiki", 30]]'
+    expected = hashlib.md5(mysql_json_text.encode('utf-8')).digest()
+    assert aggregations_hash(6581097, [0, 27], ['enwiki', 30]) == expected
+    assert len(expected) == 16  # fits the BINARY(16) column
+
+
+def test_aggregations_hash_is_content_addressed():
+    assert aggregations_hash(6581097, (0,), ('enwiki',)) == aggregations_hash(6581097, [0], ['enwiki'])
+    # the same value under different properties is a different aggregation
+    assert aggregations_hash(6581097, [27], [1950]) != aggregations_hash(6581097, [569], [1950])
+    # and so is a different bias value
+    assert aggregations_hash(6581097, [0], ['enwiki']) != aggregations_hash(6581072, [0], ['enwiki'])
+
+
+def test_properties_hash_matches_mysql_json_serialization():
+    expected = hashlib.md5('[21, [0, 27]]'.encode('utf-8')).digest()
+    assert properties_hash(21, [0, 27]) == expected
+    assert properties_hash(21, []) == hashlib.md5('[21, []]'.encode('utf-8')).digest()
+
+
+def test_coverage_from_property_masks():
+    project_citizenship = property_mask([Properties.PROJECT, Properties.CITIZENSHIP])
+    # (property mask, population bucket): (humans, sitelinks)
+    mask_totals = {(0, 0): (100, 0),
+                   (property_mask([Properties.CITIZENSHIP]), 0): (10, 0),
+                   (property_mask([Properties.PROJECT]), 1): (7, 20),
+                   (project_citizenship, 1): (5, 11),
+                   (project_citizenship | property_mask([Properties.DATE_OF_BIRTH]), 1): (2, 3)}
+    assert coverage_from_property_masks(mask_totals, [], 0) == (124, 34)
+    assert coverage_from_property_masks(mask_totals, [], 1) == (14, 34)
+    assert coverage_from_property_masks(mask_totals, [Properties.CITIZENSHIP], 0) == (17, 14)
+    assert coverage_from_property_masks(mask_totals, [Properties.PROJECT, Properties.CITIZENSHIP], 1) == (7, 14)
+    assert coverage_from_property_masks(mask_totals, [Properties.OCCUPATION], 0) == (0, 0)
+
+
+def test_threshold_for_row_budget():
+    # {group size: number of groups}
+    size_counts = {1: 1000, 2: 300, 5: 40, 100: 2}
+    assert threshold_for_row_budget(size_counts, 10000) is None
+    assert threshold_for_row_budget(size_counts, 1342) is None
+    assert threshold_for_row_budget(size_counts, 1341) == 2
+    assert threshold_for_row_budget(size_counts, 342) == 2
+    assert threshold_for_row_budget(size_counts, 341) == 3
+    assert threshold_for_row_budget(size_counts, 41) == 6
+    assert threshold_for_row_budget(size_counts, 1) == 101
+    assert threshold_for_row_budget({}, 0) is None